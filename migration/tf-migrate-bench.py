@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmark of tf-migrate.py.
+
+Tool generates synthetic local git repos shaped like repos-config.yaml (one moved project,
+tf-controller and dependent projects with links to moved one), runs 'clone', 'commit', 'review'
+and 'merge' of tf-migrate.py against them and records timings. Then 'clone' and 'commit' are run
+once more through tf-migrate loaded as library to check library mode. Nothing is sent to real gerrit:
+
+- ssh:// urls of gerrit are redirected to local bare repos by 'url.<base>.insteadOf' in private git config
+- 'ssh ... gerrit query/review/set-reviewers' is served by fake gerrit with state in json file
+- 'git review' and 'scp hooks/commit-msg' are replaced by local stand-ins
+
+Time of '_patch_dir' scanner and gerrit commands is taken from trace of tf-migrate (see --trace there).
+Results are appended to results file and compared with previous run of the same scale,
+so regressions are visible.
+
+Optional params:
+
+--work-dir - path to dir with generated repos, logs and results (default is 'bench' in script's dir)
+--scale - scale of repos: small, medium or large. may be set several times (default is small)
+--projects - number of dependent projects (overrides scale)
+--files - number of files per project (overrides scale)
+--size - average size of file in bytes (overrides scale)
+--branches - number of branches per project (overrides scale)
+--density - part of files with links to moved project (overrides scale)
+--jobs - number of parallel jobs of tf-migrate (default is 8)
+--gerrit-latency - seconds which fake gerrit waits for each command to emulate network
+--threshold - percent of slowdown against previous run to report regression (default is 20)
+--results - path to results file (default is 'results.jsonl' in work dir)
+"""
+
+import argparse
+import contextlib
+import datetime
+import fcntl
+import importlib.util
+import json
+import os
+import random
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+
+TF_MIGRATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tf-migrate.py')
+MOVED_PROJECT = 'contrail-bench'
+MOVED_DST_ORG = 'tungstenfabric'
+MOVED_DST = 'tf-bench'
+DEPENDENT_ORG = 'tungstenfabric'
+CONTROLLER = 'tf-controller'
+BENCH_USER = 'bench'
+OPERATIONS = ('clone', 'commit', 'review', 'merge')
+SCALES = {
+    'small': {'projects': 5, 'files': 50, 'size': 2048, 'branches': 1, 'density': 0.1},
+    'medium': {'projects': 20, 'files': 500, 'size': 4096, 'branches': 2, 'density': 0.05},
+    'large': {'projects': 50, 'files': 2000, 'size': 8192, 'branches': 3, 'density': 0.02},
+}
+DEFAULT_THRESHOLD = 20
+# seconds. smaller slowdowns are noise of short operations
+REGRESSION_MIN_DELTA = 0.5
+FILES_PER_DIR = 20
+FILE_SUFFIXES = ('.py', '.yaml', '.md', '.txt', '.json')
+WORDS = ('contrail', 'vrouter', 'agent', 'config', 'control', 'analytics', 'build', 'test', 'deploy',
+         'node', 'network', 'policy', 'schema', 'api', 'server', 'client', 'package', 'image')
+COMMIT_MSG_HOOK = '''#!/bin/sh
+grep -q '^Change-Id:' "$1" || printf '\\nChange-Id: I%s\\n' "$( (cat "$1"; date +%s%N; echo $$) | git hash-object --stdin)" >> "$1"
+'''
+WRAPPER = '#!/bin/sh\nexec {} {} {} "$@"\n'
+# fake tools are executed as 'tf-migrate-bench.py fake-<tool> ...'
+FAKE_TOOLS = ('ssh', 'scp', 'git-review')
+GERRIT_STATE_ENV = 'TF_MIGRATE_BENCH_GERRIT'
+GERRIT_LATENCY_ENV = 'TF_MIGRATE_BENCH_LATENCY'
+
+
+def log(message, level='INFO'):
+    print(level + ' ' + message, flush=True)
+
+
+def _load_tf_migrate():
+    # file name has dash, so it's loaded by path
+    spec = importlib.util.spec_from_file_location('tf_migrate', TF_MIGRATE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# loaded by main only - fake tools don't need it
+tf_migrate = None
+
+
+# Fake gerrit section
+
+def _gerrit_state(func):
+    """Executes func(state) under lock of state file and saves state back."""
+    path = os.environ[GERRIT_STATE_ENV]
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = {'changes': dict()}
+        if os.path.exists(path):
+            with open(path) as fh:
+                state = json.load(fh)
+        result = func(state)
+        with open(path, 'w') as fh:
+            json.dump(state, fh)
+    return result
+
+
+def _match_query(change, query):
+    change_ids = re.findall(r'(?:change:)?\b(I[0-9a-f]{40})\b', query)
+    projects = re.findall(r'project:([^\s()]+)', query)
+    statuses = re.findall(r'status:(\w+)', query)
+    if change_ids and change['id'] not in change_ids:
+        return False
+    if projects and change['project'] not in projects:
+        return False
+    if statuses and (change['status'] == 'NEW') != (statuses[0] == 'open'):
+        return False
+    return True
+
+
+def fake_ssh(args):
+    # remote side of ssh joins arguments by spaces and splits them again by shell rules
+    if 'gerrit' not in args:
+        sys.stderr.write("fake gerrit: unsupported command {}\n".format(args))
+        return 1
+    params = shlex.split(' '.join(args[args.index('gerrit') + 1:]))
+    time.sleep(float(os.environ.get(GERRIT_LATENCY_ENV) or 0))
+    command, params = params[0], params[1:]
+    if command == 'query':
+        query = ' '.join(item for item in params if not item.startswith('--') and item != 'JSON')
+        changes = _gerrit_state(lambda state: [change for change in state['changes'].values()
+                                               if _match_query(change, query)])
+        for change in changes:
+            print(json.dumps(change))
+        print(json.dumps({'type': 'stats', 'rowCount': len(changes)}))
+        return 0
+    if command == 'review':
+        revision = params[-1]
+        approved = params[params.index('--approved') + 1] if '--approved' in params else None
+
+        def _review(state):
+            for change in state['changes'].values():
+                if change['currentPatchSet']['revision'] != revision:
+                    continue
+                if approved:
+                    change['currentPatchSet']['approvals'].append({'type': 'Approved', 'value': approved})
+                if '--message' in params:
+                    change['comments'] = change.get('comments', 0) + 1
+                return True
+            return False
+
+        if not _gerrit_state(_review):
+            sys.stderr.write("fake gerrit: revision {} is not found\n".format(revision))
+            return 1
+        return 0
+    if command == 'set-reviewers':
+        return 0
+    sys.stderr.write("fake gerrit: unsupported command {}\n".format(command))
+    return 1
+
+
+def fake_scp(args):
+    # only 'scp -p -P port user@host:hooks/commit-msg dir/' is used
+    path = os.path.join(args[-1], 'commit-msg')
+    with open(path, 'w') as fh:
+        fh.write(COMMIT_MSG_HOOK)
+    os.chmod(path, 0o755)
+    return 0
+
+
+def fake_git_review(args):
+    def _git(*params):
+        return subprocess.check_output(['git'] + list(params)).decode().strip()
+
+    topic = args[args.index('-t') + 1] if '-t' in args else None
+    revision = _git('rev-parse', 'HEAD')
+    branch = _git('symbolic-ref', '--short', 'HEAD')
+    change_id = None
+    for line in _git('log', '-1', '--format=%B').splitlines():
+        if line.startswith('Change-Id:'):
+            change_id = line.split(':')[1].strip()
+    # origin is mirror or gerrit url redirected to local bare repo - both end with <org>/<project>.git
+    url = _git('config', 'remote.origin.url')
+    project = '/'.join(url.rstrip('/').split('/')[-2:])[:-len('.git')]
+    number = _gerrit_state(lambda state: len(state['changes'].get(change_id, dict()).get('patchSets', list())) + 1)
+    # push is emulated by ref in origin like gerrit's refs/changes
+    _git('push', '-q', 'origin', 'HEAD:refs/changes/{}/{}'.format(change_id, number))
+
+    def _push(state):
+        change = state['changes'].setdefault(change_id, {
+            'id': change_id, 'project': project, 'branch': branch, 'topic': topic, 'status': 'NEW', 'patchSets': list()})
+        # fake CI and reviewers approve each patch set at once, so merge can be measured
+        change['currentPatchSet'] = {'number': number, 'revision': revision, 'approvals': [
+            {'type': 'Code-Review', 'value': '2'}, {'type': 'Verified', 'value': '1'}]}
+        change['patchSets'].append(revision)
+
+    _gerrit_state(_push)
+    return 0
+
+
+# Synthetic repos section
+
+def _file_content(rnd, size, references):
+    lines = list()
+    length = 0
+    while length < size:
+        line = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(4, 10))) + '\n'
+        lines.append(line)
+        length += len(line)
+    src_key = '{}/{}'.format(tf_migrate.SRC_ORGANIZATION, MOVED_PROJECT)
+    for _ in range(references):
+        link = rnd.choice(('https://github.com/{}\n'.format(src_key),
+                           'git clone https://github.com/{}.git\n'.format(src_key),
+                           'project: {}\n'.format(src_key),
+                           'path: src/{}\n'.format(MOVED_PROJECT)))
+        lines.insert(rnd.randint(0, len(lines)), link)
+    return ''.join(lines).encode()
+
+
+def _project_files(rnd, params, with_references):
+    files = dict()
+    size = params['size']
+    for i in range(params['files']):
+        path = 'dir{:03d}/file{:04d}{}'.format(i // FILES_PER_DIR, i, FILE_SUFFIXES[i % len(FILE_SUFFIXES)])
+        references = rnd.randint(1, 3) if with_references and rnd.random() < params['density'] else 0
+        files[path] = _file_content(rnd, rnd.randint(size // 2, size * 3 // 2), references)
+    return files
+
+
+def _create_repo(path, branches, files):
+    """Creates bare repo with files in first branch and one own file in each next branch by fast-import."""
+    os.makedirs(path)
+    subprocess.check_call(['git', 'init', '-q', '--bare'], cwd=path)
+    proc = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE)
+    out = proc.stdin
+    committer = 'committer Bench <bench@example.com> {} +0000\n'.format(int(time.time())).encode()
+
+    def _data(data):
+        out.write(b'data ' + str(len(data)).encode() + b'\n' + data + b'\n')
+
+    for mark, data in enumerate(files.values(), 1):
+        out.write(b'blob\nmark :' + str(mark).encode() + b'\n')
+        _data(data)
+    commit_mark = len(files) + 1
+    out.write('commit refs/heads/{}\nmark :{}\n'.format(branches[0], commit_mark).encode() + committer)
+    _data(b'Initial commit\n')
+    for mark, name in enumerate(files, 1):
+        out.write('M 100644 :{} {}\n'.format(mark, name).encode())
+    for branch in branches[1:]:
+        out.write('commit refs/heads/{}\n'.format(branch).encode() + committer)
+        _data('Branch {}\n'.format(branch).encode())
+        out.write('from :{}\nM 100644 inline BRANCH\n'.format(commit_mark).encode())
+        _data(branch.encode())
+    out.close()
+    if proc.wait():
+        raise Exception("fast-import failed for {}".format(path))
+    subprocess.check_call(['git', 'symbolic-ref', 'HEAD', 'refs/heads/' + branches[0]], cwd=path)
+
+
+def generate(root, params, seed=0):
+    """Creates remote repos and repos config of given scale in root. Returns path to repos config."""
+    rnd = random.Random(seed)
+    remote_dir = os.path.join(root, 'remote')
+    branches = ['master'] + ['R{}'.format(2000 + i) for i in range(1, params['branches'])]
+    gitreview = lambda project: '[gerrit]\nhost={}\nport={}\nproject={}.git\n'.format(
+        tf_migrate.GERRIT_URL, tf_migrate.GERRIT_PORT, project).encode()
+
+    src_key = '{}/{}'.format(tf_migrate.SRC_ORGANIZATION, MOVED_PROJECT)
+    files = _project_files(rnd, params, with_references=True)
+    files['.gitreview'] = gitreview(src_key)
+    _create_repo(os.path.join(remote_dir, src_key + '.git'), branches, files)
+    dst_key = '{}/{}'.format(MOVED_DST_ORG, MOVED_DST)
+    _create_repo(os.path.join(remote_dir, dst_key + '.git'), branches,
+                 {'.gitreview': gitreview(dst_key), 'LICENSE': b'Apache License 2.0\n'})
+
+    projects = [{'src': MOVED_PROJECT, 'dst_org': MOVED_DST_ORG, 'dst': MOVED_DST, 'branches': branches}]
+    names = [CONTROLLER] + ['tf-dep-{:03d}'.format(i) for i in range(1, params['projects'])]
+    for name in names:
+        pkey = '{}/{}'.format(DEPENDENT_ORG, name)
+        _create_repo(os.path.join(remote_dir, pkey + '.git'), branches,
+                     _project_files(rnd, params, with_references=True))
+        projects.append({'src': name, 'src_org': DEPENDENT_ORG, 'branches': branches})
+    config = os.path.join(root, 'repos-config.yaml')
+    with open(config, 'w') as fh:
+        json.dump({'default_branches': ['master'], 'projects': projects}, fh, indent=2)
+    return config
+
+
+def prepare_env(root, latency):
+    """Creates fake tools and private git config. Returns environment for tf-migrate."""
+    bin_dir = os.path.join(root, 'bin')
+    os.makedirs(bin_dir)
+    for tool in FAKE_TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as fh:
+            fh.write(WRAPPER.format(shlex.quote(sys.executable), shlex.quote(os.path.abspath(__file__)),
+                                    'fake-' + tool))
+        os.chmod(path, 0o755)
+    git_config = os.path.join(root, 'gitconfig')
+    with open(git_config, 'w') as fh:
+        fh.write('[user]\n\tname = Bench\n\temail = bench@example.com\n'
+                 '[init]\n\tdefaultBranch = master\n'
+                 '[url "{}/"]\n\tinsteadOf = ssh://{}@{}:{}/\n'.format(
+                     os.path.join(root, 'remote'), BENCH_USER, tf_migrate.GERRIT_URL, tf_migrate.GERRIT_PORT))
+    env = dict(os.environ)
+    env.update({
+        'PATH': bin_dir + os.pathsep + env.get('PATH', ''),
+        'GIT_CONFIG_GLOBAL': git_config,
+        'GIT_CONFIG_NOSYSTEM': '1',
+        GERRIT_STATE_ENV: os.path.join(root, 'gerrit.json'),
+        GERRIT_LATENCY_ENV: str(latency),
+    })
+    return env
+
+
+# Benchmark section
+
+def _trace_totals(path):
+    """Returns seconds spent in '_patch_dir' scanner and in gerrit commands by trace of tf-migrate."""
+    with open(path) as fh:
+        events = json.load(fh)['traceEvents']
+    totals = {'patch_dir': 0.0, 'gerrit': 0.0}
+    for event in events:
+        if event.get('ph') != 'X':
+            continue
+        if event['cat'] == 'scan':
+            totals['patch_dir'] += event['dur'] / 1e6
+        elif event['cat'] == 'gerrit' and event['name'].startswith('gerrit '):
+            totals['gerrit'] += event['dur'] / 1e6
+    return totals
+
+
+def check_library(root, config, env, jobs):
+    """Runs 'clone' and 'commit' through tf-migrate loaded as library in this process. Returns seconds."""
+    saved = dict(os.environ)
+    popen = subprocess.Popen
+    os.environ.update(env)
+    started = time.monotonic()
+    try:
+        migration_config = tf_migrate.MigrationConfig(
+            repos_config=config, workspace=os.path.join(root, 'library'), user=BENCH_USER, jobs=jobs,
+            trace=os.path.join(root, 'logs', 'trace-library.json'))
+        with open(os.path.join(root, 'logs', 'library.log'), 'w') as fh, contextlib.redirect_stdout(fh):
+            with tf_migrate.Migration(migration_config) as migration:
+                for operation in ('clone', 'commit'):
+                    migration.execute(operation, sources=[MOVED_PROJECT])
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+    if subprocess.Popen is not popen:
+        raise Exception("subprocess.Popen is changed by tracing")
+    with open(os.path.join(root, 'logs', 'trace-library.json')) as fh:
+        if not any(event.get('cat') == 'subprocess' for event in json.load(fh)['traceEvents']):
+            raise Exception("processes of tool are not traced")
+    return time.monotonic() - started
+
+
+def run_scale(args, name, params):
+    """Generates repos of scale and times each operation. Returns dict of results or None on failure."""
+    root = os.path.join(args.work_dir, name)
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.makedirs(os.path.join(root, 'logs'))
+    log("Scale {}: {}".format(name, ', '.join('{}={}'.format(key, params[key]) for key in sorted(params))))
+    started = time.monotonic()
+    config = generate(root, params)
+    log("    repos are generated in {:.1f}s".format(time.monotonic() - started))
+    env = prepare_env(root, args.gerrit_latency)
+
+    results = dict()
+    for operation in OPERATIONS:
+        trace = os.path.join(root, 'logs', 'trace-{}.json'.format(operation))
+        cmd = [sys.executable, TF_MIGRATE, '--repos-config', config, '--workspace', os.path.join(root, 'workspace'),
+               '--user', BENCH_USER, '--jobs', str(args.jobs), '--trace', trace, operation, MOVED_PROJECT]
+        log_path = os.path.join(root, 'logs', operation + '.log')
+        started = time.monotonic()
+        with open(log_path, 'w') as fh:
+            result = subprocess.call(cmd, env=env, stdout=fh, stderr=subprocess.STDOUT)
+        duration = time.monotonic() - started
+        if result:
+            log("    {} failed with code {}. See {}".format(operation, result, log_path), level='ERROR')
+            return None
+        results[operation] = round(duration, 3)
+        for key, value in _trace_totals(trace).items():
+            if value:
+                results['{}.{}'.format(operation, key)] = round(value, 3)
+        log("    {} took {:.2f}s".format(operation, duration))
+    try:
+        results['library'] = round(check_library(root, config, env, args.jobs), 3)
+    except (Exception, SystemExit) as e:
+        log("    library mode failed: {!r}. See {}".format(e, os.path.join(root, 'logs', 'library.log')),
+            level='ERROR')
+        return None
+    log("    clone and commit in library mode took {:.2f}s".format(results['library']))
+    return results
+
+
+def _previous(path, name, params, jobs):
+    # the latest result of the same scale and parameters
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as fh:
+        for line in fh:
+            record = json.loads(line)
+            if record['scale'] == name and record['params'] == params and record['jobs'] == jobs:
+                previous = record
+    return previous
+
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(TF_MIGRATE),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def report(name, results, previous, threshold):
+    """Logs results against previous ones. Returns number of regressions."""
+    regressions = 0
+    log("{:<24} {:>9} {:>9} {:>8}".format('scale ' + name, 'time,s', 'prev,s', 'change'))
+    for key in sorted(results):
+        old = previous['results'].get(key) if previous else None
+        change = ''
+        level = 'INFO'
+        if old:
+            percent = (results[key] - old) * 100 / old
+            change = '{:+.0f}%'.format(percent)
+            if percent > threshold and results[key] - old > REGRESSION_MIN_DELTA:
+                change += ' REGRESSION'
+                level = 'WARNING'
+                regressions += 1
+        log("{:<24} {:>9.2f} {:>9} {:>8}".format(key, results[key], '{:.2f}'.format(old) if old else '-', change),
+            level=level)
+    return regressions
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1].startswith('fake-') and sys.argv[1][5:] in FAKE_TOOLS:
+        tool = sys.argv[1][5:].replace('-', '_')
+        return globals()['fake_' + tool](sys.argv[2:])
+
+    global tf_migrate
+    tf_migrate = _load_tf_migrate()
+    parser = argparse.ArgumentParser(description="Offline benchmark of tf-migrate.py")
+    parser.add_argument('--work-dir', default='./bench', help="Path to dir with generated repos, logs and results")
+    parser.add_argument('--scale', action='append', choices=sorted(SCALES), help="Scale of repos")
+    for key, value_type in (('projects', int), ('files', int), ('size', int), ('branches', int), ('density', float)):
+        parser.add_argument('--' + key, type=value_type, help="Overrides {} of scale".format(key))
+    parser.add_argument('--jobs', type=int, default=tf_migrate.DEFAULT_JOBS, help="Number of parallel jobs of tf-migrate")
+    parser.add_argument('--gerrit-latency', type=float, default=0, help="Seconds of fake gerrit per command")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="Percent of slowdown to report regression")
+    parser.add_argument('--results', help="Path to results file")
+    args = parser.parse_args()
+    args.work_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), args.work_dir))
+    results_path = args.results or os.path.join(args.work_dir, 'results.jsonl')
+
+    failed = 0
+    regressions = 0
+    for name in args.scale or ['small']:
+        params = dict(SCALES[name])
+        overrides = {key: getattr(args, key) for key in params if getattr(args, key) is not None}
+        if overrides:
+            params.update(overrides)
+            name += '-custom'
+        params['gerrit_latency'] = args.gerrit_latency
+        results = run_scale(args, name, params)
+        if results is None:
+            failed += 1
+            continue
+        previous = _previous(results_path, name, params, args.jobs)
+        regressions += report(name, results, previous, args.threshold)
+        record = {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'revision': _revision(),
+                  'scale': name, 'params': params, 'jobs': args.jobs, 'results': results}
+        with open(results_path, 'a') as fh:
+            fh.write(json.dumps(record, sort_keys=True) + '\n')
+    log("Results are appended to {}".format(results_path))
+    if failed or regressions:
+        log("Failed scales: {}, regressions: {}".format(failed, regressions), level='ERROR')
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
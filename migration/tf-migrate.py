@@ -7,37 +7,85 @@ Optional params:
 --workspace - path to workspace where cloned repos will be placed (default is 'workspace' in script's dir)
 --user - user for git ssh access. This parameter is mandatory for some operations
 --force - flag to indicate that operation has to be forced
+--jobs - number of parallel git jobs (default is 8)
+--mirrors - path to shared bare mirrors of projects (default is '.mirrors' in workspace)
+--no-mirrors - flag to clone projects directly from gerrit without shared mirrors
+--ssh-connections - number of multiplexed ssh connections to gerrit (default is 4)
+--gerrit-rate - max number of gerrit write commands per second (default is 5, 0 means no limit)
+--plan - print plan of 'commit' or 'review' operation with estimated cost and exit
+--wave - name of wave from repos config. all projects of wave are migrated together (src may be omitted)
+--profile - record timing spans of operation, plan steps, tasks, git subprocesses and gerrit commands,
+            print top-N summary at the end and save trace (default is workspace/src/trace-<operation>-<time>.json)
+--trace - path to trace file in Chrome trace format (chrome://tracing, Perfetto). implies --profile
 
 Mandatory params:
 
 operation - Operation to execute
-src - Source project from Juniper's organization
+src - Source project(s) from Juniper's organization
+
+Several projects (or wave) are migrated by one run in workspace/<wave or src1+src2...>.
+Each dependent project/branch is scanned and patched once for all moved projects and gets
+one commit with 'Depends-On' for each moved project which links are changed in it.
 
 tool have next operations:
 
 clean - removes all content in workspace/src directory. (TODO: abandon reviews if they are present)
 
 clone - clones all projects to workspace. If project's dir already exists and 'git status' works well
-       then tool will just pull latest changes and chekout HEAD. Overwise it will re-clone it.
+       then tool will just fetch latest changes and reset branches to them. Overwise it will re-clone it.
+       Projects are cloned/updated in parallel (see --jobs).
+       Each project is fetched from gerrit once per run into shared bare mirror and all workspaces
+       borrow objects from it, so migration of several projects doesn't download everything again.
 
 commit - copies source's content to destination project and commits changes for each specified branch.
+         Each project/branch pair has own persistent git worktree (workspace/src/.worktrees),
+         so independent branches and dependent projects are processed in parallel (see --jobs).
 
 review - pushes committed changes to gerrit.
 
+commit and review are executed as plan (DAG) of project/branch steps. Finished steps are saved
+to workspace/src/.state-<operation>.json, so interrupted operation continues from unfinished steps.
+'clone' resets these states. Use '--plan' to see the steps and their estimated cost.
+
 merge - checks all pushed review and adds 'Approved +1' for all if 'Code Review +2' and 'Verified +1' are present for all.
         If some review doesn't have these labels then ERROR will be printed and merge will not be applied,
         or if flag 'force' is present then Approved will be set just for part of review with two labels set.
 
 notify - adds notification message to all open reviews for moved project
 
+references - prints all places in cloned projects/branches where moved project is referenced.
+             It uses persistent index (workspace/src/.index) which is updated incrementally by 'git diff'
+             from indexed commit to branch head. Same index is used by 'commit' to patch only files with hits.
+
+Tool can be used as library to run many operations from one process without re-parsing config
+(parsed repos config is cached until its mtime is changed). Files are scanned in threads then,
+since worker processes can't import module loaded by path. Tracing records only processes started by
+the tool, subprocess module isn't patched:
+
+    # module is loaded from tf-migrate.py by importlib.util.spec_from_file_location
+    with tf_migrate.Migration(tf_migrate.MigrationConfig(user='user', jobs=16)) as migration:
+        for wave in ('wave1', 'wave2'):
+            migration.execute('clone', wave=wave)
+            migration.execute('commit', wave=wave)
+
 """
 
 import argparse
+import concurrent.futures
+import contextlib
+import functools
 import json
+import mmap
+import multiprocessing
 import os
+import re
+import resource
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import yaml
 
 
@@ -50,74 +98,1060 @@ PATCH_COMMIT_MESSAGE = '[{}] Patch content from Juniper\n\nAutomated change\n'.f
 TEST_DIR = 'test'
 NOTIFICATION_MESSAGE = 'Please note that this project will be moved to TF soon.\nPlease create new review after moving is completed'
 README_MIGRATED = 'Content was moved to https://github.com/{}\n'
+DEFAULT_JOBS = 8
+MIRRORS_DIR = '.mirrors'
+INDEX_DIR = '.index'
+WORKTREES_DIR = '.worktrees'
+SSH_CONNECTIONS = 4
+# OpenSSH serves 10 sessions per connection by default
+SSH_SESSIONS_PER_CONNECTION = 8
+# multiplexed connections stay alive between runs of the tool
+SSH_CONTROL_PERSIST = '10m'
+# change ids per one 'gerrit query' to keep command line short
+GERRIT_QUERY_BATCH = 50
+STATE_FILE = '.state-{}.json'
+# default cost estimations of plan steps in seconds. real durations are used when they are known.
+PLAN_STEP_COSTS = {
+    'copy': 60,
+    'patch': 10,
+    'remove': 5,
+    'test': 5,
+    'push': 15,
+    'default': 10,
+}
+GERRIT_RATE = 5.0
+GERRIT_RETRIES = 3
+# seconds, doubled for each next retry
+GERRIT_RETRY_DELAY = 2
+# files bigger than this are searched through mmap
+MMAP_THRESHOLD = 1024 * 1024
+# like 'grep -I' file is binary if there is NUL byte in first block
+BINARY_CHECK_SIZE = 8192
+SCAN_SKIP_SUFFIXES = ('.zip', '.tgz', '.tar.gz')
+SCAN_CHUNK_SIZE = 64
+TRACE_FILE = 'trace-{}-{}.json'
+# rows in each table of profile summary
+PROFILE_TOP = 20
+# commands are cut in trace to keep it readable
+TRACE_CMD_LENGTH = 200
+
+log_lock = threading.Lock()
 
 
 def log(message, level='INFO'):
-    print(level + ' ' + message)
+    with log_lock:
+        print(level + ' ' + message, flush=True)
 
 
-class Migration():
+def _thread_io():
+    # bytes read and written by syscalls of current thread (including pipes), Linux only
+    try:
+        with open('/proc/thread-self/io') as fh:
+            counters = dict(line.split(': ') for line in fh.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
 
-    valid_operations = []
-    projects = dict()
+
+class Tracer():
+    """Collects timed spans of operation, plan steps, tasks, subprocesses and gerrit commands.
+
+    Each span keeps wall time, CPU time and bytes read/written by its thread and status
+    (exit code for subprocesses). Spans are saved in Chrome trace format (chrome://tracing
+    or Perfetto) and summarized in top-N tables. Disabled tracer doesn't record anything.
+    """
 
     def __init__(self):
-        self.path = os.path.abspath(os.path.dirname(sys.argv[0]))
-        self.valid_operations = list()
-        for func in dir(self):
-            if callable(getattr(self, func)) and func.startswith('_op_'):
-                self.valid_operations.append(func[4:])
-
-        self._parse_args()
-        self._load_repos_config()
+        self.enabled = False
+        self.events = list()
+        self.threads = dict()
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def enable(self):
+        # each operation has own trace
+        self.enabled = True
+        self.origin = time.perf_counter()
+        with self.lock:
+            self.events = list()
+
+    def disable(self):
+        self.enabled = False
+
+    def start(self):
+        """Returns counters of current thread at start of span."""
+        return threading.get_ident(), time.perf_counter(), time.thread_time(), _thread_io()
+
+    def finish(self, name, category, started, status, args=None):
+        thread_id, wall, cpu, io = started
+        duration = time.perf_counter() - wall
+        args = dict(args or dict(), status=status)
+        # CPU and I/O counters are per thread - they have sense only if span is finished in the same thread
+        if thread_id == threading.get_ident():
+            args['cpu'] = round(time.thread_time() - cpu, 6)
+            io_end = _thread_io()
+            if io and io_end:
+                args['read_bytes'] = io_end[0] - io[0]
+                args['written_bytes'] = io_end[1] - io[1]
+        thread = threading.current_thread()
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+            self.events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+                                'ts': round((wall - self.origin) * 1e6), 'dur': round(duration * 1e6), 'args': args})
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """Records span around block. Yields dict of span's args which block may extend."""
+        if not self.enabled:
+            yield args
+            return
+        started = self.start()
+        status = 'ok'
+        try:
+            yield args
+        except BaseException as e:
+            status = type(e).__name__
+            raise
+        finally:
+            self.finish(name, category, started, status, args)
+
+    def save(self, path):
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                  for tid, name in self.threads.items()]
+        with self.lock:
+            events.extend(self.events)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file_atomic(path, json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+
+    def summary(self, top=PROFILE_TOP):
+        """Logs top spans' kinds by total time and top slowest spans."""
+        # sessions live while other work is done - they are kept in trace only
+        events = [event for event in self.events if event['cat'] != 'session']
+        groups = dict()
+        for event in events:
+            group = groups.setdefault((event['cat'], event['name']), {
+                'count': 0, 'wall': 0.0, 'max': 0.0, 'cpu': 0.0, 'read': 0, 'written': 0, 'failed': 0})
+            args = event['args']
+            group['count'] += 1
+            group['wall'] += event['dur'] / 1e6
+            group['max'] = max(group['max'], event['dur'] / 1e6)
+            group['cpu'] += args.get('cpu', 0)
+            group['read'] += args.get('read_bytes', 0)
+            group['written'] += args.get('written_bytes', 0)
+            if args['status'] not in ('ok', 0):
+                group['failed'] += 1
+        log("Profile: top {} of {} kinds of spans by total time (nested spans are counted in parents too)"
+            "".format(min(top, len(groups)), len(groups)))
+        log("{:<10} {:<28} {:>6} {:>9} {:>8} {:>8} {:>10} {:>10} {:>6}".format(
+            'category', 'name', 'count', 'total,s', 'max,s', 'cpu,s', 'read,KiB', 'write,KiB', 'failed'))
+        for (category, name), group in sorted(groups.items(), key=lambda item: -item[1]['wall'])[:top]:
+            log("{:<10} {:<28} {:>6} {:>9.2f} {:>8.2f} {:>8.2f} {:>10.0f} {:>10.0f} {:>6}".format(
+                category, name[:28], group['count'], group['wall'], group['max'], group['cpu'],
+                group['read'] / 1024, group['written'] / 1024, group['failed']))
+        log("Profile: top {} slowest spans".format(top))
+        for event in sorted(events, key=lambda item: -item['dur'])[:top]:
+            details = ', '.join('{}={}'.format(key, value) for key, value in sorted(event['args'].items())
+                                if key not in ('cpu', 'read_bytes', 'written_bytes'))
+            log("{:>9.2f}s {}/{} {}".format(event['dur'] / 1e6, event['cat'], event['name'], details))
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        log("Profile: CPU time of tool {:.2f}s, of finished child processes {:.2f}s".format(
+            own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime))
+
+
+tracer = Tracer()
+
+
+def traced(category, name=None):
+    """Decorator which executes function in span of tracer."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name or func.__name__, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracedPopen(subprocess.Popen):
+    """Popen which records span from start of process till its exit status is collected."""
+
+    def __init__(self, args, *params, **kwargs):
+        self.trace_started = tracer.start() if tracer.enabled else None
+        super().__init__(args, *params, **kwargs)
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout=timeout)
+        if self.trace_started:
+            started, self.trace_started = self.trace_started, None
+            cmd = [self.args] if isinstance(self.args, (str, bytes)) else [str(arg) for arg in self.args]
+            name = os.path.basename(cmd[0])
+            if name == 'git' and len(cmd) > 1:
+                name += ' ' + cmd[1]
+            # processes fed through stdin pipe are long-lived sessions like 'git cat-file --batch'
+            category = 'session' if self.stdin else 'subprocess'
+            tracer.finish(name, category, started, returncode, {'cmd': ' '.join(cmd)[:TRACE_CMD_LENGTH]})
+        return returncode
+
+
+# processes of the tool are started by these counterparts of subprocess functions, so only they are
+# traced and subprocess module isn't patched for other code of process which uses tool as library
+
+def _call(cmd, **kwargs):
+    with TracedPopen(cmd, **kwargs) as proc:
+        try:
+            return proc.wait()
+        except BaseException:
+            proc.kill()
+            raise
+
+
+def _check_call(cmd, **kwargs):
+    returncode = _call(cmd, **kwargs)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def _check_output(cmd, check=True, **kwargs):
+    """Returns stdout of command, exit code is checked unless check is False."""
+    with TracedPopen(cmd, stdout=subprocess.PIPE, **kwargs) as proc:
+        try:
+            output = proc.communicate()[0]
+        except BaseException:
+            proc.kill()
+            raise
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+    return output
+
+
+def is_skipped_path(rel_path):
+    """Returns True for paths that walk_files skips."""
+    parts = rel_path.split('/')
+    if parts[-1].endswith(SCAN_SKIP_SUFFIXES) or '.git' in parts:
+        return True
+    # vendor/github.com directory, not a file named so
+    return any(parts[i] == 'vendor' and parts[i + 1] == 'github.com' for i in range(len(parts) - 2))
+
+
+def walk_files(repo_dir, skip_vendor=True):
+    """Yields relative paths of regular files in repo_dir except git internals, archives and vendored github code."""
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(os.path.join(repo_dir, rel_dir)) as it:
+            for entry in it:
+                rel_path = os.path.join(rel_dir, entry.name)
+                # '.git' is a file in worktrees
+                if entry.name == '.git':
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if skip_vendor and entry.name == 'github.com' and os.path.basename(rel_dir) == 'vendor':
+                        continue
+                    stack.append(rel_path)
+                elif entry.is_file(follow_symlinks=False):
+                    if skip_vendor and entry.name.endswith(SCAN_SKIP_SUFFIXES):
+                        continue
+                    yield rel_path
+
+
+def read_text_if_matches(path, pattern):
+    """Returns decoded content of text file if pattern is found in it or None overwise.
+
+    UnicodeDecodeError is raised for non utf-8 text files with match."""
+    with open(path, 'rb') as fh:
+        head = fh.read(BINARY_CHECK_SIZE)
+        if b'\0' in head:
+            return None
+        size = os.fstat(fh.fileno()).st_size
+        if size > MMAP_THRESHOLD:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if not pattern.search(mm):
+                    return None
+                data = mm[:]
+        else:
+            data = head + fh.read()
+            if not pattern.search(data):
+                return None
+    return data.decode()
+
+
+def write_file_atomic(path, content):
+    tmp_path = '{}.tf-migrate.tmp'.format(path)
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as fh:
+        fh.write(content)
+    if os.path.exists(path):
+        shutil.copymode(path, tmp_path)
+    os.replace(tmp_path, path)
+
+
+_patterns = dict()
+
+
+def _get_pattern(names):
+    # compiled once per process. file matches if it has any of names.
+    if names not in _patterns:
+        _patterns[names] = re.compile(b'|'.join(re.escape(name.encode()) for name in names), re.IGNORECASE)
+    return _patterns[names]
+
+
+def _is_name_end(lower, index):
+    # 'juniper/contrail-analytics' must not match in 'juniper/contrail-analytics-ui'
+    return index >= len(lower) or not (lower[index].isalnum() or lower[index] in '-_')
+
+
+def patch_lines(lines, rel_path, src_key, dst_key):
+    """Changes 'src_org/src_project' to 'dst_org/dst_project' in lines.
+
+    Returns new lines, flag that something was changed and list of warnings."""
+    src_key = src_key.lower()
+    src_org, src = src_key.split('/')
+    dst_key = dst_key.lower()
+
+    # check file, change something, print warnings
+    # tool have to change 'src_org/src_project' to 'dst_org/dst_project'
+    #   - except link to github.com/**/wiki
+    #   - except links to github.com with commit SHA
+    # tool have to find all 'project'
+    #   - skip all like 'src/project'
+    #   - skip occurrences in files *requirements.txt, ci_unittests.json
+    #   - print warnings for rest
+
+    link_prefix = 'https://github.com/'
+    wiki_link = '{}{}/wiki'.format(link_prefix, src_key)
+    commit_link = '{}{}/blob'.format(link_prefix, src_key)
+    skip_names = rel_path.endswith('requirements.txt') or os.path.basename(rel_path) == 'ci_unittests.json'
+
+    patched = False
+    warnings = []
+    new_lines = []
+    for line_num, line in enumerate(lines, 1):
+        lower = line.lower()
+        if src not in lower:
+            new_lines.append(line)
+            continue
+        index = 0
+        while True:
+            index = lower.find(src_key, index)
+            if index == -1:
+                break
+            # key of other project which name starts with src
+            if not _is_name_end(lower, index + len(src_key)):
+                index += len(src_key)
+                continue
+            link_index = index - len(link_prefix)
+            # check link to Wiki
+            if link_index >= 0 and lower.startswith(wiki_link, link_index):
+                index += len(src_key)
+                warnings.append("Link to wiki has been found in line {} and it won't be changed.".format(line_num))
+                continue
+            # check link to commit
+            if link_index >= 0 and lower.startswith(commit_link, link_index):
+                index += len(src_key)
+                warnings.append("Link to commit has been found in line {} and it won't be changed.".format(line_num))
+                # TODO: next element in path after 'blob' can be commit SHA or branch name or something else.
+                # we can analyze is it a branch name and if this branch in the list of moved branches then we can change the link.
+                continue
+            # we can use replace with count=1 but here we definetly know what should be done.
+            line = line[0:index] + dst_key + line[index + len(src_key):]
+            lower = lower[0:index] + dst_key + lower[index + len(src_key):]
+            patched = True
+            index += len(dst_key)
+        index = 0
+        while True:
+            index = lower.find(src, index)
+            if index == -1:
+                break
+            key_index = index - len(src_org) - 1
+            # exclude src_key as it was parsed previously
+            if key_index >= 0 and lower.startswith(src_key, key_index):
+                index += len(src)
+                continue
+            # skip src in *requirements.txt, ci_unittests.json
+            if skip_names:
+                index += len(src)
+                continue
+            # skip all occurences of pointing to sources - they still are placed in old structure
+            if index >= 4 and lower.startswith('src/', index - 4):
+                index += len(src)
+                continue
+            # all other treat as warnings for now
+            warnings.append("Name '{}' was found in line {} and it won't be changed. Line is:\n{}".format(src, line_num, line))
+            index += len(src)
+        new_lines.append(line)
+
+    return new_lines, patched, warnings
+
+
+def patch_file(path, rel_path, moves):
+    """Patches file in place if it has links to any src_key of moves - list of (src_key, dst_key).
+
+    File is read and written once for all moves. Returns (rel_path, patched, warnings, error),
+    where patched is list of src_keys which links were changed."""
+    names = tuple(src_key.split('/')[1] for src_key, _ in moves)
+    try:
+        data = read_text_if_matches(path, _get_pattern(names))
+    except UnicodeDecodeError:
+        return rel_path, [], [], "File {} has invalid characters that can not be decoded by utf-8".format(path)
+    if data is None:
+        return rel_path, [], [], None
+    lines = data.splitlines(keepends=True)
+    patched = list()
+    warnings = []
+    for src_key, dst_key in moves:
+        lines, changed, found = patch_lines(lines, rel_path, src_key, dst_key)
+        if changed:
+            patched.append(src_key)
+        warnings.extend(found)
+    if patched:
+        write_file_atomic(path, ''.join(lines))
+    return rel_path, patched, warnings, None
+
+
+def replace_in_file(path, replacements):
+    """Replaces all case sensitive occurrences of src to dst for each (src, dst) of replacements.
+
+    Returns list of replaced srcs (empty if file was not changed)."""
+    pattern = re.compile(b'|'.join(re.escape(src.encode()) for src, _ in replacements))
+    try:
+        data = read_text_if_matches(path, pattern)
+    except UnicodeDecodeError:
+        return []
+    if data is None:
+        return []
+    replaced = [src for src, _ in replacements if src in data]
+    for src, dst in replacements:
+        data = data.replace(src, dst)
+    write_file_atomic(path, data)
+    return replaced
+
+
+def _patch_file_task(args):
+    return patch_file(*args)
+
+
+def _replace_in_file_task(args):
+    return args[0], replace_in_file(*args)
+
+
+class ReferenceIndex():
+    """Persistent index of project names' occurrences in branches of one repo.
+
+    Index is stored as json file and keeps for each branch indexed commit SHA and
+    file -> token -> line numbers map. Index is updated incrementally from 'git diff'
+    between indexed commit and current head of branch. Content is read from git objects,
+    so working tree state doesn't matter.
+    """
+
+    def __init__(self, path, tokens):
+        self.path = path
+        self.lock = threading.Lock()
+        self.tokens = sorted(set(token.lower() for token in tokens))
+        self.branches = dict()
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as fh:
+                data = json.load(fh)
+        except ValueError:
+            log("Index {} is broken. It will be rebuilt".format(path), level='WARNING')
+            return
+        # tokens are changed with repos config - whole index must be rebuilt
+        if data.get('tokens') == self.tokens:
+            self.branches = data['branches']
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_file_atomic(self.path, json.dumps({'tokens': self.tokens, 'branches': self.branches}))
+
+    def update(self, repo_dir, branch):
+        """Brings index of branch to its head. Returns False if index is already actual."""
+        # branch may be not checked out yet - then remote one is indexed
+        head = None
+        for ref in ('refs/heads/' + branch, 'refs/remotes/origin/' + branch):
+            try:
+                head = _check_output(['git', 'rev-parse', '--verify', '-q', ref + '^{commit}'],
+                                     cwd=repo_dir).decode().strip()
+                break
+            except subprocess.CalledProcessError:
+                continue
+        if not head:
+            raise Exception("Branch {} could not be found in {}".format(branch, repo_dir))
+        entry = self.branches.get(branch)
+        if entry and entry['commit'] == head:
+            return False
+        changed = None
+        if entry:
+            try:
+                diff = _check_output(['git', 'diff', '--name-only', '--no-renames', '-z', entry['commit'], head],
+                                     cwd=repo_dir, stderr=subprocess.DEVNULL).decode()
+                changed = set(item for item in diff.split('\0') if item)
+            except subprocess.CalledProcessError:
+                # indexed commit is not present in this repo anymore
+                changed = None
+        files = dict(entry['files']) if changed is not None else dict()
+        blobs = dict()
+        for path, sha in self._ls_tree(repo_dir, head):
+            if changed is None or path in changed:
+                blobs[sha] = blobs.get(sha, list()) + [path]
+        for path in changed or list():
+            files.pop(path, None)
+        for sha, data in self._read_blobs(repo_dir, list(blobs)):
+            hits = self._scan(data)
+            if hits:
+                for path in blobs[sha]:
+                    files[path] = hits
+        self.branches[branch] = {'commit': head, 'files': files}
+        return True
+
+    def files(self, branch, token):
+        """Returns sorted list of files in indexed branch that have token."""
+        token = token.lower()
+        files = self.branches.get(branch, dict()).get('files', dict())
+        return sorted(path for path, hits in files.items() if token in hits)
+
+    def references(self, token):
+        """Returns branch -> file -> line numbers for token."""
+        token = token.lower()
+        result = dict()
+        for branch, entry in self.branches.items():
+            for path, hits in entry['files'].items():
+                if token in hits:
+                    result.setdefault(branch, dict())[path] = hits[token]
+        return result
+
+    def _ls_tree(self, repo_dir, commit):
+        output = _check_output(['git', 'ls-tree', '-r', '-z', commit], cwd=repo_dir).decode()
+        for item in output.split('\0'):
+            if not item:
+                continue
+            info, path = item.split('\t', 1)
+            mode, obj_type, sha = info.split()
+            # like 'find -type f' - skip symlinks and submodules
+            if obj_type != 'blob' or mode == '120000' or is_skipped_path(path):
+                continue
+            yield path, sha
+
+    def _read_blobs(self, repo_dir, shas):
+        proc = TracedPopen(['git', 'cat-file', '--batch'], cwd=repo_dir,
+                           stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def _feed():
+            for sha in shas:
+                proc.stdin.write(sha.encode() + b'\n')
+            proc.stdin.close()
+
+        feeder = threading.Thread(target=_feed, daemon=True)
+        feeder.start()
+        try:
+            for _ in shas:
+                sha, _, size = proc.stdout.readline().decode().split()
+                data = proc.stdout.read(int(size))
+                proc.stdout.read(1)
+                yield sha, data
+        finally:
+            feeder.join()
+            proc.stdout.close()
+            proc.wait()
+
+    def _scan(self, data):
+        if b'\0' in data[:BINARY_CHECK_SIZE]:
+            return None
+        text = data.decode(errors='replace').lower()
+        hits = dict()
+        for token in self.tokens:
+            index = text.find(token)
+            if index == -1:
+                continue
+            lines = list()
+            pos, line = 0, 1
+            while index != -1:
+                line += text.count('\n', pos, index)
+                pos = index
+                if not lines or lines[-1] != line:
+                    lines.append(line)
+                index = text.find(token, index + len(token))
+            hits[token] = lines
+        return hits
+
+
+class GitSession():
+    """Long-lived 'git cat-file --batch' process of one repo.
+
+    Commits are parsed once and cached by SHA, so questions about HEAD and its Change-Id
+    are answered by one round trip to running process or from cache. Search in history is
+    one 'git log' per HEAD and only its answer is cached.
+    """
+
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self.lock = threading.Lock()
+        self.proc = None
+        # sha -> (parents, message)
+        self.commits = dict()
+        # (head sha, subject part) -> bool
+        self.log_cache = dict()
+
+    def close(self):
+        if self.proc:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+    def head(self):
+        """Returns SHA of HEAD commit."""
+        with self.lock:
+            sha, _ = self._read_commit('HEAD')
+        return sha
+
+    def commit_details(self, rev='HEAD'):
+        """Returns SHA, Change-Id and message of commit."""
+        with self.lock:
+            sha, (_, message) = self._read_commit(rev)
+        change_id = None
+        for line in message.splitlines():
+            if line.startswith('Change-Id:'):
+                change_id = line.split(':')[1].strip()
+        return sha, change_id, message
+
+    def log_contains(self, subject):
+        """Returns True if some commit reachable from HEAD has subject in its first line."""
+        with self.lock:
+            head, _ = self._read_commit('HEAD')
+            key = (head, subject)
+            if key not in self.log_cache:
+                self.log_cache[key] = self._find_in_log(head, subject)
+            return self.log_cache[key]
+
+    def is_dirty(self):
+        """Returns True if tracked files in working tree differ from index."""
+        return _call(['git', 'diff', '--quiet'], cwd=self.repo_dir,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) != 0
+
+    def _find_in_log(self, head, subject):
+        # one 'git log' walks history in git itself. --grep matches whole message - subject is checked here
+        output = _check_output(['git', 'log', '-F', '--grep=' + subject, '--format=%s', head],
+                               cwd=self.repo_dir, stderr=subprocess.DEVNULL)
+        return any(subject in line for line in output.decode(errors='replace').splitlines())
+
+    def _read_commit(self, rev):
+        if rev in self.commits:
+            return rev, self.commits[rev]
+        if not self.proc or self.proc.poll() is not None:
+            self.proc = TracedPopen(['git', 'cat-file', '--batch'], cwd=self.repo_dir,
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.proc.stdin.write(rev.encode() + b'\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().decode().split()
+        if len(header) != 3:
+            # '<rev> missing'
+            return None, None
+        sha, obj_type, size = header
+        data = self.proc.stdout.read(int(size)).decode(errors='replace')
+        self.proc.stdout.read(1)
+        if obj_type != 'commit':
+            return None, None
+        headers, _, message = data.partition('\n\n')
+        parents = [line.split()[1] for line in headers.splitlines() if line.startswith('parent ')]
+        self.commits[sha] = (parents, message)
+        return sha, self.commits[sha]
+
+
+class Plan():
+    """DAG of (step, project, branch) nodes of one operation with checkpointed state.
+
+    Nodes are executed in parallel as soon as all their dependencies are done. Result and
+    duration of each finished node are written to state file right after the node, so
+    interrupted run continues from unfinished nodes. Durations are used as cost estimation
+    of the same nodes for next runs.
+    """
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.nodes = dict()
+        self.lock = threading.Lock()
+        self.state = dict()
+        if os.path.exists(state_path):
+            with open(state_path) as fh:
+                self.state = json.load(fh)
+
+    def add(self, step, project, branch, method, deps=None):
+        node_id = '{}:{}:{}'.format(step, project, branch)
+        self.nodes[node_id] = {'step': step, 'project': project, 'branch': branch,
+                               'method': method, 'deps': list(deps or list())}
+        return node_id
+
+    def is_done(self, node_id):
+        return self.state.get(node_id, dict()).get('done', False)
+
+    def result(self, node_id):
+        return self.state.get(node_id, dict()).get('result')
+
+    def estimate(self, node_id):
+        if node_id in self.state:
+            return self.state[node_id].get('duration', 0)
+        return PLAN_STEP_COSTS.get(self.nodes[node_id]['step'], PLAN_STEP_COSTS['default'])
+
+    def show(self, jobs):
+        """Prints nodes in execution order and estimated cost of remaining ones."""
+        finish = dict()
+        total = 0
+        for node_id in self._ordered():
+            node = self.nodes[node_id]
+            cost = 0 if self.is_done(node_id) else self.estimate(node_id)
+            total += cost
+            finish[node_id] = max([finish[dep] for dep in node['deps']] or [0]) + cost
+            log("{:<6} {} ~{:.0f}s{}".format(
+                'done' if self.is_done(node_id) else 'todo', node_id, cost,
+                ''.join('\n           <- {}'.format(dep) for dep in node['deps'])))
+        critical = max(finish.values() or [0])
+        log("Nodes: {}, remaining: {}".format(len(self.nodes), len([n for n in self.nodes if not self.is_done(n)])))
+        log("Estimated cost: {:.0f}s serial, ~{:.0f}s with {} jobs".format(total, max(critical, total / max(1, jobs)), jobs))
+
+    def run(self, jobs):
+        """Executes all not done nodes. Returns list of failed and skipped nodes."""
+        failed = list()
+        running = dict()
+        pending = [node_id for node_id in self._ordered() if not self.is_done(node_id)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            while pending or running:
+                for node_id in list(pending):
+                    deps = self.nodes[node_id]['deps']
+                    if any(dep in failed for dep in deps):
+                        # dependency is failed - node will not be executed
+                        pending.remove(node_id)
+                        failed.append(node_id)
+                    elif all(self.is_done(dep) for dep in deps):
+                        pending.remove(node_id)
+                        running[executor.submit(self._run_node, node_id)] = node_id
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    node_id = running.pop(future)
+                    try:
+                        future.result()
+                    except (Exception, SystemExit) as e:
+                        failed.append(node_id)
+                        log("{}: {}".format(node_id, e), level='ERROR')
+        return failed
+
+    def _run_node(self, node_id):
+        node = self.nodes[node_id]
+        started = time.monotonic()
+        with tracer.span(node['step'], 'step', project=node['project'], branch=node['branch']):
+            result = node['method']()
+        with self.lock:
+            self.state[node_id] = {'done': True, 'result': result, 'duration': round(time.monotonic() - started, 3)}
+            write_file_atomic(self.state_path, json.dumps(self.state, indent=2, sort_keys=True))
+        log("Done {}".format(node_id))
+
+    def _ordered(self):
+        # topological order which keeps order of adding
+        result = list()
+        visited = set()
+
+        def _visit(node_id):
+            if node_id in visited:
+                return
+            visited.add(node_id)
+            for dep in self.nodes[node_id]['deps']:
+                _visit(dep)
+            result.append(node_id)
+
+        for node_id in self.nodes:
+            _visit(node_id)
+        return result
+
+
+class RateLimiter():
+    """Token bucket which allows 'rate' calls per second with bursts up to 'burst' calls."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class GerritClient():
+    """Gerrit ssh commands over pool of multiplexed ssh connections.
+
+    Each connection is OpenSSH ControlMaster that lives for SSH_CONTROL_PERSIST after last
+    command, so commands (and next runs of the tool) don't pay handshake cost. Commands are
+    spread over several masters to run them concurrently.
+    """
+
+    def __init__(self, user, host=GERRIT_URL, port=GERRIT_PORT, connections=SSH_CONNECTIONS):
+        self.user = user
+        self.host = host
+        self.port = port
+        self.connections = max(1, connections)
+        # unix socket path is limited by ~100 chars, so it's kept short
+        self.control_dir = os.path.join(tempfile.gettempdir(), 'tf-migrate-ssh-{}'.format(os.getuid()))
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.slots = threading.BoundedSemaphore(self.connections * SSH_SESSIONS_PER_CONNECTION)
+
+    def cmd(self, params):
+        """Executes 'gerrit <params>' and returns its output."""
+        with self.lock:
+            connection = self.counter % self.connections
+            self.counter += 1
+        ssh_cmd = ['ssh', '-p', self.port,
+                   '-o', 'ControlMaster=auto',
+                   '-o', 'ControlPersist={}'.format(SSH_CONTROL_PERSIST),
+                   '-o', 'ControlPath={}/%C-{}'.format(self.control_dir, connection),
+                   'ssh://{}@{}'.format(self.user, self.host), 'gerrit']
+        with self.slots, tracer.span('gerrit ' + params[0], 'gerrit', connection=connection):
+            return _check_output(ssh_cmd + list(params), stdin=subprocess.DEVNULL).decode()
+
+    def run_many(self, commands):
+        """Executes commands concurrently. Returns list of outputs or exceptions in the same order."""
+        def _run(params):
+            try:
+                return self.cmd(params)
+            except Exception as e:
+                return e
+
+        if not commands:
+            return list()
+        workers = min(len(commands), self.connections * SSH_SESSIONS_PER_CONNECTION)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_run, commands))
+
+    def query(self, query, options=None):
+        """Returns list of changes for query. Stats line is dropped."""
+        params = ['query', '--format', 'JSON'] + (options or list()) + [query]
+        result = list()
+        for line in self.cmd(params).splitlines():
+            data = json.loads(line)
+            if data.get('type') == 'stats':
+                continue
+            result.append(data)
+        return result
+
+    def review(self, revision, message=None, approved=None):
+        params = ['review']
+        if message:
+            params.extend(['--message', '"{}"'.format(message)])
+        if approved is not None:
+            params.extend(['--approved', str(approved)])
+        params.append(revision)
+        return self.cmd(params)
+
+    def set_reviewers(self, revision, remove=None):
+        return self.cmd(['set-reviewers', revision, '--remove', remove])
+
+
+class ReposConfig():
+    """Parsed repos config with lookups of projects by src key, by dst key and by name."""
+
+    def __init__(self, data, path=None, mtime=None):
+        self.path = path
+        self.mtime = mtime
+        self.default_branches = data['default_branches']
+        self.waves = data.get('waves') or dict()
+        # src_key -> project
+        self.projects = dict()
+        # dst_key -> moved project
+        self.by_dst = dict()
+        # name (src or dst) -> list of projects
+        self.by_name = dict()
+        for item in data['projects']:
+            src_key = '{}/{}'.format(item.get('src_org', SRC_ORGANIZATION), item['src'])
+            dst = item.get('dst', None)
+            project = {
+                "src": item['src'],
+                "src_key": src_key,
+                "dst": dst,
+                "dst_key": '{}/{}'.format(item['dst_org'], item['dst']) if dst else None,
+                "branches": item.get('branches', self.default_branches),
+                "excludes": item.get('excludes')
+            }
+            self.projects[src_key] = project
+            self.by_name.setdefault(project['src'], list()).append(project)
+            if dst:
+                self.by_dst[project['dst_key']] = project
+                self.by_name.setdefault(dst, list()).append(project)
+        # all names which are tracked by reference index
+        self.names = sorted(self.by_name)
+
+    def get(self, key):
+        """Returns project by src key or moved project by its dst key."""
+        return self.projects.get(key) or self.by_dst.get(key)
+
+    def find(self, name):
+        """Returns projects with src or dst name."""
+        return self.by_name.get(name, list())
+
+
+_repos_configs = dict()
+_repos_configs_lock = threading.Lock()
+
+
+def load_repos_config(path):
+    """Returns ReposConfig of file. Parsed config is cached until mtime of file is changed."""
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    with _repos_configs_lock:
+        config = _repos_configs.get(path)
+        if config and config.mtime == mtime:
+            return config
+        log("Reading project's config from {}".format(path))
+        with open(path) as fh:
+            # C loader of libyaml is much faster than pure python one
+            data = yaml.load(fh, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+        config = ReposConfig(data, path=path, mtime=mtime)
+        _repos_configs[path] = config
+        return config
+
+
+class MigrationConfig():
+    """Settings of Migration. Command line arguments are parsed into it, library users create it directly.
+
+    Relative paths are resolved from base_dir (script's dir by default).
+    """
+
+    def __init__(self, repos_config='./repos-config.yaml', workspace='./workspace', user=None, force=False,
+                 jobs=DEFAULT_JOBS, mirrors=None, no_mirrors=False, ssh_connections=SSH_CONNECTIONS,
+                 gerrit_rate=GERRIT_RATE, plan=False, profile=False, trace=None, base_dir=None):
+        self.repos_config = repos_config
+        self.workspace = workspace
+        self.user = user
+        self.force = force
+        self.jobs = jobs
+        self.mirrors = mirrors
+        self.no_mirrors = no_mirrors
+        self.ssh_connections = ssh_connections
+        self.gerrit_rate = gerrit_rate
+        self.plan = plan
+        self.profile = profile
+        self.trace = trace
+        self.base_dir = base_dir or os.path.dirname(os.path.abspath(__file__))
+
+
+class Migration():
+    """Migration of projects from Juniper's organization.
+
+    Object can execute many operations for different projects. Worker pools, gerrit connections
+    and parsed repos config are shared between them. Use close() or 'with' to release pools.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.path = config.base_dir
+        self.executor = None
+        self.tasks = list()
+        self.scan_pool = None
+        # (work dir, project) -> index. clones of project in different workspaces are at different commits
+        self.indexes = dict()
+        self.git_sessions = dict()
+        self.gerrit = None
+        # change id -> current patch set (None if change is absent) for current operation
+        self.changes = dict()
+        self.rate_limiter = None
+        # guards lazy creation of shared objects and worktrees from parallel tasks
+        self.lock = threading.Lock()
+        self.mirrors_dir = None
+        if not config.no_mirrors:
+            self.mirrors_dir = os.path.normpath(os.path.join(
+                self.path, config.mirrors or os.path.join(config.workspace, MIRRORS_DIR)))
+        self.repos = None
+        self.projects = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+        if self.scan_pool:
+            self.scan_pool.shutdown()
+            self.scan_pool = None
+
+    @classmethod
+    def operations(cls):
+        return sorted(name[4:] for name in dir(cls) if name.startswith('_op_') and callable(getattr(cls, name)))
+
+    def _select(self, sources, wave):
+        """Sets projects of operation: moved src keys, their destinations, name and workspace dir."""
+        repos = load_repos_config(os.path.join(self.path, self.config.repos_config))
+        if repos is not self.repos:
+            # tokens of indexes depend on projects in config
+            self.repos = repos
+            self.projects = repos.projects
+            self.indexes = dict()
+        names = list()
+        if wave:
+            if wave not in repos.waves:
+                log("Wave {} could not be found in repos config".format(wave))
+                raise SystemExit()
+            names.extend(repos.waves[wave])
+        names.extend(name for name in sources or list() if name not in names)
+        if not names:
+            log("Source project(s) or wave must be set. Please see help for the tool.", level='ERROR')
+            raise SystemExit()
         # moving project always use 'Juniper' as organization
-        self.src_key = '{}/{}'.format(SRC_ORGANIZATION, self.args.src)
-        if self.src_key not in self.projects:
-            log("Project {} could not be found in repos config".format(self.args.src))
+        self.src_keys = ['{}/{}'.format(SRC_ORGANIZATION, name) for name in names]
+        for src_key in self.src_keys:
+            if src_key not in self.projects or not self.projects[src_key]['dst_key']:
+                log("Project {} could not be found in repos config or it doesn't have destination".format(src_key))
+                raise SystemExit()
+        # (src_key, dst_key) of all moved projects. dependent projects are patched for all of them at once.
+        self.moves = [(src_key, self.projects[src_key]['dst_key']) for src_key in self.src_keys]
+        self.dst_keys = [dst_key for _, dst_key in self.moves]
+        # name of migration is used for workspace dir, commits' tag and reviews' topic
+        self.name = wave or '+'.join(names)
+        self.commit_msg_tag = "[{}/{}]".format(COMMIT_MESSAGE_TAG, self.src_keys[0] if len(names) == 1 else self.name)
+        self.work_dir = os.path.normpath(os.path.join(self.path, self.config.workspace, self.name))
+        os.makedirs(self.work_dir, exist_ok=True)
+
+    def execute(self, operation, sources=None, wave=None):
+        """Executes operation for source projects (names in Juniper's organization) and/or wave of repos config."""
+        if operation not in self.operations():
+            log("Unknown operation {}".format(operation), level='ERROR')
             raise SystemExit()
-        project = self.projects[self.src_key]
-        self.dst_key = project['dst_key']
-
-        self.work_dir = os.path.normpath(os.path.join(self.path, self.args.workspace, self.args.src))
-        if not os.path.exists(self.work_dir):
-            os.makedirs(self.work_dir, exist_ok=True)
-
-    def _parse_args(self):
-        parser = argparse.ArgumentParser()
-        parser.add_argument('--repos-config', default="./repos-config.yaml", help='Path to file with repos config')
-        parser.add_argument('--workspace', default="./workspace", help="path to workspace where cloned repos will be placed")
-        parser.add_argument('--user', help="user for git ssh access")
-        parser.add_argument('--force', help="Force operation if it's possible", action='store_true', default=False)
-        # TODO: add creds for opencontrail's gerrit
-        parser.add_argument('operation', choices=self.valid_operations, help="Operation to execute.")
-        parser.add_argument('src', help="Source project from Juniper's organization")
-        self.args = parser.parse_args()
-
-    def _load_repos_config(self):
-        config = os.path.normpath(os.path.join(self.path, self.args.repos_config))
-        log("Reading project's config from {}".format(config))
-        with open(config) as fh:
-            data = yaml.load(fh, Loader=yaml.FullLoader)
-            default_branches = data['default_branches']
-            for project in data['projects']:
-                src_org = project.get('src_org', SRC_ORGANIZATION)
-                src_key = '{}/{}'.format(src_org, project['src'])
-                dst = project.get('dst', None)
-                self.projects[src_key] = {
-                    "src": project['src'],
-                    "src_key": src_key,
-                    "dst": dst,
-                    "dst_key": '{}/{}'.format(project['dst_org'], project['dst']) if dst else None,
-                    "branches": project.get('branches', default_branches),
-                    "excludes": project.get('excludes')
-                }
-
-    def execute(self):
-        log("Execute operation {} on project {}".format(self.args.operation, self.args.src))
-        log("   New place is {}".format(self.projects[self.src_key]['dst_key']))
+        self.operation = operation
+        self._select(sources, wave)
+        self.changes = dict()
+        log("Execute operation {} on {}".format(operation, self.name))
+        for src_key, dst_key in self.moves:
+            log("   New place of {} is {}".format(src_key, dst_key))
+        if self.config.profile or self.config.trace:
+            tracer.enable()
         # call operation
-        op = getattr(self, '_op_' + self.args.operation)
-        op()
+        op = getattr(self, '_op_' + operation)
+        try:
+            with tracer.span(operation, 'operation', migration=self.name):
+                op()
+        finally:
+            for session in self.git_sessions.values():
+                session.close()
+            self.git_sessions = dict()
+            if tracer.enabled:
+                self._save_profile()
+                tracer.disable()
 
     # Operations section
 
@@ -125,124 +1159,132 @@ class Migration():
         log("Clean everything in {}".format(self.work_dir))
         # remove ${workspace}/${src}/
         shutil.rmtree(self.work_dir)
+        # indexes of this workspace are removed with it
+        self.indexes = dict((key, index) for key, index in self.indexes.items() if key[0] != self.work_dir)
         # TODO: think about abandoned reviews
 
     def _op_clone(self):
         def _clone(pkey, clone_dir=None):
             if self._is_git_repo_present(pkey, clone_dir=clone_dir):
-                log("Update project {}".format(pkey))
                 self._git_pull(pkey, clone_dir=clone_dir)
-            else:
-                log("Clone project {}".format(pkey))
-                self._run_task(self._git_clone, pkey, clone_dir=clone_dir)
+                return "Updated"
+            self._git_clone(pkey, clone_dir=clone_dir)
+            return "Cloned"
 
-        if not self.args.user:
+        if not self.config.user:
             log("user must be set for this operation. Please see help for the tool.", level="ERROR")
             raise SystemExit()
+        if self.mirrors_dir:
+            # refresh shared mirrors once per run, workspaces are cloned/updated from them
+            log("Update mirrors in {}".format(self.mirrors_dir))
+            for pkey in list(self.projects) + self.dst_keys:
+                self._run_task(pkey, self._update_mirror, pkey)
+            self._run_task('commit-msg hook', self._git_add_commit_hook, self.mirrors_dir)
+            errors = self._wait_tasks()
+            if errors:
+                log("Mirror update failed for {}: {}".format(len(errors), ', '.join(errors)), level='ERROR')
+                raise SystemExit()
         for pkey in self.projects:
-            _clone(pkey)
+            self._run_task(pkey, _clone, pkey)
             # clone controller one more time to separate directory to create test review
             if self.projects[pkey]['src'] in ('contrail-controller', 'tf-controller'):
-                _clone(pkey, clone_dir=TEST_DIR)
-        # destination project must be pre-created for now in gerrit/github
-        _clone(self.dst_key, clone_dir=self.dst_key)
+                self._run_task('{} ({})'.format(pkey, TEST_DIR), _clone, pkey, clone_dir=TEST_DIR)
+        # destination projects must be pre-created for now in gerrit/github
+        for dst_key in self.dst_keys:
+            self._run_task(dst_key, _clone, dst_key, clone_dir=dst_key)
+        errors = self._wait_tasks()
+        if errors:
+            log("Clone failed for {} project(s): {}".format(len(errors), ', '.join(errors)), level='ERROR')
+            raise SystemExit()
+        # branches are reset to remote state - nothing is committed or pushed anymore
+        for operation in ('commit', 'review'):
+            self._reset_state(operation)
 
     def _op_commit(self):
-        if not self.args.user:
-            log("user must be set for this operation. Please see help for the tool.", level="ERROR")
-            raise SystemExit()
-        project = self.projects[self.src_key]
-
-        # put destination project into separate directory to avoid naming conflict
-        excluded_names = ['.git', '.gitreview']
-        src_dir = os.path.join(self.work_dir, project['src'])
-        dst_dir = os.path.join(self.work_dir, project['dst_key'])
-        # moved project branch -> change id
-        moved_ids = dict()
-        # copy src to dest, commit push to review, get Commit-Id
-        for branch in project['branches']:
-            log("Copying src to dst for branch {}".format(branch))
-            self._git_checkout(branch, src_dir)
+        def _commit_moved(src_key, branch):
+            project = self.projects[src_key]
+            log("Copying {} to {} for branch {}".format(src_key, project['dst_key'], branch))
+            src_dir = self._get_worktree(os.path.join(self.work_dir, project['src']), branch)
             # NOTE: branch must be pre-created in destination
+            dst_dir = self._get_worktree(os.path.join(self.work_dir, project['dst_key']), branch)
             self._git_reset(dst_dir)
-            self._git_checkout(branch, dst_dir)
 
             if self._git_log_grep(dst_dir, PATCH_COMMIT_MESSAGE):
-                log("Branch {} has been already patched".format(branch))
+                log("Branch {} of {} has been already patched".format(branch, project['dst_key']))
             else:
-                # remove all in dest dir except .git
-                self._clean_dir(dst_dir, excluded_names)
-                # copy
-                log("Copying destination")
-                self._copy_dir(src_dir, dst_dir, excluded_names)
-                # commit just copied dir
-                try:
+                # make dest tree equal to src one except own .gitreview and commit it
+                log("Copying destination for branch {}".format(branch))
+                if self._git_sync_tree(src_dir, dst_dir, kept_names):
                     self._git_commit(dst_dir, COPY_COMMIT_MESSAGE)
-                except Exception:
-                    log("Content is in place. skipping...")
-                    pass
+                else:
+                    log("Content is in place for branch {}. skipping...".format(branch))
                 # we don't fix src_name to dst_name cause it requires more intelligent work
-                log("Patching destination")
-                self._patch_dir(dst_dir, self.src_key, self.dst_key, excludes=project.get('excludes'))
+                # links to other projects of this migration are changed too
+                log("Patching destination for branch {}".format(branch))
+                self._patch_dir(dst_dir, self.moves, excludes=project.get('excludes'))
                 if self._git_diff_stat(dst_dir):
                     self._git_commit(dst_dir, PATCH_COMMIT_MESSAGE)
                 else:
-                    log("Patch is empty. skipping...")
+                    log("Patch is empty for branch {}. skipping...".format(branch))
             _, change_id = self._git_get_last_commit_details(dst_dir, check_msg_tag=COMMIT_MESSAGE_TAG.splitlines()[0])
-            moved_ids[branch] = change_id
+            return change_id
 
-        # find links to src in all projects, change them, commit with Depends-On, push to review
-        commit_msg_tag = "[{}/{}]".format(COMMIT_MESSAGE_TAG, self.src_key)
-        changed_ids = dict()
-        controller_project = None
-        for pkey in self.projects:
-            if self.projects[pkey]['src'] in ('contrail-controller', 'tf-controller'):
-                controller_project = self.projects[pkey]
-            if pkey == self.src_key:
-                # do not patch source
-                continue
-            dst_dir = os.path.join(self.work_dir, self.projects[pkey]['src'])
-            for branch in self.projects[pkey]['branches']:
-                log("Patching project {} / branch {}".format(pkey, branch))
-                self._git_reset(dst_dir)
-                self._git_checkout(branch, dst_dir)
-
-                # specific patches first to prevent these findings in common patch
-                if self.projects[pkey]['src'] in ('contrail-vnc', 'tf-vnc'):
-                    # *-vnc has specific file with name only
-                    # this repo containes special XML file with folder's structure
-                    # this structure has just name without organization that must be changed
-                    # and for this line remote attribute also must be changed
-                    self._patch_dir_no_check(
-                        dst_dir,
-                        'name="{}" remote="github"'.format(project['src']),
-                        'name="{}" remote="githubtf"'.format(project['dst']))
-                # common patch
-                self._patch_dir(dst_dir, self.src_key, self.dst_key, excludes=self.projects[pkey].get('excludes'))
-
-                # check and commit
-                change_id = None
-                if self._git_diff_stat(dst_dir):
-                    log("    Committing...")
-                    depends_on = moved_ids.get(branch, moved_ids.get('master', list(moved_ids.values())[0]))
-                    msg = ("{} Change links from to {}\n\nAutomated change\nDepends-On: {}\n"
-                           "".format(commit_msg_tag, self.dst_key, depends_on))
-                    self._git_commit(dst_dir, msg)
-                    _, change_id = self._git_get_last_commit_details(dst_dir)
-                elif self._git_log_grep(dst_dir, commit_msg_tag):
-                    log("    Patch is in place. Skipping...")
-                    _, change_id = self._git_get_last_commit_details(dst_dir, check_msg_tag=commit_msg_tag)
-                else:
-                    log("    Patch is empty. Skipping...")
-                if change_id:
-                    changed_ids.setdefault(pkey, dict())[branch] = change_id
+        def _commit_dependent(pkey, branch):
+            log("Patching project {} / branch {}".format(pkey, branch))
+            dst_dir = self._get_worktree(os.path.join(self.work_dir, self.projects[pkey]['src']), branch)
+            self._git_reset(dst_dir)
+            # moved projects which links are changed in this branch (not just mentioned)
+            patched = set()
+
+            # specific patches first to prevent these findings in common patch
+            if self.projects[pkey]['src'] in ('contrail-vnc', 'tf-vnc'):
+                # *-vnc has specific file with name only
+                # this repo containes special XML file with folder's structure
+                # this structure has just name without organization that must be changed
+                # and for this line remote attribute also must be changed
+                replacements = [('name="{}" remote="github"'.format(self.projects[src_key]['src']),
+                                 'name="{}" remote="githubtf"'.format(self.projects[src_key]['dst']))
+                                for src_key in self.src_keys]
+                replaced = self._patch_dir_no_check(dst_dir, replacements)
+                patched.update(src_key for src_key, (src, _) in zip(self.src_keys, replacements) if src in replaced)
+            # common patch. only files where index has src names can be changed.
+            # links to all moved projects are changed by one pass over these files.
+            index = self._update_index(pkey, dst_dir, branches=[branch])
+            files = set()
+            for src_key in self.src_keys:
+                files.update(index.files(branch, self.projects[src_key]['src']))
+            if files:
+                patched.update(self._patch_dir(dst_dir, self.moves, excludes=self.projects[pkey].get('excludes'),
+                                               files=sorted(files)))
+
+            # check and commit
+            change_id = None
+            if self._git_diff_stat(dst_dir):
+                log("    Committing {} / {}...".format(pkey, branch))
+                depends_on = [plan.result(moved_node(src_key, branch)) for src_key in self.src_keys
+                              if src_key in patched]
+                msg = ("{} Change links from to {}\n\nAutomated change\n{}"
+                       "".format(self.commit_msg_tag, ', '.join(self.dst_keys),
+                                 ''.join('Depends-On: {}\n'.format(dep) for dep in depends_on)))
+                self._git_commit(dst_dir, msg)
+                _, change_id = self._git_get_last_commit_details(dst_dir)
+            elif self._git_log_grep(dst_dir, self.commit_msg_tag):
+                log("    Patch is in place for {} / {}. Skipping...".format(pkey, branch))
+                _, change_id = self._git_get_last_commit_details(dst_dir, check_msg_tag=self.commit_msg_tag)
+            else:
+                log("    Patch is empty for {} / {}. Skipping...".format(pkey, branch))
+            return change_id
 
-        # create commit with removed content and new readme
-        for branch in self.projects[self.src_key]['branches']:
-            log("Removing content for project {} / branch {}".format(self.src_key, branch))
-            dst_dir = os.path.join(self.work_dir, self.projects[self.src_key]['src'])
+        def _commit_removal(src_key, branch):
+            project = self.projects[src_key]
+            log("Removing content for project {} / branch {}".format(src_key, branch))
+            dst_dir = self._get_worktree(os.path.join(self.work_dir, project['src']), branch)
             log("  dst_dir = {}".format(dst_dir))
             # get list of deps
+            changed_ids = dict()
+            for (pkey, dep_branch), node_id in dependent_nodes.items():
+                if plan.result(node_id):
+                    changed_ids.setdefault(pkey, dict())[dep_branch] = plan.result(node_id)
             depends = list()
             for cid in changed_ids:
                 if branch in changed_ids[cid]:
@@ -253,13 +1295,11 @@ class Migration():
                     depends.append(changed_ids[cid]['master'])
                 else:
                     # - master/R1909 not in [ocata, queens, ...] then take latest by alphabet order
-                    branches = changed_ids[cid].keys()
-                    branches.sort()
+                    branches = sorted(changed_ids[cid].keys())
                     depends.append(changed_ids[cid][branches[-1]])
             depends.sort()
             # prepare commit
             self._git_reset(dst_dir)
-            self._git_checkout(branch, dst_dir)
             # save .gitreview
             path = os.path.join(dst_dir, ".gitreview")
             with open(path) as fh:
@@ -269,10 +1309,10 @@ class Migration():
             # add README.md
             path = os.path.join(dst_dir, "README.md")
             with open(path, 'w') as fh:
-                fh.write(README_MIGRATED.format(self.dst_key))
+                fh.write(README_MIGRATED.format(project['dst_key']))
             # build commit message
             msg = ("{} Remove content and add readme about migration.\n\nAutomated change\n\n"
-                   "".format(commit_msg_tag))
+                   "".format(self.commit_msg_tag))
             for dep in depends:
                 msg += "Depends-On: {}\n".format(dep)
             self._git_commit(dst_dir, msg)
@@ -281,32 +1321,92 @@ class Migration():
             with open(path, 'w') as fh:
                 fh.write(gitreview_data)
             _, final_change_id = self._git_get_last_commit_details(dst_dir, check_msg_tag=msg.splitlines()[0])
+            return final_change_id
 
-        # create fake commit for *-controller
-        dst_dir = os.path.join(self.work_dir, TEST_DIR)
-        for branch in controller_project['branches']:
+        def _commit_test(branch):
             log("Creating test commit for tf-controller / branch {}".format(branch))
+            dst_dir = self._get_worktree(os.path.join(self.work_dir, TEST_DIR), branch)
             self._git_reset(dst_dir)
-            self._git_checkout(branch, dst_dir)
             self._create_file(dst_dir, 'test', 'do not merge')
-            msg = ("{} Test review {}\n\nAutomated change\n\nDepends-On: {}\n"
-                   "".format(commit_msg_tag, self.dst_key, final_change_id))
-            if self._git_log_grep(dst_dir, commit_msg_tag):
+            msg = ("{} Test review {}\n\nAutomated change\n\n{}"
+                   "".format(self.commit_msg_tag, ', '.join(self.dst_keys),
+                             ''.join('Depends-On: {}\n'.format(plan.result(node)) for node in final_nodes)))
+            if self._git_log_grep(dst_dir, self.commit_msg_tag):
                 self._git_commit_amend(dst_dir, msg)
             else:
                 self._git_commit(dst_dir, msg)
 
+        if not self.config.user:
+            log("user must be set for this operation. Please see help for the tool.", level="ERROR")
+            raise SystemExit()
+        # destination project keeps own .gitreview
+        kept_names = ['.gitreview']
+        controller_project = None
+        for pkey in self.projects:
+            if self.projects[pkey]['src'] in ('contrail-controller', 'tf-controller'):
+                controller_project = self.projects[pkey]
+
+        # each (project, branch) has own worktree, so nodes of plan are executed in parallel
+        # as soon as change ids they depend on are known.
+        plan = Plan(os.path.join(self.work_dir, STATE_FILE.format('commit')))
+        # copy src to dest, commit push to review, get Commit-Id
+        moved_nodes = dict()
+        for src_key in self.src_keys:
+            for branch in self.projects[src_key]['branches']:
+                moved_nodes.setdefault(src_key, dict())[branch] = plan.add(
+                    'copy', self.projects[src_key]['dst_key'], branch, functools.partial(_commit_moved, src_key, branch))
+
+        def moved_node(src_key, branch):
+            nodes = moved_nodes[src_key]
+            return nodes.get(branch, nodes.get('master', list(nodes.values())[0]))
+
+        # find links to all moved projects in rest of projects, change them by one commit with
+        # Depends-On for each referenced moved project, push to review
+        dependent_nodes = dict()
+        for pkey in self.projects:
+            if pkey in self.src_keys:
+                # do not patch sources
+                continue
+            for branch in self.projects[pkey]['branches']:
+                dependent_nodes[(pkey, branch)] = plan.add(
+                    'patch', pkey, branch, functools.partial(_commit_dependent, pkey, branch),
+                    deps=[moved_node(src_key, branch) for src_key in self.src_keys])
+
+        # create commit with removed content and new readme
+        final_nodes = list()
+        for src_key in self.src_keys:
+            removal_nodes = list()
+            for branch in self.projects[src_key]['branches']:
+                removal_nodes.append(plan.add('remove', src_key, branch, functools.partial(_commit_removal, src_key, branch),
+                                              deps=dependent_nodes.values()))
+            final_nodes.append(removal_nodes[-1])
+
+        # create fake commit for *-controller
+        for branch in controller_project['branches']:
+            plan.add('test', TEST_DIR, branch, functools.partial(_commit_test, branch), deps=final_nodes)
+
+        self._execute_plan(plan, invalidates=['review'])
+
     def _op_review(self):
-        if not self.args.user:
+        if not self.config.user:
             log("user must be set for this operation. Please see help for the tool.", level="ERROR")
             raise SystemExit()
-        # moved project
-        project = self.projects[self.src_key]
-        dst_dir = os.path.join(self.work_dir, project['dst_key'])
-        for branch in project['branches']:
-            log("Push to review moved project {} / branch {}".format(self.src_key, branch))
-            self._git_checkout(branch, dst_dir)
-            self._git_review(dst_dir)
+
+        def _push(dst_dir):
+            return self._git_review(dst_dir)
+
+        def _push_test(dst_dir):
+            change_id = self._git_review(dst_dir)
+            self._gerrit_post_comment(change_id, 'check experimental')
+            return change_id
+
+        # moved projects
+        dst_dirs = list()
+        for src_key in self.src_keys:
+            project = self.projects[src_key]
+            for branch in project['branches']:
+                dst_dir = self._get_worktree(os.path.join(self.work_dir, project['dst_key']), branch)
+                dst_dirs.append((project['dst_key'], branch, dst_dir))
 
         # dependent projects
         controller_project = None
@@ -314,82 +1414,150 @@ class Migration():
             if self.projects[pkey]['src'] in ('contrail-controller', 'tf-controller'):
                 # save *-controller project info for next step
                 controller_project = self.projects[pkey]
-            dst_dir = os.path.join(self.work_dir, self.projects[pkey]['src'])
             for branch in self.projects[pkey]['branches']:
-                self._git_checkout(branch, dst_dir)
-                if self._git_log_grep(dst_dir, "[{}/{}]".format(COMMIT_MESSAGE_TAG, self.src_key)):
-                    log("Push to review project {} / branch {}".format(pkey, branch))
-                    self._git_review(dst_dir)
+                dst_dir = self._get_worktree(os.path.join(self.work_dir, self.projects[pkey]['src']), branch)
+                if self._git_log_grep(dst_dir, self.commit_msg_tag):
+                    dst_dirs.append((pkey, branch, dst_dir))
+
+        plan = Plan(os.path.join(self.work_dir, STATE_FILE.format('review')))
+        push_nodes = [plan.add('push', pkey, branch, functools.partial(_push, dst_dir))
+                      for pkey, branch, dst_dir in dst_dirs]
 
         # test review
         # this code creates test review in *-controller project
         # to run all tests and to ensure that all changes are in place,
         # CI takes all these changes and passes successfully.
         # at merge stage this review will be abandoned
-        dst_dir = os.path.join(self.work_dir, TEST_DIR)
         for branch in controller_project['branches']:
-            self._git_checkout(branch, dst_dir)
-            log("Push test to review for branch {}".format(branch))
-            change_id = self._git_review(dst_dir)
-            self._gerrit_post_comment(change_id, 'check experimental')
+            dst_dir = self._get_worktree(os.path.join(self.work_dir, TEST_DIR), branch)
+            plan.add('push', TEST_DIR, branch, functools.partial(_push_test, dst_dir), deps=push_nodes)
+
+        if not self.config.plan:
+            # state of all changes is requested at once
+            self._gerrit_prefetch([self._git_get_last_commit_details(dst_dir)[1] for _, _, dst_dir in dst_dirs])
+        self._execute_plan(plan)
 
     def _op_merge(self):
-        if not self.args.user:
+        if not self.config.user:
             log("user must be set for this operation. Please see help for the tool.", level="ERROR")
             raise SystemExit()
-        project = self.projects[self.src_key]
-        dst_dir = os.path.join(self.work_dir, project['dst_key'])
-        reviews = dict()
-        passed = True
-        for branch in project['branches']:
-            log("Get status of review for moved project {} / branch {}".format(self.src_key, branch))
-            _, change_id = self._git_get_last_commit_details(dst_dir)
-            reviews[change_id] = self._gerrit_get_reviewed_approved_status(change_id)
-            if not reviews[change_id]['reviewed'] or not reviews['verified']:
-                passed = False
+        change_ids = list()
+        for src_key in self.src_keys:
+            project = self.projects[src_key]
+            for branch in project['branches']:
+                log("Get status of review for moved project {} / branch {}".format(src_key, branch))
+                dst_dir = self._get_worktree(os.path.join(self.work_dir, project['dst_key']), branch)
+                change_ids.append(self._git_get_last_commit_details(dst_dir)[1])
 
         for pkey in self.projects:
-            dst_dir = os.path.join(self.work_dir, self.projects[pkey]['src'])
             for branch in self.projects[pkey]['branches']:
-                self._git_checkout(branch, dst_dir)
-                if not self._git_log_grep(dst_dir, "[{}/{}]".format(COMMIT_MESSAGE_TAG, self.src_key)):
+                dst_dir = self._get_worktree(os.path.join(self.work_dir, self.projects[pkey]['src']), branch)
+                if not self._git_log_grep(dst_dir, self.commit_msg_tag):
                     continue
                 log("Get status of review for dependent project {} / branch {}".format(pkey, branch))
-                _, change_id = self._git_get_last_commit_details(dst_dir)
-                reviews[change_id] = self._gerrit_get_reviewed_approved_status(change_id)
-                if not reviews[change_id]['reviewed'] or not reviews['verified']:
-                    passed = False
+                change_ids.append(self._git_get_last_commit_details(dst_dir)[1])
 
-        if not passed and not self.args.force:
+        # one round trip for statuses of all reviews
+        self._gerrit_prefetch(change_ids)
+        reviews = dict()
+        passed = True
+        for change_id in change_ids:
+            reviews[change_id] = self._gerrit_get_reviewed_approved_status(change_id)
+            if not reviews[change_id]['reviewed'] or not reviews[change_id]['verified']:
+                passed = False
+
+        if not passed and not self.config.force:
             log("Not all reviews have 'Code-Review +2' and 'Verified +1' labels. Do nothing.", level='ERROR')
             raise SystemExit()
-        for change_id in reviews:
-            log('Approving change {}'.format(change_id))
-            if reviews[change_id]['reviewed'] and reviews[change_id]['verified']:
-                self._gerrit_approve(change_id)
+        approvals = [(change_id, self._gerrit_approve, change_id) for change_id in reviews
+                     if reviews[change_id]['reviewed'] and reviews[change_id]['verified']]
+        errors = self._gerrit_dispatch('Approving', approvals)
+        if errors:
+            log("Approving failed for {} review(s): {}".format(len(errors), ', '.join(errors)), level='ERROR')
+            raise SystemExit()
 
     def _op_notify(self):
-        reviews = self._gerrit_cmd(['query', '--format', 'JSON', 'project:{}'.format(self.src_key),
-                                    'status:open']).splitlines()
-        project = self.projects[self.src_key]
-        for review in reviews:
-            data = json.loads(review)
-            if 'id' not in data:
-                # last line is stats
-                continue
-            if data['branch'] not in project['branches']:
-                continue
-            log("Notifying {}".format(data['id']), level='INFO')
+        # open reviews of all moved projects by one query
+        query = '"({}) status:open"'.format(' OR '.join('project:{}'.format(src_key) for src_key in self.src_keys))
+        reviews = self._gerrit().query(query, options=['--current-patch-set'])
+        for data in reviews:
+            self.changes.setdefault(data['id'], data.get('currentPatchSet'))
+
+        def _notify(change_id, revision):
             # TODO: should script set -2 to Code-Review to prevent merges while moving is going?
-            self._gerrit_post_comment(data['id'], NOTIFICATION_MESSAGE)
-            data = self._gerrit_get_current_patch_set(data['id'])
+            self._gerrit_retry(self._gerrit_post_comment, change_id, NOTIFICATION_MESSAGE)
             try:
-                self._gerrit_cmd(['set-reviewers', data['revision'], '--remove', self.args.user])
+                self._gerrit_retry(self._gerrit().set_reviewers, revision, remove=self.config.user)
             except Exception:
                 pass
+            return "Notified"
+
+        notifications = [(data['id'], _notify, data['id'], data['currentPatchSet']['revision']) for data in reviews
+                         if data['branch'] in self._get_project(data['project'])['branches']]
+        self._gerrit_dispatch('Notifying', notifications, retry=False)
+
+    def _op_references(self):
+        def _index(pkey, repo_dir):
+            self._update_index(pkey, repo_dir)
+            return "Indexed"
+
+        for pkey in self.projects:
+            if not self._is_git_repo_present(pkey):
+                log("Project {} is not cloned. Skipping...".format(pkey), level='WARNING')
+                continue
+            repo_dir = os.path.join(self.work_dir, self.projects[pkey]['src'])
+            self._run_task(pkey, _index, pkey, repo_dir)
+        errors = self._wait_tasks()
+        if errors:
+            log("Index update failed for {}: {}".format(len(errors), ', '.join(errors)), level='ERROR')
+        for pkey in self.projects:
+            if pkey in self.src_keys or (self.work_dir, pkey) not in self.indexes:
+                continue
+            for src_key in self.src_keys:
+                name = self.projects[src_key]['src']
+                references = self.indexes[(self.work_dir, pkey)].references(name)
+                for branch in sorted(references):
+                    files = references[branch]
+                    log("{} / {}: {} file(s), {} line(s) with {}".format(
+                        pkey, branch, len(files), sum(len(lines) for lines in files.values()), name))
+                    for path in sorted(files):
+                        log("    {}: {}".format(path, ', '.join(str(line) for line in files[path])))
 
     # private helpers' functions
 
+    def _get_project(self, pkey):
+        # destination and test dirs are checked out on branches of moved/controller project
+        return self.repos.get(pkey) or self.projects[self.src_keys[0]]
+
+    def _save_profile(self):
+        path = self.config.trace or os.path.join(
+            self.work_dir, TRACE_FILE.format(self.operation, time.strftime('%Y%m%d-%H%M%S')))
+        path = os.path.normpath(os.path.join(self.path, path))
+        tracer.save(path)
+        tracer.summary()
+        log("Trace is saved to {}".format(path))
+
+    def _get_index(self, pkey):
+        with self.lock:
+            key = (self.work_dir, pkey)
+            if key not in self.indexes:
+                self.indexes[key] = ReferenceIndex(os.path.join(self.work_dir, INDEX_DIR, pkey + '.json'),
+                                                   self.repos.names)
+        return self.indexes[key]
+
+    @traced('index')
+    def _update_index(self, pkey, repo_dir, branches=None):
+        index = self._get_index(pkey)
+        if branches is None:
+            branches = self._get_project(pkey)['branches']
+        with index.lock:
+            updated = False
+            for branch in branches:
+                updated = index.update(repo_dir, branch) or updated
+            if updated:
+                index.save()
+        return index
+
     def _is_git_repo_present(self, pkey, clone_dir=None):
         # clone_dir substitutes pkey[1]
         if not clone_dir:
@@ -397,13 +1565,53 @@ class Migration():
         path = os.path.join(self.work_dir, clone_dir)
         if not os.path.exists(path):
             return False
-        result = subprocess.call(['git', 'status'], cwd=path,
-                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        result = _call(['git', 'status'], cwd=path,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         return False if result else True
 
     def _git_pull(self, pkey, clone_dir=None):
-        # TODO: implement
-        pass
+        if not clone_dir:
+            clone_dir = pkey.split('/')[1]
+        path = os.path.join(self.work_dir, clone_dir)
+        project = self._get_project(pkey)
+        cmd = ['git', 'fetch', '-q', '--prune', 'origin']
+        if os.path.exists(os.path.join(path, '.git', 'shallow')):
+            cmd.extend(['--depth', '1'])
+        _check_call(cmd, cwd=path,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._git_reset(path)
+        _check_call(['git', 'checkout', '-q', '--detach', 'origin/' + project['branches'][0]], cwd=path,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # reset each local branch to its remote state. branches with worktree are reset inside it.
+        for branch in project['branches']:
+            worktree = self._worktree_path(path, branch)
+            if self._is_worktree_present(worktree):
+                self._git_reset(worktree)
+                cmd, cwd = ['git', 'checkout', '-q', '-B', branch, 'origin/' + branch], worktree
+            else:
+                cmd, cwd = ['git', 'branch', '-q', '-f', branch, 'origin/' + branch], path
+            _check_call(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _git_url(self, pkey):
+        return 'ssh://{}@{}:{}/{}.git'.format(self.config.user, GERRIT_URL, GERRIT_PORT, pkey)
+
+    def _update_mirror(self, pkey):
+        # bare mirror keeps only branches and tags - gerrit's refs/changes are not needed
+        path = os.path.join(self.mirrors_dir, pkey + '.git')
+        if not os.path.exists(os.path.join(path, 'HEAD')):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            _check_call(['git', 'clone', '-q', '--bare', self._git_url(pkey), path],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            # workspaces use objects of mirror via alternates, so mirror must never drop them
+            for key, value in (('remote.origin.fetch', '+refs/heads/*:refs/heads/*'),
+                               ('gc.pruneExpire', 'never'),
+                               ('gc.reflogExpireUnreachable', 'never')):
+                _check_call(['git', 'config', key, value], cwd=path)
+            return "Cloned"
+        _check_call(['git', 'fetch', '-q', '--prune', '--tags', 'origin'], cwd=path,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return "Updated"
 
     def _git_clone(self, pkey, clone_dir=None):
         if not clone_dir:
@@ -411,63 +1619,98 @@ class Migration():
         path = os.path.join(self.work_dir, clone_dir)
         if os.path.exists(path):
             shutil.rmtree(path)
-        url = 'ssh://{}@{}:{}/{}.git'.format(self.args.user, GERRIT_URL, GERRIT_PORT, pkey)
         cmd = ['git', 'clone', '-q']
-        if pkey != self.src_key and pkey in self.projects and len(self.projects[pkey].get('branches', list())) == 1:
-            cmd.extend(['--depth', '1', '--single-branch'])
-        cmd.extend([url, clone_dir])
-        subprocess.check_call(cmd, cwd=self.work_dir)
-        self._git_add_commit_hook(path)
-
-    def _git_add_commit_hook(self, dst_dir):
-        subprocess.check_call(['scp', '-p', '-P', GERRIT_PORT,
-                               '{}@{}:hooks/commit-msg'.format(self.args.user, GERRIT_URL),
-                               '{}/.git/hooks/'.format(dst_dir)], cwd=self.work_dir,
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-    def _git_checkout(self, branch, repo_dir):
-        subprocess.check_call(['git', 'checkout', branch], cwd=repo_dir,
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if self.mirrors_dir:
+            # local clone which borrows objects from mirror. origin points to mirror.
+            cmd.extend(['--shared', os.path.join(self.mirrors_dir, pkey + '.git'), clone_dir])
+        else:
+            if pkey not in self.src_keys and pkey in self.projects and len(self.projects[pkey].get('branches', list())) == 1:
+                cmd.extend(['--depth', '1', '--single-branch'])
+            cmd.extend([self._git_url(pkey), clone_dir])
+        _check_call(cmd, cwd=self.work_dir)
+        self._git_add_commit_hook(os.path.join(path, '.git', 'hooks'))
+
+    def _git_add_commit_hook(self, hooks_dir):
+        os.makedirs(hooks_dir, exist_ok=True)
+        # hook is downloaded once into mirrors dir if mirrors are used
+        hook = os.path.join(self.mirrors_dir, 'commit-msg') if self.mirrors_dir else None
+        if hook and os.path.exists(hook) and hooks_dir != self.mirrors_dir:
+            shutil.copy2(hook, hooks_dir)
+            return
+        _check_call(['scp', '-p', '-P', GERRIT_PORT,
+                     '{}@{}:hooks/commit-msg'.format(self.config.user, GERRIT_URL),
+                     '{}/'.format(hooks_dir)], cwd=self.work_dir,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _worktree_path(self, repo_dir, branch):
+        # ${workspace}/${src}/.worktrees/${project dir}/${branch}
+        return os.path.join(self.work_dir, WORKTREES_DIR, os.path.relpath(repo_dir, self.work_dir), branch)
+
+    def _is_worktree_present(self, path):
+        if not os.path.exists(os.path.join(path, '.git')):
+            return False
+        return _call(['git', 'rev-parse', '--git-dir'], cwd=path,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+    def _get_worktree(self, repo_dir, branch):
+        """Returns path to persistent worktree of repo with checked out branch. Creates it if needed."""
+        path = self._worktree_path(repo_dir, branch)
+        if self._is_worktree_present(path):
+            return path
+        with self.lock:
+            if self._is_worktree_present(path):
+                return path
+            # repo could be re-cloned and old worktree is broken
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            _check_call(['git', 'worktree', 'prune'], cwd=repo_dir,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            # branch can't be checked out in main dir and in worktree at the same time
+            current = _check_output(['git', 'symbolic-ref', '-q', '--short', 'HEAD'], check=False, cwd=repo_dir,
+                                    stderr=subprocess.DEVNULL).decode().strip()
+            if current == branch:
+                _check_call(['git', 'checkout', '-q', '--detach'], cwd=repo_dir,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            # local branch is created from origin one if it's absent
+            _check_call(['git', 'worktree', 'add', path, branch], cwd=repo_dir,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return path
 
     def _git_reset(self, repo_dir):
-        subprocess.check_call(['git', 'reset', '--hard'], cwd=repo_dir,
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        subprocess.check_call(['git', 'clean', '-fd'], cwd=repo_dir,
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _check_call(['git', 'reset', '--hard'], cwd=repo_dir,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _check_call(['git', 'clean', '-fd'], cwd=repo_dir,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _git_session(self, repo_dir):
+        repo_dir = os.path.normpath(repo_dir)
+        if repo_dir not in self.git_sessions:
+            self.git_sessions[repo_dir] = GitSession(repo_dir)
+        return self.git_sessions[repo_dir]
 
     def _git_log_grep(self, repo_dir, message):
         """Returns True if message is in log and False overwise."""
-        msg = message.replace('[', '\\[').replace(']', '\\]')
-        res = subprocess.call('git log --oneline | grep "{}"'.format(msg.splitlines()[0]), shell=True, cwd=repo_dir,
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return not res
+        return self._git_session(repo_dir).log_contains(message.splitlines()[0])
 
     def _git_commit(self, repo_dir, comment):
-        subprocess.check_call(['git', 'add', '.'], cwd=repo_dir,
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        subprocess.check_call(['git', 'commit', '-m', comment], cwd=repo_dir,
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _check_call(['git', 'add', '.'], cwd=repo_dir,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _check_call(['git', 'commit', '-m', comment], cwd=repo_dir,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     def _git_commit_amend(self, repo_dir, comment):
-        subprocess.check_call(['git', 'commit', '--amend', '--no-edit', '-m', comment], cwd=repo_dir,
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _check_call(['git', 'commit', '--amend', '--no-edit', '-m', comment], cwd=repo_dir,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     def _git_get_last_commit_details(self, repo_dir, check_msg_tag=None):
-        git_log = subprocess.check_output(['git', 'log', '-1'], cwd=repo_dir).decode()
-        if check_msg_tag and check_msg_tag not in git_log:
+        commit_sha, change_id, message = self._git_session(repo_dir).commit_details()
+        if check_msg_tag and check_msg_tag not in message:
             log("Latest commit is not correct", level='ERROR')
             raise SystemExit()
-        commit_sha = None
-        change_id = None
-        for line in git_log.splitlines():
-            if line.startswith('commit '):
-                commit_sha = line.split()[1]
-            if 'Change-Id:' in line:
-                change_id = line.split(':')[1].strip()
         return commit_sha, change_id
 
     def _git_review(self, repo_dir):
-        status = subprocess.check_output(['git', 'branch', '-v'], cwd=repo_dir).decode()
+        status = _check_output(['git', 'branch', '-v'], cwd=repo_dir).decode()
         if 'ahead' not in status:
             log('Nothing to commit for {}'.format(repo_dir), level='ERROR')
             raise SystemExit()
@@ -479,18 +1722,54 @@ class Migration():
         if data and data.get('revision') == commit_sha:
             log('Review already raised for {}'.format(repo_dir))
             return change_id
-        subprocess.check_call(['git', 'review', '-y', '-t', 'migration/' + self.args.src], cwd=repo_dir,
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _check_call(['git', 'review', '-y', '-t', 'migration/' + self.name], cwd=repo_dir,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # new patch set is pushed
+        self.changes.pop(change_id, None)
         return change_id
 
+    def _git_common_dir(self, repo_dir):
+        path = _check_output(['git', 'rev-parse', '--git-common-dir'], cwd=repo_dir).decode().strip()
+        return os.path.normpath(os.path.join(repo_dir, path))
+
+    @traced('copy')
+    def _git_sync_tree(self, src_dir, dst_dir, kept_names):
+        """Makes index and working tree of dst_dir equal to HEAD of src_dir except top level kept_names.
+
+        Source commit is fetched into dst repo (only objects missing there are copied, both repos
+        borrow from shared mirrors), so dst doesn't depend on source workspace which may be re-cloned
+        or cleaned. New tree is built from source tree object in temporary index. Working tree is
+        updated by two-way read-tree merge, so only changed files are written.
+        Returns False if dst_dir already has such content."""
+        src_sha = self._git_session(src_dir).head()
+        _check_call(['git', 'fetch', '-q', '--no-tags', self._git_common_dir(src_dir), src_sha],
+                    cwd=dst_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        git_dir = _check_output(['git', 'rev-parse', '--absolute-git-dir'], cwd=dst_dir).decode().strip()
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(git_dir, 'index.sync'))
+        try:
+            _check_call(['git', 'read-tree', src_sha], cwd=dst_dir, env=env)
+            for name in kept_names:
+                _check_call(['git', 'rm', '-q', '-f', '--cached', '--ignore-unmatch', '--', name],
+                            cwd=dst_dir, env=env, stdout=subprocess.DEVNULL)
+                entry = _check_output(['git', 'ls-tree', 'HEAD', '--', name], cwd=dst_dir).decode()
+                if entry:
+                    info, path = entry.rstrip('\n').split('\t', 1)
+                    mode, _, sha = info.split()
+                    _check_call(['git', 'update-index', '--add', '--cacheinfo', '{},{},{}'.format(mode, sha, path)],
+                                cwd=dst_dir, env=env)
+            tree = _check_output(['git', 'write-tree'], cwd=dst_dir, env=env).decode().strip()
+        finally:
+            if os.path.exists(env['GIT_INDEX_FILE']):
+                os.remove(env['GIT_INDEX_FILE'])
+        head_tree = _check_output(['git', 'rev-parse', 'HEAD^{tree}'], cwd=dst_dir).decode().strip()
+        if tree == head_tree:
+            return False
+        _check_call(['git', 'read-tree', '-m', '-u', 'HEAD', tree], cwd=dst_dir,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return True
+
     def _git_diff_stat(self, repo_dir):
-        # we must to flush all caches.
-        subprocess.check_call(['git', 'status'], cwd=repo_dir,
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        subprocess.check_call(['git', 'diff'], cwd=repo_dir,
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        # and finally check
-        return subprocess.check_output(['git', 'diff', '--stat'], cwd=repo_dir)
+        return self._git_session(repo_dir).is_dirty()
 
     def _gerrit_get_reviewed_approved_status(self, change_id):
         result = {'reviewed': False, 'approved': False, 'verified': False}
@@ -509,138 +1788,184 @@ class Migration():
 
     def _gerrit_post_comment(self, change_id, comment):
         data = self._gerrit_get_current_patch_set(change_id)
-        self._gerrit_cmd(['review', '--message', '"{}"'.format(comment), data['revision']])
+        self._gerrit().review(data['revision'], message=comment)
+        # approvals are changed
+        self.changes.pop(change_id, None)
 
     def _gerrit_approve(self, change_id):
         data = self._gerrit_get_current_patch_set(change_id)
-        self._gerrit_cmd(['review', '--approved', '1', data['revision']])
+        self._gerrit().review(data['revision'], approved=1)
+        self.changes.pop(change_id, None)
+
+    @traced('gerrit')
+    def _gerrit_prefetch(self, change_ids):
+        """Fills cache of current patch sets with batched 'change:A OR change:B' queries."""
+        change_ids = sorted(set(cid for cid in change_ids if cid and cid not in self.changes))
+        batches = [change_ids[i:i + GERRIT_QUERY_BATCH] for i in range(0, len(change_ids), GERRIT_QUERY_BATCH)]
+        commands = [['query', '--format', 'JSON', '--current-patch-set',
+                     '"{}"'.format(' OR '.join('change:{}'.format(cid) for cid in batch))] for batch in batches]
+        for batch, output in zip(batches, self._gerrit().run_many(commands)):
+            if isinstance(output, Exception):
+                log("Failed to query changes: {}".format(output), level='WARNING')
+                continue
+            found = dict()
+            for line in output.splitlines():
+                data = json.loads(line)
+                # first change wins like in single query
+                if 'id' in data and data['id'] not in found:
+                    found[data['id']] = data.get('currentPatchSet')
+            for change_id in batch:
+                self.changes[change_id] = found.get(change_id)
 
     def _gerrit_get_current_patch_set(self, change_id):
-        # use only commit info. drop stats
-        data = self._gerrit_cmd(['query', '--current-patch-set', '--format', 'JSON', change_id]).splitlines()
-        data = [json.loads(item) for item in data]
-        if 'type' in data[0] and data[0]['type'] == 'stats':
-            # there is no such change_id in gerrit
-            return None
-        return data[0].get('currentPatchSet')
-
-    def _gerrit_cmd(self, params):
-        gerrit_cmd = ['ssh', '-p', GERRIT_PORT, 'ssh://{}@{}'.format(self.args.user, GERRIT_URL), 'gerrit']
-        gerrit_cmd.extend(params)
-        return subprocess.check_output(gerrit_cmd, cwd=self.work_dir).decode()
-
-    def _run_task(self, method, *args, **kwargs):
-        # TODO: implement threading
-        method(*args, **kwargs)
-
-    def _patch_file(self, file, src_key, dst_key):
-        src_key = src_key.lower()
-        src_org, src = src_key.split('/')
-        dst_key = dst_key.lower()
-        dst_org, dst = dst_key.split('/')
-
-        # check file, change something, print warnings
-        # tool have to change 'src_org/src_project' to 'dst_org/dst_project'
-        #   - except link to github.com/**/wiki
-        #   - except links to github.com with commit SHA
-        # tool have to find all 'project'
-        #   - skip all like 'src/project'
-        #   - skip occurrences in files *requirements.txt, ci_unittests.json
-        #   - print warnings for rest
-
-        link_prefix = 'https://github.com/'
-        wiki_link = '{}{}/wiki'.format(link_prefix, src_key)
-        commit_link = '{}{}/blob'.format(link_prefix, src_key)
-
-        # max file is 1mb so just read it
-        patched = False
-        warnings = []
-        try:
-            with open(file) as fh:
-                lines = fh.readlines()
-        except UnicodeDecodeError:
-            log("File {} has invalid characters that can not be decoded by utf-8".format(file), level='ERROR')
+        if change_id not in self.changes:
+            data = self._gerrit().query(change_id, options=['--current-patch-set'])
+            # there is no such change_id in gerrit if data is empty
+            self.changes[change_id] = data[0].get('currentPatchSet') if data else None
+        return self.changes[change_id]
+
+    def _gerrit_retry(self, method, *args, **kwargs):
+        """Calls gerrit write method within rate limit. Retries it with exponential backoff."""
+        with self.lock:
+            if not self.rate_limiter:
+                self.rate_limiter = RateLimiter(self.config.gerrit_rate)
+        delay = GERRIT_RETRY_DELAY
+        for attempt in range(1, GERRIT_RETRIES + 1):
+            self.rate_limiter.acquire()
+            try:
+                return method(*args, **kwargs)
+            except Exception as e:
+                if attempt == GERRIT_RETRIES:
+                    raise
+                log("Gerrit command failed ({}), retry in {}s: {}".format(attempt, delay, e), level='WARNING')
+                time.sleep(delay)
+                delay *= 2
+
+    def _gerrit_dispatch(self, action, items, retry=True):
+        """Executes gerrit writes concurrently. items are (name, method, *args).
+
+        Returns names of failed items."""
+        for name, method, *args in items:
+            log("{} {}".format(action, name))
+            if retry:
+                self._run_task(name, self._gerrit_retry, method, *args)
+            else:
+                self._run_task(name, method, *args)
+        errors = self._wait_tasks()
+        log("{}: {} succeeded, {} failed{}".format(
+            action, len(items) - len(errors), len(errors), (': ' + ', '.join(errors)) if errors else ''))
+        return errors
+
+    def _gerrit(self):
+        with self.lock:
+            if not self.gerrit:
+                self.gerrit = GerritClient(self.config.user, connections=self.config.ssh_connections)
+        return self.gerrit
+
+    def _run_task(self, name, method, *args, **kwargs):
+        # method is executed in worker pool. results must be collected with _wait_tasks
+        if not self.executor:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.config.jobs))
+        future = self.executor.submit(self._run_traced, name, method, *args, **kwargs)
+        self.tasks.append((name, future))
+
+    def _run_traced(self, name, method, *args, **kwargs):
+        with tracer.span(getattr(method, '__name__', 'task'), 'task', task=name):
+            return method(*args, **kwargs)
+
+    def _wait_tasks(self):
+        """Waits for all scheduled tasks, logs progress and returns names of failed ones."""
+        tasks, self.tasks = self.tasks, list()
+        names = {future: name for name, future in tasks}
+        errors = list()
+        done = 0
+        for future in concurrent.futures.as_completed(names):
+            done += 1
+            name = names[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                errors.append(name)
+                log("[{}/{}] {}: {}".format(done, len(tasks), name, e), level='ERROR')
+                continue
+            log("[{}/{}] {} {}".format(done, len(tasks), result or 'Done', name))
+        return errors
+
+    def _execute_plan(self, plan, invalidates=None):
+        if self.config.plan:
+            plan.show(self.config.jobs)
+            return
+        if all(plan.is_done(node_id) for node_id in plan.nodes):
+            log("All steps are done already. Use 'clone' to start from scratch.")
             return
+        # results of next operations are based on results of this one - they are reset
+        # only when some step is going to run
+        for operation in invalidates or list():
+            self._reset_state(operation)
+        failed = plan.run(self.config.jobs)
+        if failed:
+            log("Failed to process {}. Please check errors above. Next run continues from them."
+                "".format(', '.join(failed)), level='ERROR')
+            raise SystemExit()
 
-        line_num = 0
-        new_lines = []
-        for line in lines:
-            line_num += 1
-            index = 0
-            while True:
-                index = line.lower().find(src_key, index)
-                if index == -1:
-                    break
-                # check link to Wiki
-                if line[index - len(link_prefix):].lower().startswith(wiki_link):
-                    index += len(src_key)
-                    warnings.append("Link to wiki has been found in line {} and it won't be changed.".format(line_num))
-                    continue
-                # check link to commit
-                if line[index - len(link_prefix):].lower().startswith(commit_link):
-                    index += len(src_key)
-                    warnings.append("Link to commit has been found in line {} and it won't be changed.".format(line_num))
-                    # TODO: next element in path after 'blob' can be commit SHA or branch name or something else.
-                    # we can analyze is it a branch name and if this branch in the list of moved branches then we can change the link.
-                    continue
-                # we can use replace with count=1 but here we definetly know what should be done.
-                line = line[0:index] + dst_key + line[index + len(src_key):]
-                patched = True
-                index += len(dst_key)
-            index = 0
-            while True:
-                index = line.lower().find(src, index)
-                if index == -1:
-                    break
-                # exclude src_key as it was parsed previously
-                if line[index - len(src_org) - 1:index + len(src)].lower() == src_key:
-                    index += len(src)
-                    continue
-                # skip src in *requirements.txt, ci_unittests.json
-                if file.endswith('requirements.txt') or file in ['ci_unittests.json']:
-                    index += len(src)
-                    continue
-                # skip all occurences of pointing to sources - they still are placed in old structure
-                if line[index - 4:index].lower() == 'src/':
-                    index += len(src)
-                    continue
-                # all other treat as warnings for now
-                warnings.append("Name '{}' was found in line {} and it won't be changed. Line is:\n{}".format(src, line_num, line))
-                index += len(src)
-            new_lines.append(line)
+    def _reset_state(self, operation):
+        path = os.path.join(self.work_dir, STATE_FILE.format(operation))
+        if os.path.exists(path):
+            os.remove(path)
 
+    def _log_patch_result(self, file, patched, warnings, error):
+        if error:
+            log(error, level='ERROR')
+            return
         if not patched and not warnings:
             return
         log("Patching file: {}".format(file))
         for item in warnings:
             log("  " + item, level="WARNING")
 
-        with open(file, 'w') as fh:
-            fh.writelines(new_lines)
-
-    def _patch_dir(self, repo_dir, src_key, dst_key, excludes=None):
-        src = src_key.split('/')[1]
-        cmd = ('find . -not -path "*/.git/*" -not -path "*/vendor/github.com/*"'
-               ' -not -path "*.zip" -not -path "*.tgz" -not -path "*.tar.gz"'
-               ' -type f -exec grep -I -i -l "{}" {{}} \;'.format(src))
-        output = subprocess.check_output(cmd, shell=True, cwd=repo_dir).decode()
-        for file in output.splitlines():
-            file = os.path.normpath(file)
-            if excludes and file in excludes:
-                continue
-            dst_path = os.path.join(repo_dir, file)
-            self._patch_file(dst_path, src_key, dst_key)
-
-    def _patch_dir_no_check(self, repo_dir, src, dst):
-        cmd = (' find . -not -path "*/.git/*" -type f -exec grep -l "{}" {{}} \;'.format(src.replace('"', '\\"')))
-        output = subprocess.check_output(cmd, shell=True, cwd=repo_dir).decode()
-        for file in output.splitlines():
-            dst_path = os.path.join(repo_dir, os.path.normpath(file))
-            subprocess.check_call(
-                'sed -E -i "" "s|{}|{}|g" {}'.format(src.replace('"', '\\"'), dst.replace('"', '\\"'), dst_path),
-                shell=True, cwd=self.work_dir,
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    def _get_scan_pool(self):
+        with self.lock:
+            if not self.scan_pool and __name__ != '__main__':
+                # module loaded by path can't be imported by name in worker processes,
+                # so library users scan in threads
+                self.scan_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.config.jobs))
+            if not self.scan_pool:
+                # workers must not be forked from this process - they would inherit pipes of running
+                # git processes and these processes would never get EOF.
+                context = None
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                self.scan_pool = concurrent.futures.ProcessPoolExecutor(max_workers=max(1, self.config.jobs),
+                                                                        mp_context=context)
+        return self.scan_pool
+
+    def _patch_dir(self, repo_dir, moves, excludes=None, files=None):
+        if files is None:
+            files = walk_files(repo_dir)
+        files = [rel_path for rel_path in files if not excludes or rel_path not in excludes]
+        args = [(os.path.join(repo_dir, rel_path), rel_path, moves) for rel_path in files]
+        with tracer.span('patch_dir', 'scan', repo=repo_dir, files=len(args)) as span:
+            results = self._get_scan_pool().map(_patch_file_task, args, chunksize=SCAN_CHUNK_SIZE)
+            span['patched'] = 0
+            patched_keys = set()
+            for rel_path, patched, warnings, error in results:
+                span['patched'] += 1 if patched else 0
+                patched_keys.update(patched)
+                self._log_patch_result(os.path.join(repo_dir, rel_path), patched, warnings, error)
+        return patched_keys
+
+    def _patch_dir_no_check(self, repo_dir, replacements):
+        files = [os.path.join(repo_dir, rel_path) for rel_path in walk_files(repo_dir, skip_vendor=False)]
+        args = [(path, replacements) for path in files]
+        result = set()
+        with tracer.span('patch_dir_no_check', 'scan', repo=repo_dir, files=len(args)):
+            for path, replaced in self._get_scan_pool().map(_replace_in_file_task, args, chunksize=SCAN_CHUNK_SIZE):
+                if replaced:
+                    log("Patching file: {}".format(path))
+                    result.update(replaced)
+        return result
 
+    @traced('shutil')
     def _clean_dir(self, dst_dir, excluded_names):
         for item in os.listdir(dst_dir):
             if item in excluded_names:
@@ -651,26 +1976,45 @@ class Migration():
             else:
                 os.remove(item_path)
 
-    def _copy_dir(self, src_dir, dst_dir, excluded_names):
-        for item in os.listdir(src_dir):
-            if item in excluded_names:
-                continue
-            src_path = os.path.join(src_dir, item)
-            dst_path = os.path.join(dst_dir, item)
-            if os.path.isdir(src_path):
-                shutil.copytree(src_path, dst_path, symlinks=True)
-            else:
-                shutil.copy2(src_path, dst_path, follow_symlinks=False)
-
     def _create_file(self, fdir, filename, content):
         path = os.path.join(fdir, filename)
         with open(path, 'w') as fh:
             fh.write(content)
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repos-config', default="./repos-config.yaml", help='Path to file with repos config')
+    parser.add_argument('--workspace', default="./workspace", help="path to workspace where cloned repos will be placed")
+    parser.add_argument('--user', help="user for git ssh access")
+    parser.add_argument('--force', help="Force operation if it's possible", action='store_true', default=False)
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS, help="Number of parallel git jobs")
+    parser.add_argument('--mirrors', help="Path to shared bare mirrors of projects")
+    parser.add_argument('--no-mirrors', help="Clone projects directly from gerrit", action='store_true', default=False)
+    parser.add_argument('--ssh-connections', type=int, default=SSH_CONNECTIONS,
+                        help="Number of multiplexed ssh connections to gerrit")
+    parser.add_argument('--gerrit-rate', type=float, default=GERRIT_RATE,
+                        help="Max number of gerrit write commands per second")
+    parser.add_argument('--plan', help="Print plan of operation and exit", action='store_true', default=False)
+    parser.add_argument('--wave', help="Name of wave of projects from repos config to migrate together")
+    parser.add_argument('--profile', help="Print profile summary at the end and save trace", action='store_true',
+                        default=False)
+    parser.add_argument('--trace', help="Path to trace file in Chrome trace format (implies --profile)")
+    # TODO: add creds for opencontrail's gerrit
+    parser.add_argument('operation', choices=Migration.operations(), help="Operation to execute.")
+    parser.add_argument('src', nargs='*', help="Source project(s) from Juniper's organization")
+    return parser.parse_args(argv)
+
+
 def main():
-    migration = Migration()
-    migration.execute()
+    args = parse_args()
+    config = MigrationConfig(
+        repos_config=args.repos_config, workspace=args.workspace, user=args.user, force=args.force, jobs=args.jobs,
+        mirrors=args.mirrors, no_mirrors=args.no_mirrors, ssh_connections=args.ssh_connections,
+        gerrit_rate=args.gerrit_rate, plan=args.plan, profile=args.profile, trace=args.trace,
+        base_dir=os.path.abspath(os.path.dirname(sys.argv[0])))
+    with Migration(config) as migration:
+        migration.execute(args.operation, args.src, wave=args.wave)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,118 @@
+import argparse
+import datetime
+import os
+import sys
+import types
+import unittest
+
+try:
+    import mysql.connector  # noqa: F401
+except ImportError:
+    # export_table doesn't use the driver, module only has to be importable
+    sys.modules['mysql'] = types.ModuleType('mysql')
+    sys.modules['mysql.connector'] = sys.modules['mysql'].connector = types.ModuleType('mysql.connector')
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import zuul_exporter  # noqa: E402
+
+
+START = datetime.datetime(2024, 1, 2, 3, 4, 5)
+
+
+class FakeCursor():
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.params = None
+
+    def execute(self, sql, params):
+        self.params = params
+        self.rows = [row for row in self.rows if row[0] > params[0]][:params[1]]
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def close(self):
+        pass
+
+
+class FakeConnection():
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self):
+        return FakeCursor(self.rows)
+
+    def rollback(self):
+        pass
+
+
+class FakeWriter():
+
+    def __init__(self):
+        self.lines = list()
+
+    def write(self, lines):
+        self.lines += lines
+
+
+def build(build_id, result, start=None, end=None, ended=None):
+    return (build_id, 'job', result, start, end, True, 'node', 'tenant', 'check', 'project', 'master', START,
+            ended or end)
+
+
+class ExportTableTest(unittest.TestCase):
+
+    def export(self, rows, state=None):
+        writer = FakeWriter()
+        state = state or zuul_exporter.ExportState(None)
+        args = argparse.Namespace(batch_size=2, max_rows=100)
+        read = zuul_exporter.export_table(FakeConnection(rows), writer, state, zuul_exporter.BUILD_TABLE,
+                                          'sql', zuul_exporter.build_point, lambda row: row[2] is not None, args)
+        return read, writer.lines, state
+
+    def test_skipped_build_is_exported_and_does_not_block(self):
+        end = START + datetime.timedelta(seconds=30)
+        rows = [build(1, 'FAILURE', START, end), build(2, 'SKIPPED', ended=end), build(3, 'SUCCESS', START, end)]
+        read, lines, state = self.export(rows)
+        self.assertEqual(read, 3)
+        self.assertEqual(state.last_id[zuul_exporter.BUILD_TABLE], 3)
+        self.assertEqual(state.pending, dict())
+        self.assertEqual(len(lines), 3)
+        self.assertIn('result=SKIPPED', lines[1])
+        self.assertNotIn('duration=', lines[1])
+        self.assertIn('duration=30.0', lines[0])
+
+    def test_points_of_the_same_second_differ(self):
+        end = START + datetime.timedelta(seconds=30)
+        _, lines, _ = self.export([build(1, 'SUCCESS', START, end), build(2, 'SUCCESS', START, end)])
+        timestamps = [int(line.rsplit(' ', 1)[1]) for line in lines]
+        self.assertEqual(timestamps[1] - timestamps[0], 1)
+        self.assertEqual(timestamps[0] // zuul_exporter.NS, int((end - datetime.datetime(1970, 1, 1)).total_seconds()))
+
+    def test_running_build_blocks_export(self):
+        end = START + datetime.timedelta(seconds=30)
+        rows = [build(1, 'SUCCESS', START, end), build(2, None, START), build(3, 'SKIPPED', ended=end)]
+        read, lines, state = self.export(rows)
+        self.assertEqual(read, 1)
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(state.last_id[zuul_exporter.BUILD_TABLE], 1)
+        self.assertEqual(state.pending[zuul_exporter.BUILD_TABLE][0], 2)
+
+        rows[1] = build(2, 'SUCCESS', START, end)
+        read, lines, state = self.export(rows, state)
+        self.assertEqual(read, 2)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(state.pending, dict())
+
+    def test_build_without_any_time_is_not_written(self):
+        read, lines, state = self.export([build(1, 'SKIPPED')])
+        self.assertEqual(read, 1)
+        self.assertEqual(lines, list())
+        self.assertEqual(state.last_id[zuul_exporter.BUILD_TABLE], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,303 @@
+#!/bin/python
+
+"""Exporter of zuul build history from MySQL to InfluxDB.
+
+Rows of zuul_build and zuul_buildset newer than stored high-water ids are read in id order with
+unbuffered (streaming) cursor and written to InfluxDB as line protocol in large batches:
+
+    zuul_build,tenant,pipeline,project,branch,job,result,node,voting  duration,queue_time,passed,build_id
+    zuul_buildset,tenant,pipeline,project,branch,result  duration,builds,passed,buildset_id
+
+Durations are in seconds, point time is end of build (buildset). Builds without end time (SKIPPED,
+...) have no duration and take the end of their buildset, or start time if buildset has no ended builds.
+Point time is written in nanoseconds: seconds of the time plus row id modulo 10^9, so points of
+different rows don't overwrite each other when they have the same tags and second. Queue time is
+time from event of buildset if zuul_buildset has event_timestamp, otherwise from start of the first
+build of buildset. High-water ids are saved in state file after every written batch, so restart
+continues where export stopped and points are never written twice. Unfinished rows (no result) stop
+reading of their table until they are finished, rows unfinished longer than PENDING_TIMEOUT are skipped.
+
+Connection is taken from env variables MYSQL_HOST, MYSQL_USER, MYSQL_PASSWD and ZUUL_DATABASE,
+InfluxDB from INFLUXDB_URL and INFLUXDB_DATABASE.
+"""
+
+import argparse
+import calendar
+import json
+import mysql.connector
+import os
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+BUILD_TABLE = 'zuul_build'
+BUILDSET_TABLE = 'zuul_buildset'
+BATCH_SIZE = 5000
+# rows per query, the next query continues from the last exported id
+MAX_ROWS = 100000
+INTERVAL = 60
+PENDING_TIMEOUT = 24 * 3600
+WRITE_DELAYS = (1, 5, 15, 60)
+# nanoseconds of point time are taken by row id
+NS = 10 ** 9
+PASSED = 'SUCCESS'
+BUILD_SQL = """SELECT b.id, b.job_name, b.result, b.start_time, b.end_time, b.voting, b.node_name,
+    bs.tenant, bs.pipeline, bs.project, bs.branch, {queued},
+    COALESCE(b.end_time, (SELECT MAX(e.end_time) FROM `{schema}`.`zuul_build` e WHERE e.buildset_id = b.buildset_id),
+             b.start_time)
+    FROM `{schema}`.`zuul_build` b JOIN `{schema}`.`zuul_buildset` bs ON bs.id = b.buildset_id
+    WHERE b.id > %s ORDER BY b.id LIMIT %s"""
+BUILD_QUEUED_FIRST_BUILD = """(SELECT MIN(f.start_time) FROM `{schema}`.`zuul_build` f
+    WHERE f.buildset_id = b.buildset_id)"""
+BUILDSET_SQL = """SELECT bs.id, bs.tenant, bs.pipeline, bs.project, bs.branch, bs.result,
+    MIN(b.start_time), MAX(b.end_time), COUNT(b.id)
+    FROM `{schema}`.`zuul_buildset` bs LEFT JOIN `{schema}`.`zuul_build` b ON b.buildset_id = bs.id
+    WHERE bs.id > %s GROUP BY bs.id ORDER BY bs.id LIMIT %s"""
+
+
+def log(message):
+    sys.stderr.write("{}\n".format(message))
+
+
+def connect_mysql():
+    # rows left unread by stopped export are discarded on next query
+    return mysql.connector.connect(host=os.environ["MYSQL_HOST"], user=os.environ["MYSQL_USER"],
+                                   passwd=os.environ["MYSQL_PASSWD"], consume_results=True)
+
+
+def _columns(conn, schema, table):
+    c = conn.cursor()
+    c.execute("SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+              (schema, table))
+    columns = set(row[0] for row in c.fetchall())
+    c.close()
+    return columns
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def point(measurement, tags, fields, timestamp):
+    """Returns line protocol point, tags with empty values are omitted, int fields are written as integers."""
+    line = [_escape(measurement)]
+    for key in sorted(tags):
+        if tags[key] not in (None, ''):
+            line.append(',{}={}'.format(key, _escape(tags[key])))
+    values = list()
+    for key, value in fields.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        elif isinstance(value, int):
+            value = '{}i'.format(value)
+        values.append('{}={}'.format(key, value))
+    return '{} {} {}'.format(''.join(line), ','.join(values), timestamp)
+
+
+def _timestamp(dt, row_id):
+    """Nanoseconds since epoch of naive UTC datetime which zuul stores, sub-second part is row id."""
+    return calendar.timegm(dt.utctimetuple()) * NS + row_id % NS
+
+
+def _duration(start, end):
+    if start is None or end is None:
+        return None
+    return float((end - start).total_seconds())
+
+
+def build_point(row):
+    (build_id, job, result, start, end, voting, node, tenant, pipeline, project, branch, queued, ended) = row
+    if ended is None:
+        # skipped build of buildset without any started build has no time
+        return None
+    tags = dict(tenant=tenant, pipeline=pipeline, project=project, branch=branch, job=job, result=result,
+                node=node, voting=None if voting is None else str(bool(voting)).lower())
+    fields = dict(duration=_duration(start, end), queue_time=_duration(queued, start),
+                  passed=int(result == PASSED), build_id=build_id)
+    return point(BUILD_TABLE, tags, fields, _timestamp(ended, build_id))
+
+
+def buildset_point(row):
+    (buildset_id, tenant, pipeline, project, branch, result, start, end, builds) = row
+    if end is None:
+        # buildset without builds (merge failure, ...) has no time
+        return None
+    tags = dict(tenant=tenant, pipeline=pipeline, project=project, branch=branch, result=result)
+    fields = dict(duration=_duration(start, end), builds=builds, passed=int(result == PASSED),
+                  buildset_id=buildset_id)
+    return point(BUILDSET_TABLE, tags, fields, _timestamp(end, buildset_id))
+
+
+class InfluxWriter():
+    """Writes batches of line protocol points, retries with backoff while InfluxDB is not available."""
+
+    def __init__(self, url, database, delays=WRITE_DELAYS):
+        self.url = '{}/write?{}'.format(url.rstrip('/'), urllib.parse.urlencode(dict(db=database, precision='ns')))
+        self.delays = delays
+        self.points = 0
+
+    def write(self, lines):
+        body = '\n'.join(lines).encode()
+        for attempt, delay in enumerate((0,) + tuple(self.delays)):
+            if delay:
+                time.sleep(delay)
+            try:
+                urllib.request.urlopen(urllib.request.Request(self.url, data=body, method='POST'), timeout=60)
+                self.points += len(lines)
+                return
+            except urllib.error.HTTPError as err:
+                message = err.read().decode(errors='replace')
+                if err.code == 400 and 'partial write' in message:
+                    # valid points are written, rejected ones (e.g. field type conflict) would fail again
+                    log("influxdb rejected some points: {}".format(message))
+                    self.points += len(lines)
+                    return
+                if err.code < 500 and err.code != 429:
+                    raise
+                error = "{} {}".format(err.code, message)
+            except (urllib.error.URLError, OSError) as err:
+                error = err
+            log("failed to write {} points ({}), attempt {}".format(len(lines), error, attempt + 1))
+        raise RuntimeError("failed to write points to influxdb in {} attempts".format(len(self.delays) + 1))
+
+
+class ExportState():
+    """High-water ids of exported tables and the unfinished rows blocking them."""
+
+    def __init__(self, path):
+        self.path = path
+        self.last_id = dict()
+        # table -> [id, first time seen unfinished]
+        self.pending = dict()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.last_id = data['last_id']
+            self.pending = data.get('pending', dict())
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(last_id=self.last_id, pending=self.pending), f)
+        os.replace(tmp, self.path)
+
+    def is_pending(self, table, row_id, now):
+        """True if unfinished row should block export yet, False if it waited too long and is skipped."""
+        pending = self.pending.get(table)
+        if not pending or pending[0] != row_id:
+            self.pending[table] = [row_id, now]
+            return True
+        return now - pending[1] < PENDING_TIMEOUT
+
+
+def _flush(writer, state, table, lines, last_id):
+    if lines:
+        writer.write(lines)
+    state.last_id[table] = last_id
+    if state.pending.get(table, [last_id + 1])[0] <= last_id:
+        del state.pending[table]
+    state.save()
+
+
+def export_table(conn, writer, state, table, sql, to_point, finished, args):
+    """Exports rows of table newer than high-water id, returns number of read rows."""
+    last_id = state.last_id.get(table, 0)
+    c = conn.cursor()
+    c.execute(sql, (last_id, args.max_rows))
+    lines = list()
+    rows = 0
+    now = time.time()
+    stopped = False
+    while not stopped:
+        batch = c.fetchmany(args.batch_size)
+        if not batch:
+            break
+        for row in batch:
+            if not finished(row):
+                if state.is_pending(table, row[0], now):
+                    stopped = True
+                    break
+                log("{} {} is unfinished for {}s, skipped".format(table, row[0], PENDING_TIMEOUT))
+            else:
+                line = to_point(row)
+                if line:
+                    lines.append(line)
+            rows += 1
+            last_id = row[0]
+        if len(lines) >= args.batch_size:
+            _flush(writer, state, table, lines, last_id)
+            lines = list()
+    _flush(writer, state, table, lines, last_id)
+    c.close()
+    conn.rollback()
+    return rows
+
+
+def export(conn, writer, state, schema, args):
+    """Exports all new rows, returns number of read rows."""
+    queued = 'bs.event_timestamp' if 'event_timestamp' in _columns(conn, schema, BUILDSET_TABLE) \
+        else BUILD_QUEUED_FIRST_BUILD.format(schema=schema)
+    build_sql = BUILD_SQL.format(schema=schema, queued=queued)
+    buildset_sql = BUILDSET_SQL.format(schema=schema)
+    total = 0
+    while True:
+        # result is set when build is finished, end time is not set for skipped builds
+        rows = export_table(conn, writer, state, BUILD_TABLE, build_sql, build_point,
+                            lambda row: row[2] is not None, args)
+        rows += export_table(conn, writer, state, BUILDSET_TABLE, buildset_sql, buildset_point,
+                             lambda row: row[5] is not None, args)
+        total += rows
+        # a full query means there is more history to catch up with
+        if rows < args.max_rows:
+            return total
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Exports zuul builds and buildsets from MySQL to InfluxDB")
+    parser.add_argument('--state', default=os.environ.get('EXPORTER_STATE', 'zuul_exporter.json'),
+                        help="Path to file with high-water ids of exported rows")
+    parser.add_argument('--influxdb-url', default=os.environ.get('INFLUXDB_URL', 'http://localhost:8086'))
+    parser.add_argument('--influxdb-database', default=os.environ.get('INFLUXDB_DATABASE', 'monitoring'))
+    parser.add_argument('--batch-size', type=int, default=int(os.environ.get('EXPORTER_BATCH_SIZE', BATCH_SIZE)),
+                        help="Points per write to InfluxDB")
+    parser.add_argument('--max-rows', type=int, default=MAX_ROWS, help="Rows per MySQL query")
+    parser.add_argument('--interval', type=int, default=int(os.environ.get('EXPORTER_INTERVAL', INTERVAL)),
+                        help="Seconds between exports, 0 exports once and exits")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    schema = os.environ["ZUUL_DATABASE"]
+    state = ExportState(args.state)
+    writer = InfluxWriter(args.influxdb_url, args.influxdb_database)
+    conn = None
+    while True:
+        started = time.monotonic()
+        try:
+            if conn is None:
+                conn = connect_mysql()
+            rows = export(conn, writer, state, schema, args)
+            log("exported {} rows, {} points written, last ids {}".format(rows, writer.points, state.last_id))
+        except (mysql.connector.Error, RuntimeError, OSError) as err:
+            # high-water ids are saved only for written points, the next export repeats the rest
+            log("failed to export zuul builds: {}".format(err))
+            if conn is not None:
+                conn.close()
+                conn = None
+            if not args.interval:
+                return 1
+        if not args.interval:
+            return 0
+        time.sleep(max(0, args.interval - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
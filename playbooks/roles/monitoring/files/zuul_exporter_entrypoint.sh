@@ -0,0 +1,5 @@
+#!/bin/sh
+set -e
+
+pip install mysql-connector
+python /root/zuul_exporter.py
\ No newline at end of file
@@ -0,0 +1,301 @@
+#!/bin/python
+
+"""Allocation of build numbers in build_metadata_cache.
+
+Build number is sequential per version and is allocated once per zuul buildset: all jobs of buildset
+get the same number. Allocation is one statement 'INSERT ... SELECT MAX(build_number) + 1 ... RETURNING',
+unique keys (version, build_number) and (version, zuul_buildset_id) reject concurrent duplicates -
+loser of the race returns number of existing buildset or retries. Allocated numbers never change,
+so they are cached in bounded LRU cache. Connections are taken from pool.
+
+Usage:
+    build_number.py allocate VERSION BUILDSET_ID - prints build number (MYSQL_HOST, MYSQL_USER,
+        MYSQL_PASSWD and BUILD_NUMBER_DATABASE env variables are used)
+    build_number.py bench [--sqlite PATH | --mysql] ... - concurrency benchmark, see --help
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import os
+import queue
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+
+TABLE = 'build_metadata_cache'
+# MySQL table is created and upgraded by migrations of create_db.py only, bench table copies it;
+# SQLite table of bench mirrors its columns and unique keys
+SQLITE_SCHEMA = """CREATE TABLE IF NOT EXISTS {table} (
+    build_number INTEGER,
+    zuul_buildset_id TEXT,
+    version TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (version, build_number),
+    UNIQUE (version, zuul_buildset_id)
+);"""
+SELECT_SQL = "SELECT build_number FROM {table} WHERE version = {p} AND zuul_buildset_id = {p}"
+ALLOCATE_SQL = """INSERT INTO {table} (build_number, zuul_buildset_id, version)
+    SELECT COALESCE(MAX(build_number), 0) + 1, {p}, {p} FROM {table} WHERE version = {p}
+    RETURNING build_number"""
+POOL_SIZE = 10
+CACHE_SIZE = 4096
+# attempts of allocation when concurrent allocations collide
+MAX_ATTEMPTS = 20
+RETRY_DELAY = 0.01
+
+
+class LRUCache():
+    """Thread safe mapping with bounded size, the least recently used items are dropped."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+class ConnectionPool():
+    """Pool of DB-API connections created on demand, at most 'size' are used at once."""
+
+    def __init__(self, connect, size=POOL_SIZE):
+        self._connect = connect
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            except Exception:
+                # connection in unknown state (e.g. lost) is not returned to pool
+                try:
+                    conn.rollback()
+                except Exception:
+                    conn.close()
+                    raise
+                self._idle.put(conn)
+                raise
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class BuildNumberAllocator():
+
+    def __init__(self, pool, db_module, table=TABLE, cache_size=CACHE_SIZE):
+        self.pool = pool
+        self.db_module = db_module
+        placeholder = '?' if db_module.paramstyle == 'qmark' else '%s'
+        self._select_sql = SELECT_SQL.format(table=table, p=placeholder)
+        self._allocate_sql = ALLOCATE_SQL.format(table=table, p=placeholder)
+        self.cache = LRUCache(cache_size)
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+    def allocate(self, version, buildset_id):
+        """Returns build number of buildset, new one is allocated for the first call."""
+        key = (version, buildset_id)
+        number = self.cache.get(key)
+        if number is not None:
+            self._count('cache_hits')
+            return number
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt:
+                self._count('retries')
+                # randomized delay spreads colliding allocations
+                time.sleep(random.uniform(0, RETRY_DELAY * attempt))
+            try:
+                with self.pool.connection() as conn:
+                    number = self._find(conn, version, buildset_id)
+                    if number is None:
+                        number = self._insert(conn, version, buildset_id)
+            except self.db_module.IntegrityError:
+                # concurrent allocation took the same number or the same buildset
+                continue
+            except (self.db_module.OperationalError, self.db_module.InternalError):
+                # lock wait timeout, deadlock or lost connection
+                continue
+            self.cache.put(key, number)
+            return number
+        raise RuntimeError("failed to allocate build number for {} {} in {} attempts".format(
+            version, buildset_id, MAX_ATTEMPTS))
+
+    def _find(self, conn, version, buildset_id):
+        self._count('lookups')
+        cursor = conn.cursor()
+        try:
+            cursor.execute(self._select_sql, (version, buildset_id))
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        # read transaction is finished, so next statement sees fresh data
+        conn.rollback()
+        return row[0] if row else None
+
+    def _insert(self, conn, version, buildset_id):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(self._allocate_sql, (buildset_id, version, version))
+            number = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+        conn.commit()
+        self._count('allocated')
+        return number
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+
+def create_bench_table(conn, table):
+    """(Re)creates table with schema of migrated build_metadata_cache."""
+    c = conn.cursor()
+    try:
+        c.execute("DROP TABLE IF EXISTS {}".format(table))
+        c.execute("CREATE TABLE {} LIKE {}".format(table, TABLE))
+    finally:
+        c.close()
+
+
+def mysql_allocator(pool_size=POOL_SIZE, table=TABLE):
+    import mysql.connector
+
+    def connect():
+        return mysql.connector.connect(host=os.environ["MYSQL_HOST"], user=os.environ["MYSQL_USER"],
+                                       passwd=os.environ["MYSQL_PASSWD"],
+                                       database=os.environ["BUILD_NUMBER_DATABASE"])
+
+    return BuildNumberAllocator(ConnectionPool(connect, pool_size), mysql.connector, table=table)
+
+
+def sqlite_allocator(path, pool_size=POOL_SIZE, table=TABLE):
+    def connect():
+        conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    conn = connect()
+    conn.execute(SQLITE_SCHEMA.format(table=table))
+    conn.close()
+    return BuildNumberAllocator(ConnectionPool(connect, pool_size), sqlite3, table=table)
+
+
+def bench(args):
+    """Starts all jobs of all buildsets at once and checks that numbers are unique and sequential."""
+    if args.mysql:
+        allocator = mysql_allocator(args.pool, table=TABLE + '_bench')
+        with allocator.pool.connection() as conn:
+            create_bench_table(conn, TABLE + '_bench')
+        backend = 'mysql'
+    else:
+        path = args.sqlite or os.path.join(tempfile.mkdtemp(), 'bench.db')
+        if os.path.exists(path):
+            os.remove(path)
+        allocator = sqlite_allocator(path, args.pool)
+        backend = 'sqlite ' + path
+
+    buildsets = [('{}.{}'.format(args.version_prefix, i % args.versions), str(uuid.uuid4()))
+                 for i in range(args.buildsets)]
+    requests = [buildset for buildset in buildsets for _ in range(args.jobs)]
+    random.shuffle(requests)
+    start_event = threading.Event()
+
+    def request(buildset):
+        start_event.wait()
+        started = time.perf_counter()
+        number = allocator.allocate(*buildset)
+        return buildset, number, time.perf_counter() - started
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
+        futures = [executor.submit(request, buildset) for buildset in requests]
+        started = time.perf_counter()
+        start_event.set()
+        results = [future.result() for future in futures]
+        duration = time.perf_counter() - started
+    allocator.pool.close()
+
+    numbers = dict()
+    errors = 0
+    for buildset, number, _ in results:
+        if numbers.setdefault(buildset, number) != number:
+            errors += 1
+    by_version = collections.defaultdict(list)
+    for (version, _), number in numbers.items():
+        by_version[version].append(number)
+    for version, items in by_version.items():
+        if sorted(items) != list(range(1, len(items) + 1)):
+            errors += 1
+            print("ERROR: numbers of version {} are not unique and sequential".format(version))
+    latencies = sorted(item[2] for item in results)
+    print("backend: {}, buildsets: {}, jobs per buildset: {}, threads: {}, pool: {}".format(
+        backend, args.buildsets, args.jobs, args.threads, args.pool))
+    print("requests: {}, {:.0f} req/s, latency p50 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+        len(results), len(results) / duration, latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000))
+    print("allocated: {allocated}, lookups: {lookups}, cache hits: {cache_hits}, retries: {retries}".format(
+        **collections.defaultdict(int, allocator.stats)))
+    print("errors: {}".format(errors))
+    return 1 if errors else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Allocates build numbers of zuul buildsets")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_allocate = subparsers.add_parser('allocate', help="Print build number of buildset")
+    parser_allocate.add_argument('version')
+    parser_allocate.add_argument('buildset_id')
+    parser_bench = subparsers.add_parser('bench', help="Concurrency benchmark")
+    backend = parser_bench.add_mutually_exclusive_group()
+    backend.add_argument('--sqlite', help="Path to SQLite db (default is temporary file)")
+    backend.add_argument('--mysql', action='store_true', default=False,
+                         help="Use MySQL from env variables like 'allocate' does (table {0}_bench is copy of "
+                              "{0} migrated by create_db.py)".format(TABLE))
+    parser_bench.add_argument('--buildsets', type=int, default=500, help="Number of buildsets started at once")
+    parser_bench.add_argument('--jobs', type=int, default=5, help="Jobs per buildset requesting number")
+    parser_bench.add_argument('--versions', type=int, default=3, help="Number of versions")
+    parser_bench.add_argument('--version-prefix', default='bench', help="Prefix of version names")
+    parser_bench.add_argument('--threads', type=int, default=100, help="Number of concurrent clients")
+    parser_bench.add_argument('--pool', type=int, default=POOL_SIZE, help="Size of connection pool")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == 'bench':
+        sys.exit(bench(args))
+    allocator = mysql_allocator(pool_size=1)
+    try:
+        print(allocator.allocate(args.version, args.buildset_id))
+    finally:
+        allocator.pool.close()
@@ -1,88 +1,298 @@
 #!/bin/python
 
+"""Versioned schema manager of zuul databases.
+
+Applied migrations are recorded in schema_version table of build number database. When schema is current
+the run is one connection of zuul user and one query. Otherwise user, databases and grants are (re)created
+if zuul user can't log in, and pending migrations are applied under named lock, so concurrent runs
+don't race. Consecutive migrations which only alter tables are applied in one online ALTER per table.
+Rows which a migration would fail on (e.g. duplicates rejected by new unique key) are looked up first,
+then the run stops listing them, nothing is changed. Applied migrations which differ from the code
+(checksum of statements) are reported.
+MySQL is polled with backoff until it accepts connections.
+"""
+
+import hashlib
 import mysql.connector
 import os
 import sys
+import time
+
+
+SCHEMA_VERSION_TABLE = """CREATE TABLE IF NOT EXISTS `{bn_db}`.schema_version (
+    version INT PRIMARY KEY,
+    description VARCHAR(200),
+    checksum CHAR(64),
+    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);"""
+# migrations are never edited once deployed, new ones are appended; migration 2 is the table created
+# before schema was versioned, so tables created by either have the same indexes. statement is either SQL string
+# or (table, clause) which is applied online as 'ALTER TABLE table clause, ...'
+MIGRATIONS = [
+    (1, "zuul and build number databases", [
+        "CREATE DATABASE IF NOT EXISTS `{zuul_db}`;",
+        "CREATE DATABASE IF NOT EXISTS `{bn_db}`;",
+    ]),
+    (2, "build_metadata_cache table", [
+        """CREATE TABLE IF NOT EXISTS `{bn_db}`.build_metadata_cache (
+            build_number INT,
+            zuul_buildset_id VARCHAR(36),
+            version varchar(100),
+            INDEX (version, build_number),
+            INDEX (version, zuul_buildset_id)
+        );""",
+    ]),
+    (3, "unique build numbers and buildsets per version", [
+        ("`{bn_db}`.build_metadata_cache",
+         "ADD UNIQUE KEY IF NOT EXISTS version_build_number (version, build_number)"),
+        ("`{bn_db}`.build_metadata_cache",
+         "ADD UNIQUE KEY IF NOT EXISTS version_buildset (version, zuul_buildset_id)"),
+    ]),
+    (4, "creation time of build numbers", [
+        ("`{bn_db}`.build_metadata_cache",
+         "ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP"),
+    ]),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+# version -> [(problem, query of rows which the migration would fail on)], checked before it is applied
+CHECKS = {
+    3: [
+        ("duplicate build numbers (version, build_number, rows)",
+         """SELECT version, build_number, COUNT(*) FROM `{bn_db}`.build_metadata_cache
+            WHERE version IS NOT NULL AND build_number IS NOT NULL
+            GROUP BY version, build_number HAVING COUNT(*) > 1 LIMIT {limit};"""),
+        ("duplicate buildsets (version, zuul_buildset_id, rows)",
+         """SELECT version, zuul_buildset_id, COUNT(*) FROM `{bn_db}`.build_metadata_cache
+            WHERE version IS NOT NULL AND zuul_buildset_id IS NOT NULL
+            GROUP BY version, zuul_buildset_id HAVING COUNT(*) > 1 LIMIT {limit};"""),
+    ],
+}
+# rows listed per failed check
+CHECK_LIMIT = 20
+ONLINE_DDL = "ALGORITHM=INPLACE, LOCK=NONE"
+LOCK_NAME = "zuul-schema"
+LOCK_TIMEOUT = 600
+WAIT_TIMEOUT = 300
+MAX_DELAY = 30
+# can't connect, server gone or lost, too many connections, server shutdown in progress
+NOT_READY_ERRORS = (2002, 2003, 2006, 2013, 1040, 1053)
+ACCESS_DENIED = 1045
+# access denied to database or table
+NO_PRIVILEGES = (1044, 1142)
+UNKNOWN_DATABASE = 1049
+UNKNOWN_TABLE = 1146
+# online ALTER is not supported for this change
+ONLINE_NOT_SUPPORTED = (1845, 1846)
+
+
+def log(message):
+    sys.stderr.write("{}\n".format(message))
+
+
+def wait_for_mysql(connect, timeout=WAIT_TIMEOUT):
+    """Returns connection, retries with exponential backoff while MySQL is not ready."""
+    deadline = time.monotonic() + timeout
+    delay = 1
+    while True:
+        try:
+            return connect()
+        except mysql.connector.Error as err:
+            if err.errno not in NOT_READY_ERRORS or time.monotonic() + delay > deadline:
+                raise
+            log("mysql is not ready ({}), retry in {}s".format(err, delay))
+        time.sleep(delay)
+        delay = min(delay * 2, MAX_DELAY)
+
+
+def connect_mysql(user, passwd):
+    return mysql.connector.connect(host=os.environ["MYSQL_HOST"], user=user, passwd=passwd)
+
+
+def _names():
+    return dict(zuul_db=os.environ["ZUUL_DATABASE"], bn_db=os.environ["BUILD_NUMBER_DATABASE"])
+
+
+def _checksum(statements):
+    return hashlib.sha256(repr(statements).encode()).hexdigest()
+
+
+def applied_versions(conn, names):
+    """Returns dict version -> checksum of applied migrations, empty if schema_version table doesn't exist yet."""
+    c = conn.cursor()
+    try:
+        c.execute("SELECT version, checksum FROM `{bn_db}`.schema_version;".format(**names))
+        return dict((row[0], row[1]) for row in c.fetchall())
+    except mysql.connector.Error as err:
+        if err.errno in (UNKNOWN_DATABASE, UNKNOWN_TABLE):
+            return dict()
+        raise
+    finally:
+        c.close()
+
+
+def verify_checksums(applied):
+    """Warns about applied migrations which were edited since, their changes are not applied again."""
+    for version, description, statements in MIGRATIONS:
+        if applied.get(version) not in (None, _checksum(statements)):
+            log("WARNING: migration {} ({}) differs from the applied one (checksum {}), "
+                "changes must go to a new migration".format(version, description, applied[version]))
+
+
+def current_version(names):
+    """Fast path: applied migrations (see applied_versions) read by zuul user, None if zuul user can't log in."""
+    try:
+        conn = wait_for_mysql(lambda: connect_mysql(os.environ["MYSQL_USER"], os.environ["MYSQL_PASSWD"]))
+    except mysql.connector.Error as err:
+        if err.errno == ACCESS_DENIED:
+            return None
+        raise
+    try:
+        return applied_versions(conn, names)
+    except mysql.connector.Error as err:
+        # no grants on build number database
+        if err.errno in NO_PRIVILEGES:
+            return None
+        raise
+    finally:
+        conn.close()
 
-def connect_mysql():
-    mysql_host = os.environ["MYSQL_HOST"]
-    root_passwd = os.environ["MYSQL_ROOT_PASSWD"]
-    return mysql.connector.connect(host=mysql_host, user="root", passwd=root_passwd)
 
-def create_user(conn):
+def create_user(conn, names):
     username = os.environ["MYSQL_USER"]
     password = os.environ["MYSQL_PASSWD"]
 
     c = conn.cursor()
     try:
-        c.execute("CREATE OR REPLACE USER '{0}'@'%' IDENTIFIED BY '{1}';".format(username, password))
-        c.execute("CREATE OR REPLACE USER '{0}'@'localhost' IDENTIFIED BY '{1}';".format(username, password))
+        for host in ('%', 'localhost'):
+            c.execute("CREATE OR REPLACE USER '{0}'@'{1}' IDENTIFIED BY '{2}';".format(username, host, password))
+            for db_name in (names['zuul_db'], names['bn_db']):
+                c.execute("GRANT ALL privileges ON `{0}`.* TO '{1}'@'{2}';".format(db_name, username, host))
+        c.execute("FLUSH PRIVILEGES;")
     except mysql.connector.Error as err:
-        sys.stderr.write("failed to create user {}".format(username))
+        log("failed to create user {} and grant privileges".format(username))
         raise err
-    c.close()
+    finally:
+        c.close()
 
-    return username
 
-def init_cachedb(conn, db_name):
-    c = conn.cursor()
+def _batches(pending):
+    """Groups pending migrations: consecutive ones of ALTER clauses only are one batch."""
+    batch = list()
+    for migration in pending:
+        if all(isinstance(statement, tuple) for statement in migration[2]):
+            batch.append(migration)
+            continue
+        if batch:
+            yield batch
+            batch = list()
+        yield [migration]
+    if batch:
+        yield batch
+
+
+def _alter(c, table, clauses):
+    sql = "ALTER TABLE {} {}".format(table, ", ".join(clauses))
     try:
-        c.execute(
-            """CREATE TABLE IF NOT EXISTS {}.build_metadata_cache (
-                    build_number INT,
-                    zuul_buildset_id VARCHAR(36),
-                    version varchar(100),
-                    INDEX (version, build_number),
-                    INDEX (version, zuul_buildset_id)
-                );""".format(db_name))
+        c.execute("{}, {};".format(sql, ONLINE_DDL))
     except mysql.connector.Error as err:
-        sys.stderr.write("failed to create table {}.build_metadata_cache".format(db_name))
-        raise err
+        if err.errno not in ONLINE_NOT_SUPPORTED:
+            raise
+        log("online change of {} is not supported ({}), table is locked while altered".format(table, err.msg))
+        c.execute(sql + ";")
 
-    c.close()
 
-def create_dbs(conn, username):
-    zuul_db_name = os.environ["ZUUL_DATABASE"]
-    buildnumber_db_name = os.environ["BUILD_NUMBER_DATABASE"]
+def check_batch(conn, names, batch):
+    """Raises RuntimeError listing rows which migrations of batch can't be applied to."""
+    c = conn.cursor()
+    try:
+        for version, description, _ in batch:
+            for problem, sql in CHECKS.get(version, list()):
+                c.execute(sql.format(limit=CHECK_LIMIT, **names))
+                rows = c.fetchall()
+                if rows:
+                    raise RuntimeError("migration {} ({}) can't be applied, {}: {}; fix them and run again".format(
+                        version, description, problem, ", ".join(str(tuple(row)) for row in rows)))
+    finally:
+        c.close()
+
 
+def apply_batch(conn, names, batch):
     c = conn.cursor()
-    for db_name in (zuul_db_name, buildnumber_db_name):
-        try:
-            c.execute("CREATE DATABASE IF NOT EXISTS `{}`;".format(db_name))
-        except mysql.connector.Error as err:
-            sys.stderr.write("failed to create database {}".format(db_name))
-            raise err
+    try:
+        alters = dict()
+        for _, _, statements in batch:
+            for statement in statements:
+                if isinstance(statement, tuple):
+                    table, clause = statement
+                    alters.setdefault(table.format(**names), list()).append(clause.format(**names))
+                else:
+                    c.execute(statement.format(**names))
+        for table, clauses in alters.items():
+            _alter(c, table, clauses)
+        c.execute(SCHEMA_VERSION_TABLE.format(**names))
+        c.executemany("INSERT IGNORE INTO `{bn_db}`.schema_version (version, description, checksum) "
+                      "VALUES (%s, %s, %s);".format(**names),
+                      [(version, description, _checksum(statements))
+                       for version, description, statements in batch])
+        conn.commit()
+    finally:
+        c.close()
 
-        try:
-            c.execute("GRANT ALL privileges ON `{0}`.* TO '{1}'@'%';".format(db_name, username))
-            c.execute("GRANT ALL privileges ON `{0}`.* TO '{1}'@'localhost';".format(db_name, username))
-        except mysql.connector.Error as err:
-            sys.stderr.write("failed to grand privileges to database {0} to user {1}".format(db_name, username))
-            raise err
 
+def migrate(conn, names, create_access):
+    c = conn.cursor(buffered=True)
+    c.execute("SELECT GET_LOCK(%s, %s);", (LOCK_NAME, LOCK_TIMEOUT))
+    if c.fetchone()[0] != 1:
+        raise RuntimeError("failed to get lock {} in {}s".format(LOCK_NAME, LOCK_TIMEOUT))
     try:
-        c.execute("FLUSH PRIVILEGES;")
-    except mysql.connector.Error as err:
-        sys.stderr.write("failed to flush priveleges")
-        raise err
+        if create_access:
+            create_user(conn, names)
+        # concurrent run could apply migrations while we waited for lock
+        applied = applied_versions(conn, names)
+        if create_access:
+            verify_checksums(applied)
+        pending = [migration for migration in MIGRATIONS if migration[0] not in applied]
+        for batch in _batches(pending):
+            log("applying migrations {}".format(", ".join(
+                "{} ({})".format(version, description) for version, description, _ in batch)))
+            started = time.monotonic()
+            check_batch(conn, names, batch)
+            apply_batch(conn, names, batch)
+            log("applied in {:.1f}s".format(time.monotonic() - started))
+    finally:
+        c.execute("SELECT RELEASE_LOCK(%s);", (LOCK_NAME,))
+        c.fetchall()
+        c.close()
 
-    c.close()
-    init_cachedb(conn, buildnumber_db_name)
 
-if __name__ == "__main__":
+def main():
+    names = _names()
     try:
-        db = connect_mysql()
+        applied = current_version(names)
     except mysql.connector.Error as err:
-        sys.stderr.write("failed to connect to mysql: {}". format(err))
-        exit(1)
+        log("failed to connect to mysql: {}".format(err))
+        return 1
+    if applied is not None:
+        verify_checksums(applied)
+    if applied is not None and all(migration[0] in applied for migration in MIGRATIONS):
+        log("schema is current (version {})".format(LATEST_VERSION))
+        return 0
 
     try:
-        username = create_user(db)
-        create_dbs(db, username)
-        if db.in_transaction:
-            db.commit()
+        db = wait_for_mysql(lambda: connect_mysql("root", os.environ["MYSQL_ROOT_PASSWD"]))
     except mysql.connector.Error as err:
-        sys.stderr.write("failed to create zuul databases with error: {}". format(err))
-        exit(1)
+        log("failed to connect to mysql: {}".format(err))
+        return 1
+    try:
+        migrate(db, names, create_access=applied is None)
+    except (mysql.connector.Error, RuntimeError) as err:
+        log("failed to migrate zuul databases with error: {}".format(err))
+        return 1
     finally:
         db.close()
+    log("schema is migrated to version {}".format(LATEST_VERSION))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,375 @@
+#!/bin/python
+
+"""Retention of build_metadata_cache and zuul build tables.
+
+- rows of build_metadata_cache older than retention are archived (optionally) and deleted version by
+  version, the row with the max build number of each version is kept, so numbering continues
+- rows which existed before created_at column was added got time of the upgrade and age from it,
+  --backfill-created-at (run once) sets it to start of the first build of their zuul buildset, rows
+  of buildsets pruned already keep time of the upgrade
+- zuul buildsets whose builds ended before retention are deleted with all their builds (skipped ones
+  have no end time) and rows referencing them (artifacts, provides, ...)
+- rows are deleted by primary/unique keys in bounded batches, each batch is a short transaction
+  followed by pause, so allocation of build numbers and zuul reporting are not blocked
+- indexes used by pruning are added if missing, pruned tables are analyzed or optimized (rebuilt)
+- sizes of tables and indexes are reported before and after
+
+Connection and databases are taken from env variables MYSQL_HOST, MYSQL_USER, MYSQL_PASSWD,
+ZUUL_DATABASE and BUILD_NUMBER_DATABASE like create_db.py does. Retention is set by params or env.
+"""
+
+import argparse
+import datetime
+import mysql.connector
+import os
+import sys
+import time
+
+
+BUILD_NUMBER_TABLE = 'build_metadata_cache'
+ZUUL_BUILD_TABLE = 'zuul_build'
+ZUUL_BUILDSET_TABLE = 'zuul_buildset'
+# name -> (table, columns). first columns are used by pruning queries, the rest makes index covering
+PRUNE_INDEXES = {
+    'prune_created_at': (BUILD_NUMBER_TABLE, ('created_at', 'version', 'build_number')),
+    'prune_end_time': (ZUUL_BUILD_TABLE, ('end_time', 'buildset_id')),
+}
+BATCH_SIZE = 1000
+# seconds between batches
+BATCH_PAUSE = 0.2
+# seconds to wait for row lock, pruning gives up (and retries batch) earlier than clients
+LOCK_WAIT_TIMEOUT = 5
+MAX_BATCH_ATTEMPTS = 5
+# migration of create_db.py which added created_at column
+CREATED_AT_MIGRATION = 4
+# lock wait timeout, deadlock
+RETRY_ERRORS = (1205, 1213)
+
+
+def log(message):
+    print("{} {}".format(datetime.datetime.now().isoformat(timespec='seconds'), message), flush=True)
+
+
+def connect_mysql():
+    return mysql.connector.connect(host=os.environ["MYSQL_HOST"], user=os.environ["MYSQL_USER"],
+                                   passwd=os.environ["MYSQL_PASSWD"])
+
+
+def _query(conn, sql, params=()):
+    c = conn.cursor()
+    try:
+        c.execute(sql, params)
+        return c.fetchall() if c.with_rows else c.rowcount
+    finally:
+        c.close()
+
+
+def _in(values):
+    return ', '.join(['%s'] * len(values))
+
+
+def table_sizes(conn, schemas):
+    """Returns dict (schema, table) -> (rows, data bytes, index bytes, free bytes)."""
+    rows = _query(conn, "SELECT TABLE_SCHEMA, TABLE_NAME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH, DATA_FREE "
+                        "FROM information_schema.TABLES WHERE TABLE_SCHEMA IN ({}) AND TABLE_TYPE = 'BASE TABLE'"
+                        .format(_in(schemas)), schemas)
+    return {(row[0], row[1]): tuple(value or 0 for value in row[2:]) for row in rows}
+
+
+def report_sizes(before, after):
+    log("{:<48} {:>12} {:>10} {:>10} {:>10}".format('table', 'rows', 'data,MB', 'index,MB', 'free,MB'))
+    for key in sorted(after):
+        old = before.get(key)
+        values = ["{}".format(after[key][0])] + ["{:.1f}".format(value / 2 ** 20) for value in after[key][1:]]
+        if old:
+            values = ["{}({:+})".format(after[key][0], after[key][0] - old[0])] + [
+                "{:.1f}({:+.1f})".format(new / 2 ** 20, (new - prev) / 2 ** 20)
+                for new, prev in zip(after[key][1:], old[1:])]
+        log("{:<48} {:>12} {:>10} {:>10} {:>10}".format('.'.join(key), *values))
+
+
+def _table_exists(conn, schema, table):
+    return bool(_query(conn, "SELECT 1 FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+                       (schema, table)))
+
+
+def _columns(conn, schema, table):
+    return set(row[0] for row in _query(
+        conn, "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+        (schema, table)))
+
+
+def ensure_index(conn, schema, name, dry_run=False):
+    """Adds index used by pruning unless table already has index starting with the same column."""
+    table, columns = PRUNE_INDEXES[name]
+    first = _query(conn, "SELECT INDEX_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s "
+                         "AND TABLE_NAME = %s AND COLUMN_NAME = %s AND SEQ_IN_INDEX = 1", (schema, table, columns[0]))
+    if first:
+        return
+    log("{} index {} ({}) to {}.{}".format('missing' if dry_run else 'adding', name, ', '.join(columns), schema,
+                                           table))
+    if not dry_run:
+        # online DDL - table stays writable while index is built
+        _query(conn, "ALTER TABLE `{}`.`{}` ADD INDEX {} ({}), ALGORITHM=INPLACE, LOCK=NONE".format(
+            schema, table, name, ', '.join(columns)))
+
+
+def _run_batch(conn, statements):
+    """Executes statements (sql, params) in one transaction. Returns rowcount of the last one."""
+    for attempt in range(MAX_BATCH_ATTEMPTS):
+        try:
+            for sql, params in statements:
+                count = _query(conn, sql, params)
+            conn.commit()
+            return count
+        except mysql.connector.Error as err:
+            conn.rollback()
+            if err.errno not in RETRY_ERRORS or attempt == MAX_BATCH_ATTEMPTS - 1:
+                raise
+            log("batch is retried after error: {}".format(err))
+            time.sleep(BATCH_PAUSE * (attempt + 1))
+
+
+def prune_build_numbers(conn, schema, days, batch_size, archive=False, dry_run=False):
+    """Deletes rows created 'days' ago and earlier except the last build number of each version."""
+    table = '`{}`.`{}`'.format(schema, BUILD_NUMBER_TABLE)
+    if not _table_exists(conn, schema, BUILD_NUMBER_TABLE):
+        log("{} doesn't exist, skipped".format(table))
+        return 0
+    if 'created_at' not in _columns(conn, schema, BUILD_NUMBER_TABLE):
+        log("{} has no created_at column (run create_db.py to upgrade it), skipped".format(table))
+        return 0
+    ensure_index(conn, schema, 'prune_created_at', dry_run)
+    if archive and not dry_run:
+        _query(conn, "CREATE TABLE IF NOT EXISTS `{0}`.`{1}_archive` LIKE `{0}`.`{1}`".format(
+            schema, BUILD_NUMBER_TABLE))
+    # created_at is in time zone of session, so cutoff is computed there
+    cutoff = _query(conn, "SELECT NOW() - INTERVAL %s DAY", (days,))[0][0]
+    versions = [row[0] for row in _query(
+        conn, "SELECT DISTINCT version FROM {} WHERE created_at < %s".format(table), (cutoff,))]
+    conn.rollback()
+    total = 0
+    for version in versions:
+        last = _query(conn, "SELECT MAX(build_number) FROM {} WHERE version = %s".format(table), (version,))[0][0]
+        if dry_run:
+            deleted = _query(conn, "SELECT COUNT(*) FROM {} WHERE version = %s AND created_at < %s "
+                                   "AND build_number < %s".format(table), (version, cutoff, last))[0][0]
+            conn.rollback()
+        else:
+            deleted = _prune_version(conn, schema, version, cutoff, last, batch_size, archive)
+        if deleted:
+            log("{}: {} rows of version {} {}".format(table, deleted, version,
+                                                      'to prune' if dry_run else 'pruned'))
+        total += deleted
+    return total
+
+
+def _upgrade_time(conn, schema):
+    """Returns time when created_at column was added, None if schema_version doesn't record it."""
+    if not _table_exists(conn, schema, 'schema_version'):
+        return None
+    rows = _query(conn, "SELECT applied_at FROM `{}`.schema_version WHERE version = %s".format(schema),
+                  (CREATED_AT_MIGRATION,))
+    return rows[0][0] if rows else None
+
+
+def backfill_created_at(conn, schema, zuul_schema, batch_size, dry_run=False):
+    """Sets created_at of rows older than the column to start of the first build of their zuul buildset."""
+    table = '`{}`.`{}`'.format(schema, BUILD_NUMBER_TABLE)
+    if not _table_exists(conn, schema, BUILD_NUMBER_TABLE) or not _table_exists(conn, zuul_schema, ZUUL_BUILD_TABLE):
+        log("{} or zuul builds don't exist, backfill is skipped".format(table))
+        return 0
+    if 'created_at' not in _columns(conn, schema, BUILD_NUMBER_TABLE):
+        log("{} has no created_at column (run create_db.py to upgrade it), backfill is skipped".format(table))
+        return 0
+    upgraded = _upgrade_time(conn, schema)
+    if upgraded is None:
+        log("{} has no record of created_at migration, backfill is skipped".format(table))
+        return 0
+    versions = [row[0] for row in _query(
+        conn, "SELECT DISTINCT version FROM {} WHERE created_at <= %s".format(table), (upgraded,))]
+    conn.rollback()
+    total = 0
+    for version in versions:
+        updated = 0
+        last = -1
+        while True:
+            rows = _query(conn, "SELECT build_number, zuul_buildset_id FROM {} WHERE version = %s AND created_at <= %s "
+                                "AND build_number > %s ORDER BY build_number LIMIT %s".format(table),
+                          (version, upgraded, last, batch_size))
+            conn.rollback()
+            if not rows:
+                break
+            last = rows[-1][0]
+            numbers = [row[0] for row in rows]
+            uuids = [row[1] for row in rows if row[1]]
+            if not uuids:
+                continue
+            # zuul build times are UTC (session time zone is UTC), only rows of existing buildsets are changed
+            started = ("(SELECT bs.uuid, MIN(b.start_time) AS started FROM `{0}`.`{1}` bs "
+                       "JOIN `{0}`.`{2}` b ON b.buildset_id = bs.id WHERE bs.uuid IN ({3}) GROUP BY bs.uuid) z "
+                       "ON z.uuid = c.zuul_buildset_id".format(zuul_schema, ZUUL_BUILDSET_TABLE, ZUUL_BUILD_TABLE,
+                                                               _in(uuids)))
+            where = "WHERE c.version = %s AND c.build_number IN ({}) AND z.started < c.created_at".format(_in(numbers))
+            params = uuids + [version] + numbers
+            if dry_run:
+                updated += _query(conn, "SELECT COUNT(*) FROM {} c JOIN {} {}".format(table, started, where),
+                                  params)[0][0]
+                conn.rollback()
+                continue
+            updated += _run_batch(conn, [("UPDATE {} c JOIN {} SET c.created_at = z.started {}".format(
+                table, started, where), params)])
+            time.sleep(BATCH_PAUSE)
+        if updated:
+            log("{}: created_at of {} rows of version {} {}".format(table, updated, version,
+                                                                   'to backfill' if dry_run else 'backfilled'))
+        total += updated
+    return total
+
+
+def _prune_version(conn, schema, version, cutoff, last, batch_size, archive):
+    table = '`{}`.`{}`'.format(schema, BUILD_NUMBER_TABLE)
+    deleted = 0
+    while True:
+        numbers = [row[0] for row in _query(
+            conn, "SELECT build_number FROM {} WHERE version = %s AND created_at < %s AND build_number < %s "
+                  "ORDER BY build_number LIMIT %s".format(table), (version, cutoff, last, batch_size))]
+        conn.rollback()
+        if not numbers:
+            return deleted
+        params = [version] + numbers
+        statements = list()
+        if archive:
+            statements.append(("INSERT IGNORE INTO `{}`.`{}_archive` SELECT * FROM {} WHERE version = %s "
+                               "AND build_number IN ({})".format(schema, BUILD_NUMBER_TABLE, table,
+                                                                 _in(numbers)), params))
+        statements.append(("DELETE FROM {} WHERE version = %s AND build_number IN ({})".format(
+            table, _in(numbers)), params))
+        deleted += _run_batch(conn, statements)
+        time.sleep(BATCH_PAUSE)
+
+
+def _references(conn, schema, table):
+    """Returns list of (table, column) referencing table by foreign keys."""
+    return _query(conn, "SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE "
+                        "WHERE TABLE_SCHEMA = %s AND REFERENCED_TABLE_SCHEMA = %s AND REFERENCED_TABLE_NAME = %s",
+                  (schema, schema, table))
+
+
+def prune_zuul_builds(conn, schema, cutoff, batch_size, dry_run=False):
+    """Deletes buildsets whose builds ended before cutoff, with all their builds and referencing rows.
+
+    Skipped builds have no end time, so buildsets are pruned as a whole: by the last end time of their
+    builds. Buildsets without ended builds (merge failures, all jobs skipped) are pruned when they are
+    older (by id) than the newest buildset with builds ended before cutoff."""
+    if not _table_exists(conn, schema, ZUUL_BUILD_TABLE):
+        log("`{}`.`{}` doesn't exist, skipped".format(schema, ZUUL_BUILD_TABLE))
+        return 0
+    ensure_index(conn, schema, 'prune_end_time', dry_run)
+    build_table = '`{}`.`{}`'.format(schema, ZUUL_BUILD_TABLE)
+    buildset_table = '`{}`.`{}`'.format(schema, ZUUL_BUILDSET_TABLE)
+    last_buildset = _query(conn, "SELECT MAX(buildset_id) FROM {} WHERE end_time < %s".format(build_table),
+                           (cutoff,))[0][0]
+    conn.rollback()
+    build_refs = _references(conn, schema, ZUUL_BUILD_TABLE)
+    buildset_refs = [ref for ref in _references(conn, schema, ZUUL_BUILDSET_TABLE) if ref[0] != ZUUL_BUILD_TABLE]
+    builds = 0
+    buildsets = 0
+    last_id = 0
+    while last_buildset:
+        # buildsets are walked by primary key, builds of each are aggregated by buildset_id index
+        rows = _query(conn, "SELECT bs.id, MAX(b.end_time), COUNT(b.id) FROM {} bs LEFT JOIN {} b "
+                            "ON b.buildset_id = bs.id WHERE bs.id > %s AND bs.id <= %s GROUP BY bs.id "
+                            "ORDER BY bs.id LIMIT %s".format(buildset_table, build_table),
+                      (last_id, last_buildset, batch_size))
+        conn.rollback()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        rows = [row for row in rows if row[1] is None or row[1] < cutoff]
+        if not rows:
+            continue
+        ids = [row[0] for row in rows]
+        builds += sum(row[2] for row in rows)
+        buildsets += len(ids)
+        if dry_run:
+            continue
+        builds_of = "SELECT id FROM {} WHERE buildset_id IN ({})".format(build_table, _in(ids))
+        statements = [("DELETE FROM `{}`.`{}` WHERE `{}` IN ({})".format(schema, ref_table, column, builds_of), ids)
+                      for ref_table, column in build_refs]
+        statements.append(("DELETE FROM {} WHERE buildset_id IN ({})".format(build_table, _in(ids)), ids))
+        statements += [("DELETE FROM `{}`.`{}` WHERE `{}` IN ({})".format(schema, ref_table, column, _in(ids)), ids)
+                       for ref_table, column in buildset_refs]
+        statements.append(("DELETE FROM {} WHERE id IN ({})".format(buildset_table, _in(ids)), ids))
+        _run_batch(conn, statements)
+        time.sleep(BATCH_PAUSE)
+    log("{}: {} buildsets with {} builds {}".format(buildset_table, buildsets, builds,
+                                                     'to prune' if dry_run else 'pruned'))
+    return builds + buildsets
+
+
+def maintain_tables(conn, tables, optimize=False):
+    """Refreshes statistics of pruned tables or rebuilds them to return free space."""
+    for schema, table in tables:
+        log("{} `{}`.`{}`".format('optimizing' if optimize else 'analyzing', schema, table))
+        # InnoDB rebuilds table online, so it stays writable
+        _query(conn, "{} TABLE `{}`.`{}`".format('OPTIMIZE' if optimize else 'ANALYZE', schema, table))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prunes old rows of build_metadata_cache and zuul build tables")
+    parser.add_argument('--build-number-retention-days', type=int,
+                        default=int(os.environ.get('BUILD_NUMBER_RETENTION_DAYS', 365)),
+                        help="Age of build_metadata_cache rows to prune")
+    parser.add_argument('--build-retention-days', type=int,
+                        default=int(os.environ.get('ZUUL_BUILD_RETENTION_DAYS', 180)),
+                        help="Age of zuul buildsets (end of their last build) to prune")
+    parser.add_argument('--batch-size', type=int, default=int(os.environ.get('PRUNE_BATCH_SIZE', BATCH_SIZE)),
+                        help="Rows deleted per transaction")
+    parser.add_argument('--archive', action='store_true', default=os.environ.get('PRUNE_ARCHIVE') == 'true',
+                        help="Move pruned build_metadata_cache rows to build_metadata_cache_archive")
+    parser.add_argument('--optimize', action='store_true', default=os.environ.get('PRUNE_OPTIMIZE') == 'true',
+                        help="Rebuild pruned tables to return free space")
+    parser.add_argument('--backfill-created-at', action='store_true',
+                        default=os.environ.get('PRUNE_BACKFILL_CREATED_AT') == 'true',
+                        help="Set created_at of build_metadata_cache rows older than the column from zuul builds")
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help="Only report rows to prune and missing indexes")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    zuul_db_name = os.environ["ZUUL_DATABASE"]
+    buildnumber_db_name = os.environ["BUILD_NUMBER_DATABASE"]
+    # zuul stores build times in UTC
+    now = datetime.datetime.utcnow()
+    try:
+        db = connect_mysql()
+    except mysql.connector.Error as err:
+        sys.stderr.write("failed to connect to mysql: {}".format(err))
+        exit(1)
+
+    try:
+        _query(db, "SET SESSION innodb_lock_wait_timeout = {}".format(LOCK_WAIT_TIMEOUT))
+        # zuul build times are UTC, so they are stored to created_at as is
+        _query(db, "SET SESSION time_zone = '+00:00'")
+        schemas = [zuul_db_name, buildnumber_db_name]
+        before = table_sizes(db, schemas)
+        pruned = list()
+        if args.backfill_created_at:
+            backfill_created_at(db, buildnumber_db_name, zuul_db_name, args.batch_size, dry_run=args.dry_run)
+        if prune_build_numbers(db, buildnumber_db_name, args.build_number_retention_days, args.batch_size,
+                               archive=args.archive, dry_run=args.dry_run):
+            pruned.append((buildnumber_db_name, BUILD_NUMBER_TABLE))
+        if prune_zuul_builds(db, zuul_db_name, now - datetime.timedelta(days=args.build_retention_days),
+                             args.batch_size, dry_run=args.dry_run):
+            pruned += [(zuul_db_name, ZUUL_BUILD_TABLE), (zuul_db_name, ZUUL_BUILDSET_TABLE)]
+        if not args.dry_run:
+            maintain_tables(db, pruned, optimize=args.optimize)
+        report_sizes(before, table_sizes(db, schemas))
+    except mysql.connector.Error as err:
+        sys.stderr.write("failed to prune zuul databases with error: {}".format(err))
+        exit(1)
+    finally:
+        db.close()
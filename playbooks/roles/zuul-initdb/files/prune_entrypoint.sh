@@ -0,0 +1,5 @@
+#!/bin/sh
+set -e
+
+pip install mysql-connector
+python /root/prune_db.py
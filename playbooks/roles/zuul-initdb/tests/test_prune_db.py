@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import sys
+import types
+import unittest
+
+try:
+    import mysql.connector  # noqa: F401
+except ImportError:
+    # pruning catches driver errors only, module has to be importable
+    sys.modules['mysql'] = types.ModuleType('mysql')
+    sys.modules['mysql.connector'] = sys.modules['mysql'].connector = types.ModuleType('mysql.connector')
+    sys.modules['mysql.connector'].Error = type('Error', (Exception,), dict(errno=None))
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'files'))
+import prune_db  # noqa: E402
+
+
+SCHEMA = 'zuul'
+# times are plain numbers, pruning only compares them with cutoff
+CUTOFF = 1000
+
+
+class FakeCursor():
+    """Cursor of SQLite database attached as schema, information_schema queries are answered by the fake."""
+
+    def __init__(self, db):
+        self.db = db
+        self.with_rows = False
+        self.rowcount = -1
+        self.rows = list()
+
+    def execute(self, sql, params=()):
+        self.with_rows = sql.startswith('SELECT')
+        if 'information_schema.TABLES' in sql:
+            self.rows = self.db.execute("SELECT 1 FROM zuul.sqlite_master WHERE name = ?", (params[1],)).fetchall()
+        elif 'information_schema.STATISTICS' in sql:
+            # prune indexes exist
+            self.rows = [('prune_end_time',)]
+        elif 'information_schema.KEY_COLUMN_USAGE' in sql:
+            self.rows = [('zuul_artifact', 'build_id')] if params[2] == prune_db.ZUUL_BUILD_TABLE \
+                else [('zuul_build', 'buildset_id')]
+        else:
+            cursor = self.db.execute(sql.replace('%s', '?'), params)
+            self.rows = cursor.fetchall()
+            self.rowcount = cursor.rowcount
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection():
+
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return FakeCursor(self.db)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        pass
+
+
+class PruneZuulBuildsTest(unittest.TestCase):
+
+    def setUp(self):
+        prune_db.BATCH_PAUSE = 0
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute("ATTACH DATABASE ':memory:' AS zuul")
+        self.db.executescript("""
+            CREATE TABLE zuul.zuul_buildset (id INTEGER PRIMARY KEY, result TEXT);
+            CREATE TABLE zuul.zuul_build (id INTEGER PRIMARY KEY, buildset_id INT, result TEXT, end_time INT);
+            CREATE TABLE zuul.zuul_artifact (id INTEGER PRIMARY KEY, build_id INT);""")
+        self.conn = FakeConnection(self.db)
+
+    def add_buildset(self, buildset_id, *builds):
+        self.db.execute("INSERT INTO zuul.zuul_buildset VALUES (?, 'SUCCESS')", (buildset_id,))
+        for build_id, result, end_time in builds:
+            self.db.execute("INSERT INTO zuul.zuul_build VALUES (?, ?, ?, ?)",
+                            (build_id, buildset_id, result, end_time))
+            self.db.execute("INSERT INTO zuul.zuul_artifact (build_id) VALUES (?)", (build_id,))
+
+    def ids(self, table, column='id'):
+        return [row[0] for row in self.db.execute("SELECT {} FROM zuul.{} ORDER BY 1".format(column, table))]
+
+    def test_old_buildset_with_skipped_build_is_pruned(self):
+        self.add_buildset(1, (1, 'FAILURE', 100), (2, 'SKIPPED', None))
+        # merge failure without builds
+        self.add_buildset(2)
+        self.add_buildset(3, (3, 'SKIPPED', None))
+        self.add_buildset(4, (4, 'SUCCESS', 500), (5, 'SKIPPED', None))
+        # partly old buildset is kept as a whole
+        self.add_buildset(5, (6, 'SUCCESS', 900), (7, 'SUCCESS', 1100), (8, 'SKIPPED', None))
+        # new buildset which is still running
+        self.add_buildset(6, (9, None, None))
+
+        pruned = prune_db.prune_zuul_builds(self.conn, SCHEMA, CUTOFF, batch_size=2)
+
+        self.assertEqual(pruned, 5 + 4)
+        self.assertEqual(self.ids('zuul_buildset'), [5, 6])
+        self.assertEqual(self.ids('zuul_build'), [6, 7, 8, 9])
+        self.assertEqual(self.ids('zuul_artifact', 'build_id'), [6, 7, 8, 9])
+
+    def test_dry_run_counts_only(self):
+        self.add_buildset(1, (1, 'FAILURE', 100), (2, 'SKIPPED', None))
+        self.add_buildset(2, (3, 'SUCCESS', 1100))
+
+        self.assertEqual(prune_db.prune_zuul_builds(self.conn, SCHEMA, CUTOFF, batch_size=10, dry_run=True), 3)
+        self.assertEqual(self.ids('zuul_build'), [1, 2, 3])
+
+    def test_nothing_ended_before_cutoff(self):
+        self.add_buildset(1, (1, 'SKIPPED', None))
+        self.add_buildset(2, (2, 'SUCCESS', 1100))
+
+        self.assertEqual(prune_db.prune_zuul_builds(self.conn, SCHEMA, CUTOFF, batch_size=10), 0)
+        self.assertEqual(self.ids('zuul_buildset'), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+"""Aggregate CI reports over history of reviews: failure rates and flakiness of zuul-tf and jenkins2-engprod.
+
+Reviews are read from local store of gerrit_stats (--db, synced by 'gerrit_stats.py --db') or from gerrit.
+CI comments are parsed once into columnar CommentTable and reports are group-bys over it.
+"""
+
+import argparse
+import collections
+import datetime
+
+from comment_table import CommentTable
+from gerrit_stats import (DEFAULT_LIMIT, EXCLUDED_PROJECTS, GERRIT_QUERY, IGNORED_STATUSES, PAGE_SIZE,
+                          GerritClient, ci_events)
+from review_store import ReviewStore
+
+
+GROUP_COLUMNS = ('project', 'branch', 'day')
+REPORTS = ('failures', 'flaky')
+
+
+def load_table(changes):
+    """Returns CommentTable of CI comments of changes (abandoned changes and excluded projects are skipped)."""
+    table = CommentTable()
+    for data in changes:
+        if data['status'] == 'ABANDONED' or data['project'] in EXCLUDED_PROJECTS:
+            continue
+        change = int(data['number'])
+        for ci, num, status, timestamp in ci_events(data):
+            if not num.isdigit():
+                continue
+            table.append(change, int(num), timestamp, ci, status, data['project'], data['branch'])
+    return table
+
+
+def _verdicts(table):
+    """Returns codes of verdict statuses and of succeeded status."""
+    verdicts = set(code for code, status in enumerate(table.values['status']) if status not in IGNORED_STATUSES)
+    return verdicts, table.code('status', 'succeeded')
+
+
+def failure_rates(table, by):
+    """Returns rows (group values..., ci, verdicts, failures, failure rate %)."""
+    verdicts, succeeded = _verdicts(table)
+    totals = collections.Counter()
+    failures = collections.Counter()
+    for key, count in table.group_count(list(by) + ['reviewer', 'status']).items():
+        if key[-1] not in verdicts:
+            continue
+        totals[key[:-1]] += count
+        if key[-1] != succeeded:
+            failures[key[:-1]] += count
+    return _rows(table, by, totals, failures)
+
+
+def flakiness(table, by):
+    """Returns rows (group values..., ci, patch sets, flaky, flaky %).
+
+    Patch set is flaky for CI if CI both failed and succeeded on it."""
+    verdicts, succeeded = _verdicts(table)
+    # (group..., ci, change, patch set) -> (has success, has failure)
+    patch_sets = dict()
+    for key in table.group_count(list(by) + ['reviewer', 'change', 'patch_set', 'status']):
+        if key[-1] not in verdicts:
+            continue
+        passed, failed = patch_sets.get(key[:-1], (False, False))
+        patch_sets[key[:-1]] = (passed or key[-1] == succeeded, failed or key[-1] != succeeded)
+    totals = collections.Counter()
+    flaky = collections.Counter()
+    for key, (passed, failed) in patch_sets.items():
+        totals[key[:-2]] += 1
+        if passed and failed:
+            flaky[key[:-2]] += 1
+    return _rows(table, by, totals, flaky)
+
+
+def _rows(table, by, totals, counts):
+    names = list(by) + ['reviewer']
+    rows = list()
+    for key in sorted(totals, key=lambda key: (-counts[key] / totals[key], key)):
+        values = [table.decode(name, code) for name, code in zip(names, key)]
+        rows.append(values + [totals[key], counts[key], 100.0 * counts[key] / totals[key]])
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Reports failure rates and flakiness of CI systems in reviews")
+    parser.add_argument('report', choices=REPORTS,
+                        help="failures - failure rate of CI verdicts, flaky - patch sets where CI both failed "
+                             "and succeeded")
+    parser.add_argument('limit', nargs='?', type=int,
+                        help="Max number of reviews (default is {} if --since is not set)".format(DEFAULT_LIMIT))
+    parser.add_argument('--by', nargs='*', choices=GROUP_COLUMNS, default=list(), metavar='COLUMN',
+                        help="Group by columns: {} (day is local date of comment)".format(', '.join(GROUP_COLUMNS)))
+    parser.add_argument('--since', help="Analyse reviews updated since date YYYY-MM-DD")
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE, help="Reviews per one gerrit query")
+    parser.add_argument('--db', help="Path to local SQLite store of reviews synced by gerrit_stats.py")
+    parser.add_argument('--top', type=int, help="Print only first TOP rows")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    since = None
+    if args.since:
+        since = datetime.datetime.strptime(args.since, '%Y-%m-%d').timestamp()
+    limit = args.limit if args.limit or since else DEFAULT_LIMIT
+    store = None
+    if args.db:
+        store = ReviewStore(args.db)
+        changes = store.changes(since=since, limit=limit)
+    else:
+        changes = GerritClient().query_stream(GERRIT_QUERY, options='--comments', since=since, limit=limit,
+                                              page_size=args.page_size)
+    table = load_table(changes)
+    if store:
+        store.close()
+
+    if args.report == 'failures':
+        rows, header = failure_rates(table, args.by), ['verdicts', 'failures', 'rate %']
+    else:
+        rows, header = flakiness(table, args.by), ['patchsets', 'flaky', 'flaky %']
+    widths = [max([len(name)] + [len(str(row[i])) for row in rows]) for i, name in enumerate(args.by)]
+    fmt = ''.join('{{:<{}}} '.format(width) for width in widths) + '{:<18} {:>10} {:>10} {:>8}'
+    print("CI comments: {}".format(len(table)))
+    print(fmt.format(*(list(args.by) + ['ci'] + header)))
+    for row in rows[:args.top]:
+        print(fmt.format(*(row[:-1] + ['{:.1f}'.format(row[-1])])))
+
+
+if __name__ == "__main__":
+    main()
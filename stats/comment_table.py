@@ -0,0 +1,80 @@
+"""Columnar table of parsed CI comments for aggregate reports of gerrit_stats.
+
+Each comment is parsed once into a row of integer columns kept in compact 'array' buffers; string
+columns (reviewer, status, project, branch) are dictionary encoded. Group-bys count tuples of column
+codes, so tens of thousands of comments are aggregated without touching the messages again.
+"""
+
+import array
+import collections
+import datetime
+
+
+STRING_COLUMNS = ('reviewer', 'status', 'project', 'branch')
+COLUMNS = ('change', 'patch_set', 'timestamp') + STRING_COLUMNS
+# time zone offsets are multiples of 15 minutes, so all timestamps of such bucket have the same local day
+DAY_BUCKET = 900
+
+
+class CommentTable():
+
+    def __init__(self):
+        self.columns = {
+            'change': array.array('q'),
+            'patch_set': array.array('l'),
+            'timestamp': array.array('q'),
+        }
+        # string column -> list of values, code of value is its index
+        self.values = dict()
+        self._codes = dict()
+        for name in STRING_COLUMNS:
+            self.columns[name] = array.array('l')
+            self.values[name] = list()
+            self._codes[name] = dict()
+
+    def __len__(self):
+        return len(self.columns['change'])
+
+    def append(self, change, patch_set, timestamp, reviewer, status, project, branch):
+        self.columns['change'].append(change)
+        self.columns['patch_set'].append(patch_set)
+        self.columns['timestamp'].append(timestamp)
+        for name, value in zip(STRING_COLUMNS, (reviewer, status, project, branch)):
+            self.columns[name].append(self._code(name, value))
+
+    def code(self, name, value):
+        """Returns code of value in string column or None if column has no such value."""
+        return self._codes[name].get(value)
+
+    def column(self, name):
+        """Returns column codes. 'day' is local day of timestamp (like gerrit_stats' latency days) as ordinal."""
+        if name == 'day':
+            days = dict()
+            column = array.array('l')
+            for timestamp in self.columns['timestamp']:
+                bucket = timestamp // DAY_BUCKET
+                day = days.get(bucket)
+                if day is None:
+                    day = days[bucket] = datetime.date.fromtimestamp(timestamp).toordinal()
+                column.append(day)
+            return column
+        return self.columns[name]
+
+    def decode(self, name, code):
+        if name in self.values:
+            return self.values[name][code]
+        if name == 'day':
+            return datetime.date.fromordinal(code).isoformat()
+        return code
+
+    def group_count(self, names):
+        """Returns Counter of code tuples of columns 'names'."""
+        return collections.Counter(zip(*[self.column(name) for name in names]))
+
+    def _code(self, name, value):
+        codes = self._codes[name]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.values[name])
+            self.values[name].append(value)
+        return code
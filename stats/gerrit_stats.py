@@ -1,58 +1,259 @@
+import argparse
+import concurrent.futures
+import contextlib
 import datetime
+import gzip
+import itertools
 import json
 import os
+import signal
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+
+from latency import DIMENSIONS, LatencyStats
+from review_store import ReviewStore
 
 
 SSH_CMD = 'ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no'
 SSH_DEST = '-p 29418 zuul-tf@review.opencontrail.org'
-GERRIT_CMD = 'gerrit query --comments --format=JSON branch:master limit:{}'
+GERRIT_BRANCH = 'master'
+GERRIT_QUERY = 'branch:{}'.format(GERRIT_BRANCH)
+STREAM_EVENTS = 'gerrit stream-events -s patchset-created -s comment-added -s change-abandoned'
+# seconds
+SNAPSHOT_INTERVAL = 60
+# reviews not updated longer are dropped from live state
+LIVE_STATE_TTL = 14 * 24 * 3600
+RECONNECT_DELAYS = (1, 5, 15, 60)
+DEFAULT_LIMIT = 30
+GZIP_MAGIC = b'\x1f\x8b'
+# changes per one 'gerrit query' when results are paged
+PAGE_SIZE = 500
+SSH_CONNECTIONS = 2
+# OpenSSH serves 10 sessions per connection by default
+SSH_SESSIONS_PER_CONNECTION = 8
+# multiplexed connections stay alive between runs
+SSH_CONTROL_PERSIST = '10m'
 EXCLUDED_PROJECTS = [
     'Juniper/contrail-zuul-jobs',
     'Juniper/contrail-project-config',
     'Juniper/contrail-dev-env',
 ]
 
-tf_fails = 0
-juniper_fails = 0
+CI_ZUUL = 'zuul-tf'
+CI_JENKINS = 'jenkins2-engprod'
+# CI comment statuses which are not verdicts
+IGNORED_STATUSES = ('started', 'aborted', '(check)')
 
 
-def check_review(data):
-    global tf_fails, juniper_fails
-    output = []
-    if data['project'] in EXCLUDED_PROJECTS:
-        return output
-    output.append("Review {}, created = {}, updated = {}, URL = {}".format(
-        data['number'], datetime.datetime.fromtimestamp(data['createdOn']),
-        datetime.datetime.fromtimestamp(data['lastUpdated']), data['url']))
-    patches = dict()
-    reviewers = set()
+class ReviewStats():
+    """Results of analysed reviews: CI comparison counters and CI latency sketches.
+
+    Stats of separately analysed parts of reviews can be merged."""
+
+    def __init__(self):
+        self.tf_fails = 0
+        self.juniper_fails = 0
+        self.latency = LatencyStats()
+
+    def merge(self, other):
+        self.tf_fails += other.tf_fails
+        self.juniper_fails += other.juniper_fails
+        self.latency.merge(other.latency)
+
+
+class GerritClient():
+    """Gerrit ssh commands over pool of multiplexed (ControlMaster) ssh connections."""
+
+    def __init__(self, ssh_cmd=SSH_CMD, ssh_dest=SSH_DEST, connections=SSH_CONNECTIONS):
+        self.ssh_cmd = ssh_cmd
+        self.ssh_dest = ssh_dest
+        self.connections = connections
+        # unix socket path is limited by ~100 chars, so it's kept short
+        self.control_dir = os.path.join(tempfile.gettempdir(), 'gerrit-stats-ssh-{}'.format(os.getuid()))
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+        self.counter = itertools.count()
+        self.slots = threading.BoundedSemaphore(connections * SSH_SESSIONS_PER_CONNECTION)
+
+    def command(self, gerrit_cmd):
+        connection = next(self.counter) % self.connections
+        opts = '-o ControlMaster=auto -o ControlPersist={} -o ControlPath={}/%C-{}'.format(
+            SSH_CONTROL_PERSIST, self.control_dir, connection)
+        return '{} {} {} {}'.format(self.ssh_cmd, opts, self.ssh_dest, gerrit_cmd)
+
+    def cmd(self, gerrit_cmd):
+        with self.slots:
+            return subprocess.check_output(self.command(gerrit_cmd), shell=True, stdin=subprocess.DEVNULL).decode()
+
+    def stream(self, gerrit_cmd):
+        """Yields output lines of command as they arrive. Command is killed if consumer stops early."""
+        with self.slots:
+            proc = subprocess.Popen(self.command(gerrit_cmd), shell=True, stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE)
+            completed = False
+            try:
+                for line in proc.stdout:
+                    yield line.decode()
+                completed = True
+            finally:
+                if not completed:
+                    proc.kill()
+                proc.stdout.close()
+                returncode = proc.wait()
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, gerrit_cmd)
+
+    def run_many(self, gerrit_cmds):
+        """Executes commands concurrently and returns their outputs in the same order."""
+        workers = max(1, min(len(gerrit_cmds), self.connections * SSH_SESSIONS_PER_CONNECTION))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.cmd, gerrit_cmds))
+
+    def query(self, query):
+        """Returns list of parsed JSON lines of 'gerrit query --format=JSON' without stats line."""
+        result = list()
+        for line in self.cmd('gerrit query --format=JSON {}'.format(query)).splitlines():
+            data = json.loads(line)
+            if data.get('type') != 'stats':
+                result.append(data)
+        return result
+
+    def query_stream(self, query, options='', since=None, limit=None, page_size=PAGE_SIZE):
+        """Yields changes of query as they arrive, recently updated first.
+
+        Results are paged by 'resume_sortkey:' for old gerrit (changes have 'sortKey') or by '--start'.
+        Paging stops at first change updated before 'since' (unix time) or after 'limit' changes."""
+        count = 0
+        start = 0
+        sort_key = None
+        while True:
+            size = page_size if limit is None else min(page_size, limit - count)
+            if size <= 0:
+                return
+            page = '{} resume_sortkey:{}'.format(query, sort_key) if sort_key else query
+            gerrit_cmd = 'gerrit query --format=JSON {} {}{} limit:{}'.format(
+                options, '--start {} '.format(start) if start and not sort_key else '', page, size)
+            rows = 0
+            more = None
+            with contextlib.closing(self.stream(gerrit_cmd)) as lines:
+                for line in lines:
+                    data = json.loads(line)
+                    if data.get('type') == 'stats':
+                        more = data.get('moreChanges')
+                        continue
+                    rows += 1
+                    if since and data.get('lastUpdated', since) < since:
+                        return
+                    sort_key = data.get('sortKey')
+                    count += 1
+                    yield data
+                    if limit is not None and count >= limit:
+                        return
+            if rows < size or more is False:
+                return
+            start += rows
+
+
+def ci_events(data):
+    """Returns list of (ci, patch set, status, timestamp) of CI comments in review incl. not verdicts."""
+    events = list()
     for comment in data['comments']:
         lines = comment['message'].splitlines()
         if 'username' not in comment['reviewer']:
             continue
-        if comment['reviewer']['username'] == 'zuul-tf' and '(check)' in comment['message']:
+        if comment['reviewer']['username'] == CI_ZUUL and '(check)' in comment['message']:
             num = lines[0].split()[2].split(':')[0]
             status = [line for line in lines if "(check)" in line][0].split()[2].lower()
-            if status in ('started', 'aborted', '(check)'):
-                continue
-        elif comment['reviewer']['username'] == 'jenkins2-engprod':
+        elif comment['reviewer']['username'] == CI_JENKINS:
             num = lines[0].split()[2].split(':')[0]
             if 'Verified+1' in comment['message']:
                 status = 'succeeded'
             elif 'Build Failed' in comment['message']:
                 status = 'failed'
+            elif 'Build Started' in comment['message']:
+                status = 'started'
             else:
                 continue
         else:
             continue
+        events.append((comment['reviewer']['username'], num, status, comment['timestamp']))
+    return events
+
+
+def _patch_set_times(data):
+    """Returns dict patch set -> creation time. Upload comments are used if query has no patch sets."""
+    times = dict()
+    for comment in data['comments']:
+        if comment['message'].startswith('Uploaded patch set '):
+            num = comment['message'].split()[3].rstrip('.:')
+            times.setdefault(num, comment['timestamp'])
+    for item in data.get('patchSets', list()):
+        if item.get('createdOn'):
+            times[str(item['number'])] = item['createdOn']
+    return times
+
+
+def collect_latency(data, events, latency):
+    """Adds time to first verdict and queue to result of each CI system in review to latency stats."""
+    created = _patch_set_times(data)
+    first_verdicts = dict()
+    started = dict()
+    for ci, num, status, timestamp in events:
+        if status == 'started':
+            started[(ci, num)] = timestamp
+            continue
+        if status in IGNORED_STATUSES:
+            continue
+        if (ci, num) in started:
+            latency.add(ci, 'queue_to_result', data['project'], _day(started[(ci, num)]),
+                        timestamp - started.pop((ci, num)))
+        if (ci, num) not in first_verdicts:
+            first_verdicts[(ci, num)] = timestamp
+    for (ci, num), timestamp in first_verdicts.items():
+        # verdict of patch set uploaded before analysed period can't be measured
+        if num in created and timestamp >= created[num]:
+            latency.add(ci, 'first_verdict', data['project'], _day(created[num]), timestamp - created[num])
+
+
+def _day(timestamp):
+    # local day like other times of report and 'day' column of comment_table
+    return datetime.date.fromtimestamp(timestamp).isoformat()
+
+
+def failed_ci(statuses):
+    """Returns CI which failed patch set while other CI succeeded or None.
 
-        time = str(datetime.datetime.fromtimestamp(comment['timestamp']))
-        patches.setdefault(num, list()).append((comment['reviewer']['username'], status, time))
-        reviewers.add(comment['reviewer']['username'])
+    statuses is dict CI -> set of verdict statuses of patch set."""
+    if len(set().union(*statuses.values())) < 2:
+        return None
+    if statuses.get(CI_ZUUL) == {'succeeded'}:
+        return CI_JENKINS
+    if statuses.get(CI_JENKINS) == {'succeeded'}:
+        return CI_ZUUL
+    return None
 
-    if len(reviewers) == 1 and next(iter(reviewers)) == 'jenkins2-engprod':
+
+def check_review(data, stats):
+    output = []
+    if data['project'] in EXCLUDED_PROJECTS:
+        return output
+    output.append("Review {}, created = {}, updated = {}, URL = {}".format(
+        data['number'], datetime.datetime.fromtimestamp(data['createdOn']),
+        datetime.datetime.fromtimestamp(data['lastUpdated']), data['url']))
+    events = ci_events(data)
+    collect_latency(data, events, stats.latency)
+    patches = dict()
+    reviewers = set()
+    for username, num, status, timestamp in events:
+        if status in IGNORED_STATUSES:
+            continue
+        time = str(datetime.datetime.fromtimestamp(timestamp))
+        patches.setdefault(num, list()).append((username, status, time))
+        reviewers.add(username)
+
+    if len(reviewers) == 1 and next(iter(reviewers)) == CI_JENKINS:
         output.append("    ERROR: reviewed just by {}. project {}".format(next(iter(reviewers)), data['project']))
 
     # check only last patchset
@@ -63,16 +264,15 @@ def check_review(data):
     statuses = set([item[1] for item in pdata])
     if len(statuses) < 2:
         return output
-    statuses_zuul = set([item[1] for item in pdata if item[0] == 'jenkins2-engprod'])
-    statuses_zuul_tf = set([item[1] for item in pdata if item[0] == 'zuul-tf'])
+    failed = failed_ci({ci: set([item[1] for item in pdata if item[0] == ci]) for ci in (CI_ZUUL, CI_JENKINS)})
 
-    if len(statuses_zuul_tf) == 1 and next(iter(statuses_zuul_tf)) == 'succeeded':
+    if failed == CI_JENKINS:
         #output.append("    {}: GOOD: TF is better.".format(num))
-        juniper_fails += 1
+        stats.juniper_fails += 1
         return output
-    if len(statuses_zuul) == 1 and next(iter(statuses_zuul)) == 'succeeded':
+    if failed == CI_ZUUL:
         output.append("    {}: BAD: Juniper is better.".format(num))
-        tf_fails += 1
+        stats.tf_fails += 1
         return output
 
     for item in pdata:
@@ -81,23 +281,317 @@ def check_review(data):
     return output
 
 
+class LiveState():
+    """CI state of recently updated reviews, updated incrementally by gerrit stream events.
+
+    Juniper/TF fails are counted over last patch sets of tracked reviews, latency sketches only grow.
+    Repeated CI comments (e.g. from backfill after reconnect) are ignored."""
+
+    def __init__(self):
+        self.stats = ReviewStats()
+        # change number -> dict with project, updated, created (patch set -> time),
+        # started (CI -> patch set -> time), verdicts (patch set -> CI -> statuses) and seen CI comments
+        self.reviews = dict()
+        # time of last handled event. backfill after reconnect starts from it
+        self.last_event = 0
+
+    def handle(self, event):
+        change = event.get('change')
+        if not change or change['project'] in EXCLUDED_PROJECTS or change.get('branch') != GERRIT_BRANCH:
+            return
+        timestamp = event.get('eventCreatedOn', 0)
+        self.last_event = max(self.last_event, timestamp)
+        number = str(change['number'])
+        if event['type'] == 'change-abandoned':
+            review = self.reviews.pop(number, None)
+            if review:
+                self._count(review, -1)
+            return
+        if event['type'] not in ('patchset-created', 'comment-added'):
+            return
+        review = self.reviews.get(number)
+        if review is None:
+            review = self.reviews[number] = {'project': change['project'], 'updated': timestamp, 'created': dict(),
+                                             'started': dict(), 'verdicts': dict(), 'seen': list()}
+        review['updated'] = max(review['updated'], timestamp)
+        if event['type'] == 'patchset-created':
+            patch_set = event['patchSet']
+            review['created'].setdefault(str(patch_set['number']), patch_set.get('createdOn', timestamp))
+            return
+        comment = {'timestamp': timestamp, 'reviewer': event.get('author', dict()), 'message': event.get('comment', '')}
+        for ci, num, status, timestamp in ci_events({'comments': [comment]}):
+            self._ci_event(review, ci, num, status, timestamp)
+
+    def apply_change(self, data):
+        """Applies patch sets and comments of change from 'gerrit query --comments --patch-sets'."""
+        change = {key: data[key] for key in ('project', 'branch', 'number')}
+        if data['status'] == 'ABANDONED':
+            self.handle({'type': 'change-abandoned', 'change': change, 'eventCreatedOn': data['lastUpdated']})
+            return
+        events = [{'type': 'patchset-created', 'change': change, 'patchSet': item,
+                   'eventCreatedOn': item.get('createdOn', 0)} for item in data.get('patchSets', list())]
+        events += [{'type': 'comment-added', 'change': change, 'author': item['reviewer'], 'comment': item['message'],
+                    'eventCreatedOn': item['timestamp']} for item in data['comments']]
+        for event in sorted(events, key=lambda event: event['eventCreatedOn']):
+            self.handle(event)
+
+    def expire(self, now):
+        """Drops reviews not updated for LIVE_STATE_TTL seconds."""
+        for number in [number for number, review in self.reviews.items() if review['updated'] < now - LIVE_STATE_TTL]:
+            self._count(self.reviews.pop(number), -1)
+
+    def save(self, path):
+        data = {'last_event': self.last_event, 'juniper_fails': self.stats.juniper_fails,
+                'tf_fails': self.stats.tf_fails, 'latency': self.stats.latency.to_dict(), 'reviews': self.reviews}
+        # snapshot is replaced atomically, so crash doesn't leave broken file
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        state = cls()
+        state.last_event = data['last_event']
+        state.stats.juniper_fails = data['juniper_fails']
+        state.stats.tf_fails = data['tf_fails']
+        state.stats.latency = LatencyStats.from_dict(data['latency'])
+        state.reviews = data['reviews']
+        return state
+
+    def _ci_event(self, review, ci, num, status, timestamp):
+        key = [timestamp, ci, num, status]
+        if key in review['seen']:
+            return
+        review['seen'].append(key)
+        if status == 'started':
+            review['started'].setdefault(ci, dict())[num] = timestamp
+            return
+        if status in IGNORED_STATUSES:
+            return
+        latency = self.stats.latency
+        started = review['started'].get(ci, dict()).pop(num, None)
+        if started is not None:
+            latency.add(ci, 'queue_to_result', review['project'], _day(started), timestamp - started)
+        created = review['created'].get(num)
+        if ci not in review['verdicts'].get(num, dict()) and created is not None and timestamp >= created:
+            latency.add(ci, 'first_verdict', review['project'], _day(created), timestamp - created)
+        # review is counted again with new verdict
+        self._count(review, -1)
+        statuses = review['verdicts'].setdefault(num, dict()).setdefault(ci, list())
+        if status not in statuses:
+            statuses.append(status)
+        self._count(review, 1)
+
+    def _count(self, review, sign):
+        # only last patch set is compared like in check_review
+        if not review['verdicts']:
+            return
+        statuses = review['verdicts'][max(review['verdicts'], key=int)]
+        failed = failed_ci({ci: set(items) for ci, items in statuses.items()})
+        if failed == CI_JENKINS:
+            self.stats.juniper_fails += sign
+        elif failed == CI_ZUUL:
+            self.stats.tf_fails += sign
+
+
+def _print_live(state):
+    print("{}: reviews {}, Juniper fails {}, TF fails {}".format(
+        datetime.datetime.fromtimestamp(state.last_event), len(state.reviews), state.stats.juniper_fails,
+        state.stats.tf_fails))
+    print('\n'.join(state.stats.latency.report()), flush=True)
+
+
+def _consume(state, lines, args):
+    """Applies JSON events from lines to state and returns number of events.
+
+    Snapshot is saved and printed every snapshot interval."""
+    count = 0
+    last_snapshot = time.monotonic()
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        state.handle(event)
+        count += 1
+        if time.monotonic() - last_snapshot >= args.snapshot_interval:
+            _snapshot(state, args)
+            last_snapshot = time.monotonic()
+    return count
+
+
+def _snapshot(state, args):
+    # event time is used, so replay expires reviews like live mode did
+    state.expire(state.last_event)
+    if args.snapshot:
+        state.save(args.snapshot)
+    _print_live(state)
+
+
+def _stop(signum, frame):
+    raise SystemExit("Stopped by signal {}".format(signum))
+
+
+def run_daemon(args, since=None):
+    """Follows 'gerrit stream-events' (or replays events file) and keeps live CI state.
+
+    Stream is reopened after drop and missed changes are backfilled by query since last handled event.
+    Stream is opened before backfill, so events in between are buffered and not lost."""
+    state = LiveState()
+    if args.snapshot and os.path.exists(args.snapshot):
+        state = LiveState.load(args.snapshot)
+        print("Loaded snapshot: reviews {}, last event {}".format(
+            len(state.reviews), datetime.datetime.fromtimestamp(state.last_event)), flush=True)
+    if args.events:
+        with open(args.events) as f:
+            _consume(state, f, args)
+        _snapshot(state, args)
+        return
+    # snapshot is saved on stop by service manager too
+    signal.signal(signal.SIGTERM, _stop)
+    client = GerritClient()
+    backfill_since = state.last_event or since
+    attempt = 0
+    try:
+        while True:
+            proc = subprocess.Popen(client.command(STREAM_EVENTS), shell=True, stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE, universal_newlines=True)
+            try:
+                if backfill_since:
+                    count = 0
+                    for data in client.query_stream(GERRIT_QUERY, options='--comments --patch-sets',
+                                                    since=backfill_since, page_size=args.page_size):
+                        state.apply_change(data)
+                        count += 1
+                    print("Backfilled reviews: {}".format(count), flush=True)
+                if _consume(state, proc.stdout, args):
+                    attempt = 0
+            except (subprocess.CalledProcessError, OSError) as e:
+                print("ERROR: {}".format(e), flush=True)
+            finally:
+                proc.kill()
+                proc.wait()
+            delay = RECONNECT_DELAYS[min(attempt, len(RECONNECT_DELAYS) - 1)]
+            print("Stream is dropped. Reconnect in {}s".format(delay), flush=True)
+            time.sleep(delay)
+            attempt += 1
+            backfill_since = state.last_event or since
+    finally:
+        _snapshot(state, args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compares CI results of zuul-tf and jenkins2-engprod in reviews")
+    parser.add_argument('limit', nargs='?', type=int,
+                        help="Max number of reviews (default is {} if --since and --input are not set)".format(
+                            DEFAULT_LIMIT))
+    parser.add_argument('--since', help="Analyse reviews updated since date YYYY-MM-DD")
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE, help="Reviews per one gerrit query")
+    parser.add_argument('--input', help="Replay recorded output of 'gerrit query --format=JSON --comments' "
+                                        "(plain or gzip, '-' is stdin) instead of gerrit")
+    parser.add_argument('--db', help="Path to local SQLite store of reviews. Only changed reviews are downloaded "
+                                     "(or imported from --input) to it and report is built from it")
+    parser.add_argument('--offline', action='store_true', default=False,
+                        help="Build report from local store without sync")
+    parser.add_argument('--daemon', action='store_true', default=False,
+                        help="Follow 'gerrit stream-events' and print live CI state every snapshot interval")
+    parser.add_argument('--events', help="Replay file of recorded stream events instead of live stream "
+                                         "(implies --daemon)")
+    parser.add_argument('--snapshot', help="Path to JSON snapshot of live state. It's loaded on start and "
+                                           "missed changes are backfilled")
+    parser.add_argument('--snapshot-interval', type=int, default=SNAPSHOT_INTERVAL,
+                        help="Seconds between snapshots of live state")
+    parser.add_argument('--latency', nargs='*', choices=DIMENSIONS, metavar='DIMENSION',
+                        help="Print p50/p90/p99 of CI time to first verdict and queue to result in minutes "
+                             "by DIMENSION: {} (default is all)".format(', '.join(DIMENSIONS)))
+    return parser.parse_args()
+
+
+def read_dump(path):
+    """Yields changes of recorded 'gerrit query --format=JSON' output. File may be gzipped, '-' is stdin."""
+    source = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    try:
+        stream = source
+        # stdin can't be reopened, so format is detected by peeking
+        if source.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+            stream = gzip.GzipFile(fileobj=source)
+        for line in stream:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            if data.get('type') != 'stats':
+                yield data
+    finally:
+        if path != '-':
+            source.close()
+
+
+def _select(changes, since=None, limit=None):
+    """Yields changes updated since 'since' up to 'limit' changes."""
+    count = 0
+    for data in changes:
+        if limit is not None and count >= limit:
+            return
+        if since and data.get('lastUpdated', since) < since:
+            continue
+        count += 1
+        yield data
+
+
+def sync_store(store, client, since=None, limit=None, page_size=PAGE_SIZE):
+    """Downloads changes updated after high-water mark of store (or since/limit for empty store)."""
+    mark = store.high_water_mark()
+    if mark:
+        # changes updated in the same second as mark are downloaded again - it's cheap and nothing is lost
+        since, limit = mark, None
+    changes = client.query_stream(GERRIT_QUERY, options='--comments --patch-sets', since=since, limit=limit,
+                                  page_size=page_size)
+    return store.save_many(changes)
+
+
 def main():
-    limit = "30"
-    if len(sys.argv) > 1:
-        limit = sys.argv[1]
-    cmd = "{} {} {}".format(SSH_CMD, SSH_DEST, GERRIT_CMD)
-    cmd = cmd.format(limit)
-    output = subprocess.check_output(cmd, shell=True).decode()
-    for line in output.splitlines():
-        data = json.loads(line)
-        if 'id' not in data or data['status'] == 'ABANDONED':
-            # looks like it's a summary
+    args = parse_args()
+    since = None
+    if args.since:
+        since = datetime.datetime.strptime(args.since, '%Y-%m-%d').timestamp()
+    if args.daemon or args.events:
+        run_daemon(args, since=since)
+        return
+    limit = args.limit if args.limit or since or args.input else DEFAULT_LIMIT
+    store = None
+    if args.db:
+        store = ReviewStore(args.db)
+        if args.input:
+            count = store.save_many(read_dump(args.input))
+            print("Imported reviews: {}".format(count), flush=True)
+        elif not args.offline:
+            count = sync_store(store, GerritClient(), since=since, limit=limit, page_size=args.page_size)
+            print("Synced reviews: {}".format(count), flush=True)
+        changes = store.changes(since=since, limit=limit)
+    elif args.input:
+        changes = _select(read_dump(args.input), since=since, limit=limit)
+    else:
+        # reviews are analysed one by one as they arrive, so memory doesn't depend on number of reviews
+        # patch sets are needed for time to first verdict only
+        options = '--comments --patch-sets' if args.latency is not None else '--comments'
+        changes = GerritClient().query_stream(GERRIT_QUERY, options=options, since=since, limit=limit,
+                                              page_size=args.page_size)
+    stats = ReviewStats()
+    for data in changes:
+        if data['status'] == 'ABANDONED':
             continue
-        output = check_review(data)
+        output = check_review(data, stats)
         if len(output) > 1:
-            print('\n'.join(output))
-    print("Juniper fails: {}".format(juniper_fails))
-    print("TF      fails: {}".format(tf_fails))
+            print('\n'.join(output), flush=True)
+    if store:
+        store.close()
+    print("Juniper fails: {}".format(stats.juniper_fails))
+    print("TF      fails: {}".format(stats.tf_fails))
+    if args.latency is not None:
+        for dimension in args.latency or ['all']:
+            print('\n'.join([''] + stats.latency.report(dimension)))
 
 
 if __name__ == "__main__":
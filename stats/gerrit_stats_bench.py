@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmark of gerrit_stats.py.
+
+'generate' writes synthetic dump shaped like output of 'gerrit query --format=JSON --comments':
+reviews of several projects with several patch sets, 'Uploaded patch set' comments, '(check)' comments
+of zuul-tf, 'Build Started/Failed' and 'Verified+1' comments of jenkins2-engprod, rechecks and human votes.
+Dump is gzipped if its name ends with '.gz'. It can be replayed by 'gerrit_stats.py --input'.
+
+'run' measures reviews/sec and peak memory (max RSS) of parsing dump (read_dump) and of parsing with
+check_review for each size. Every phase is measured in separate process, so peak memory doesn't mix.
+Dumps are generated once and kept in work dir. Results are appended to results file and compared
+with previous run of the same size, so regressions are visible.
+
+Params of 'generate':
+
+reviews - number of reviews
+output - path to dump
+--seed - seed of random generator (default is 0)
+--patch-sets - add 'patchSets' like 'gerrit query --patch-sets'
+
+Params of 'run':
+
+--size - number of reviews. may be set several times (default is 1000, 10000 and 100000)
+--work-dir - path to dir with dumps and results (default is 'bench' in script's dir)
+--seed - seed of generated dumps (default is 0)
+--threshold - percent of slowdown (or memory growth) against previous run to report regression (default is 20)
+--results - path to results file (default is 'results.jsonl' in work dir)
+"""
+
+import argparse
+import datetime
+import gzip
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+
+SIZES = (1000, 10000, 100000)
+PHASES = ('parse', 'check')
+DEFAULT_THRESHOLD = 20
+# MB. smaller growth of peak memory is noise
+REGRESSION_MIN_MEMORY = 2
+DUMP_FILE = 'dump-{}-{}.json.gz'
+PROJECTS = (
+    'Juniper/contrail-controller', 'Juniper/contrail-vrouter', 'Juniper/contrail-analytics',
+    'Juniper/contrail-api-client', 'Juniper/contrail-common', 'Juniper/contrail-web-core',
+    'Juniper/contrail-packages', 'Juniper/contrail-build', 'Juniper/contrail-zuul-jobs',
+)
+BRANCHES = ('master', 'master', 'master', 'R2011', 'R1912')
+USERS = ('alice', 'bob', 'carol', 'dave', 'erin', 'frank', 'grace', 'heidi')
+ZUUL_JOBS = ('build-tf', 'test-unittest', 'test-sanity-ansible', 'test-sanity-k8s', 'test-helm')
+# seconds
+REVIEW_INTERVAL = 900
+PATCH_SET_INTERVAL = 7200
+ZUUL_FAIL_RATE = 0.25
+JENKINS_FAIL_RATE = 0.2
+RECHECK_RATE = 0.3
+
+
+def log(message, level='INFO'):
+    print(level + ' ' + message, flush=True)
+
+
+def _account(username):
+    return {'name': username.capitalize(), 'email': '{}@example.org'.format(username), 'username': username}
+
+
+def _zuul_comments(rnd, num, start):
+    time_started = start + rnd.randint(30, 600)
+    comments = [(time_started, 'zuul-tf', "Patch Set {}:\n\nTF CI started (check)".format(num))]
+    failed = rnd.random() < ZUUL_FAIL_RATE
+    jobs = '\n'.join("- {} http://logs.tf-jenkins.example.org/{}/{} : {} in {}m".format(
+        job, num, job, 'FAILURE' if failed and i == 0 else 'SUCCESS', rnd.randint(5, 180))
+        for i, job in enumerate(rnd.sample(ZUUL_JOBS, 3)))
+    message = "Patch Set {}: Verified{}\n\nTF CI {} (check)\n\n{}".format(
+        num, '-1' if failed else '+1', 'failed' if failed else 'succeeded', jobs)
+    comments.append((time_started + int(rnd.lognormvariate(8.3, 0.5)), 'zuul-tf', message))
+    return comments
+
+
+def _jenkins_comments(rnd, num, start):
+    url = 'http://jenkins.example.org/job/ci-contrail/{}/'.format(rnd.randint(1000, 99999))
+    time_started = start + rnd.randint(10, 300)
+    comments = [(time_started, 'jenkins2-engprod', "Patch Set {}:\n\nBuild Started {}".format(num, url))]
+    if rnd.random() < JENKINS_FAIL_RATE:
+        message = "Patch Set {}: Verified-1\n\nBuild Failed \n\n{} : FAILURE".format(num, url)
+    else:
+        message = "Patch Set {}: Verified+1\n\nBuild Successful \n\n{} : SUCCESS".format(num, url)
+    comments.append((time_started + int(rnd.lognormvariate(8.8, 0.4)), 'jenkins2-engprod', message))
+    return comments
+
+
+def _review(rnd, number, created, patch_sets):
+    project = rnd.choice(PROJECTS)
+    owner = rnd.choice(USERS)
+    comments = list()
+    items = list()
+    for num in range(1, rnd.randint(1, 5) + 1):
+        uploaded = created + (num - 1) * rnd.randint(600, PATCH_SET_INTERVAL)
+        items.append({'number': num, 'revision': '{:040x}'.format(rnd.getrandbits(160)), 'createdOn': uploaded,
+                      'uploader': _account(owner)})
+        comments.append((uploaded, owner, "Uploaded patch set {}.".format(num)))
+        comments += _zuul_comments(rnd, num, uploaded)
+        comments += _jenkins_comments(rnd, num, uploaded)
+        if rnd.random() < RECHECK_RATE:
+            recheck = max(timestamp for timestamp, _, _ in comments) + rnd.randint(60, 3600)
+            comments.append((recheck, owner, "Patch Set {}:\n\nrecheck".format(num)))
+            comments += _zuul_comments(rnd, num, recheck)
+            comments += _jenkins_comments(rnd, num, recheck)
+        if rnd.random() < 0.5:
+            comments.append((uploaded + rnd.randint(3600, 86400), rnd.choice(USERS),
+                             "Patch Set {}: Code-Review+{}".format(num, rnd.randint(1, 2))))
+    comments.sort()
+    status = rnd.choices(('NEW', 'MERGED', 'ABANDONED'), (60, 35, 5))[0]
+    data = {
+        'project': project,
+        'branch': rnd.choice(BRANCHES),
+        'id': 'I{:040x}'.format(rnd.getrandbits(160)),
+        'number': number,
+        'subject': "Fix {} in {}".format(rnd.choice(('build', 'test', 'agent', 'config')), project.split('/')[1]),
+        'owner': _account(owner),
+        'url': 'https://review.opencontrail.org/c/{}/+/{}'.format(project, number),
+        'createdOn': created,
+        'lastUpdated': comments[-1][0],
+        'open': status == 'NEW',
+        'status': status,
+        'comments': [{'timestamp': timestamp, 'reviewer': _account(username), 'message': message}
+                     for timestamp, username, message in comments],
+    }
+    if patch_sets:
+        data['patchSets'] = items
+    return data
+
+
+def generate(path, reviews, seed=0, patch_sets=False):
+    """Writes dump of synthetic reviews ordered like 'gerrit query' output (recently updated first)."""
+    rnd = random.Random(seed)
+    now = int(time.time())
+    # serialized lines take much less memory than dicts
+    lines = list()
+    for i in range(reviews):
+        data = _review(rnd, 100000 + i, now - (reviews - i) * REVIEW_INTERVAL, patch_sets)
+        lines.append((data['lastUpdated'], json.dumps(data)))
+    lines.sort(key=lambda item: item[0], reverse=True)
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path + '.tmp', 'wt') as fh:
+        for _, line in lines:
+            fh.write(line + '\n')
+        fh.write(json.dumps({'type': 'stats', 'rowCount': reviews, 'moreChanges': False}) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def measure(phase, path):
+    """Measures phase over dump in this process and prints results as JSON."""
+    import gerrit_stats
+
+    count = 0
+    start = time.perf_counter()
+    if phase == 'parse':
+        for data in gerrit_stats.read_dump(path):
+            count += 1
+    else:
+        stats = gerrit_stats.ReviewStats()
+        for data in gerrit_stats.read_dump(path):
+            count += 1
+            if data['status'] != 'ABANDONED':
+                gerrit_stats.check_review(data, stats)
+    duration = time.perf_counter() - start
+    print(json.dumps({'reviews': count, 'seconds': duration, 'peak_rss_mb': _peak_rss() / 1024}))
+
+
+def _peak_rss():
+    # ru_maxrss survives exec and would include memory of parent, VmHWM is reset by exec
+    with open('/proc/self/status') as fh:
+        for line in fh:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_size(args, size):
+    dump = os.path.join(args.work_dir, DUMP_FILE.format(size, args.seed))
+    if not os.path.exists(dump):
+        log("Generating dump of {} reviews".format(size))
+        generate(dump, size, seed=args.seed)
+    results = dict()
+    for phase in PHASES:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), 'measure', phase, dump])
+        measured = json.loads(output)
+        results[phase + '.reviews_per_sec'] = round(measured['reviews'] / measured['seconds'], 1)
+        results[phase + '.peak_rss_mb'] = round(measured['peak_rss_mb'], 1)
+        log("    {} of {} reviews took {:.2f}s".format(phase, measured['reviews'], measured['seconds']))
+    return results
+
+
+def _previous(path, size, seed):
+    # the latest result of the same size
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as fh:
+        for line in fh:
+            record = json.loads(line)
+            if record['size'] == size and record['seed'] == seed:
+                previous = record
+    return previous
+
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def report(size, results, previous, threshold):
+    """Logs results against previous ones. Returns number of regressions."""
+    regressions = 0
+    log("{:<26} {:>10} {:>10} {:>8}".format('size {}'.format(size), 'value', 'prev', 'change'))
+    for key in sorted(results):
+        old = previous['results'].get(key) if previous else None
+        change = ''
+        level = 'INFO'
+        if old:
+            percent = (results[key] - old) * 100 / old
+            change = '{:+.0f}%'.format(percent)
+            # rate is better when higher, memory - when lower
+            if key.endswith('.reviews_per_sec'):
+                regressed = -percent > threshold
+            else:
+                regressed = percent > threshold and results[key] - old > REGRESSION_MIN_MEMORY
+            if regressed:
+                change += ' REGRESSION'
+                level = 'WARNING'
+                regressions += 1
+        log("{:<26} {:>10.1f} {:>10} {:>8}".format(key, results[key], '{:.1f}'.format(old) if old else '-', change),
+            level=level)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of gerrit_stats.py")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_generate = subparsers.add_parser('generate', help="Generate synthetic dump of 'gerrit query'")
+    parser_generate.add_argument('reviews', type=int, help="Number of reviews")
+    parser_generate.add_argument('output', help="Path to dump, gzipped if it ends with .gz")
+    parser_generate.add_argument('--seed', type=int, default=0, help="Seed of random generator")
+    parser_generate.add_argument('--patch-sets', action='store_true', default=False,
+                                 help="Add patch sets like 'gerrit query --patch-sets'")
+    parser_run = subparsers.add_parser('run', help="Measure reviews/sec and peak memory")
+    parser_run.add_argument('--size', type=int, action='append', help="Number of reviews")
+    parser_run.add_argument('--work-dir', default='./bench', help="Path to dir with dumps and results")
+    parser_run.add_argument('--seed', type=int, default=0, help="Seed of generated dumps")
+    parser_run.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                            help="Percent of slowdown or memory growth to report regression")
+    parser_run.add_argument('--results', help="Path to results file")
+    parser_measure = subparsers.add_parser('measure')
+    parser_measure.add_argument('phase', choices=PHASES)
+    parser_measure.add_argument('dump')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == 'generate':
+        generate(args.output, args.reviews, seed=args.seed, patch_sets=args.patch_sets)
+        return 0
+    if args.command == 'measure':
+        measure(args.phase, args.dump)
+        return 0
+
+    args.work_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), args.work_dir))
+    os.makedirs(args.work_dir, exist_ok=True)
+    results_path = args.results or os.path.join(args.work_dir, 'results.jsonl')
+    regressions = 0
+    for size in args.size or SIZES:
+        log("Size {}".format(size))
+        results = run_size(args, size)
+        regressions += report(size, results, _previous(results_path, size, args.seed), args.threshold)
+        record = {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'revision': _revision(),
+                  'size': size, 'seed': args.seed, 'results': results}
+        with open(results_path, 'a') as fh:
+            fh.write(json.dumps(record, sort_keys=True) + '\n')
+    log("Results are appended to {}".format(results_path))
+    if regressions:
+        log("Regressions: {}".format(regressions), level='ERROR')
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""Streaming latency analytics of CI systems for gerrit_stats.
+
+Latencies are kept in mergeable quantile sketches: values are counted in logarithmic buckets
+(like DDSketch), so memory doesn't depend on number of values, any quantile has bounded relative
+error and sketches of different periods/shards are merged by adding bucket counts.
+"""
+
+import math
+
+
+# relative error of quantiles
+SKETCH_ACCURACY = 0.01
+# seconds. smaller latencies are counted as zero
+MIN_LATENCY = 1.0
+QUANTILES = (0.5, 0.9, 0.99)
+DIMENSIONS = ('all', 'project', 'day')
+
+
+class QuantileSketch():
+    """Mergeable streaming quantile sketch with relative error of SKETCH_ACCURACY."""
+
+    def __init__(self, accuracy=SKETCH_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # bucket index -> count. bucket i has values in (gamma^(i-1), gamma^i]
+        self.buckets = dict()
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if value < MIN_LATENCY:
+            self.zeros += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            raise ValueError("Sketches with different accuracy can't be merged")
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return self.min
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                # middle of bucket has relative error <= accuracy
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'accuracy': self.accuracy, 'buckets': {str(index): count for index, count in self.buckets.items()},
+                'zeros': self.zeros, 'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['accuracy'])
+        sketch.buckets = {int(index): count for index, count in data['buckets'].items()}
+        for key in ('zeros', 'count', 'total', 'min', 'max'):
+            setattr(sketch, key, data[key])
+        return sketch
+
+
+class LatencyStats():
+    """Latency sketches by (CI system, metric) overall, per project and per day."""
+
+    def __init__(self):
+        # (ci, metric, dimension, value) -> sketch
+        self.sketches = dict()
+
+    def add(self, ci, metric, project, day, seconds):
+        for dimension, value in (('all', ''), ('project', project), ('day', day)):
+            key = (ci, metric, dimension, value)
+            if key not in self.sketches:
+                self.sketches[key] = QuantileSketch()
+            self.sketches[key].add(seconds)
+
+    def merge(self, other):
+        for key, sketch in other.sketches.items():
+            if key not in self.sketches:
+                self.sketches[key] = QuantileSketch(sketch.accuracy)
+            self.sketches[key].merge(sketch)
+
+    def report(self, dimension='all'):
+        """Returns lines of table with count and quantiles (in minutes) for dimension."""
+        output = ["{:<18} {:<16} {:<32} {:>7} {}".format(
+            'ci', 'metric', dimension, 'count', ' '.join('{:>8}'.format('p{:g}'.format(q * 100)) for q in QUANTILES))]
+        for (ci, metric, dim, value) in sorted(key for key in self.sketches if key[2] == dimension):
+            sketch = self.sketches[(ci, metric, dim, value)]
+            output.append("{:<18} {:<16} {:<32} {:>7} {}".format(
+                ci, metric, value or '-', sketch.count,
+                ' '.join('{:>8.1f}'.format(sketch.quantile(q) / 60) for q in QUANTILES)))
+        return output
+
+    def to_dict(self):
+        return [list(key) + [sketch.to_dict()] for key, sketch in self.sketches.items()]
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        for ci, metric, dimension, value, sketch in data:
+            stats.sketches[(ci, metric, dimension, value)] = QuantileSketch.from_dict(sketch)
+        return stats
@@ -0,0 +1,138 @@
+"""Local SQLite store of gerrit changes, patch sets and comments for gerrit_stats.
+
+Changes are saved in the same JSON shape as 'gerrit query --format=JSON --comments --patch-sets'
+returns them and are read back in this shape, so reports work the same way on store and on gerrit.
+High-water mark is max 'lastUpdated' of synced changes - next sync downloads only newer changes.
+"""
+
+import sqlite3
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS changes (
+    number INTEGER PRIMARY KEY,
+    id TEXT NOT NULL,
+    project TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    status TEXT NOT NULL,
+    subject TEXT,
+    url TEXT,
+    created_on INTEGER NOT NULL,
+    last_updated INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS changes_last_updated ON changes (last_updated);
+CREATE TABLE IF NOT EXISTS patch_sets (
+    change_number INTEGER NOT NULL REFERENCES changes (number) ON DELETE CASCADE,
+    number INTEGER NOT NULL,
+    revision TEXT,
+    created_on INTEGER,
+    PRIMARY KEY (change_number, number)
+);
+CREATE TABLE IF NOT EXISTS comments (
+    change_number INTEGER NOT NULL REFERENCES changes (number) ON DELETE CASCADE,
+    timestamp INTEGER NOT NULL,
+    username TEXT,
+    name TEXT,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS comments_change ON comments (change_number, timestamp);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+HIGH_WATER_MARK = 'last_updated'
+# changes per transaction while saving
+COMMIT_EVERY = 500
+
+
+class ReviewStore():
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # readers are not blocked by sync
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA foreign_keys=ON')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def high_water_mark(self):
+        """Returns max 'lastUpdated' of synced changes or None for empty store."""
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (HIGH_WATER_MARK,)).fetchone()
+        return int(row[0]) if row else None
+
+    def save_many(self, changes):
+        """Saves changes (replacing stored ones) and moves high-water mark. Returns number of saved changes.
+
+        Mark is moved only after all changes are saved - interrupted sync is repeated from the old mark."""
+        count = 0
+        last_updated = self.high_water_mark() or 0
+        try:
+            for data in changes:
+                self._save(data)
+                last_updated = max(last_updated, data['lastUpdated'])
+                count += 1
+                if count % COMMIT_EVERY == 0:
+                    self.db.commit()
+            if count:
+                self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                (HIGH_WATER_MARK, str(last_updated)))
+        finally:
+            self.db.commit()
+        return count
+
+    def changes(self, since=None, limit=None):
+        """Yields stored changes updated since 'since' (unix time), recently updated first."""
+        query = 'SELECT number, id, project, branch, status, subject, url, created_on, last_updated FROM changes'
+        params = list()
+        if since:
+            query += ' WHERE last_updated >= ?'
+            params.append(since)
+        query += ' ORDER BY last_updated DESC'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        # separate cursor - comments are read while changes are iterated
+        for row in self.db.cursor().execute(query, params):
+            number = row[0]
+            data = {'number': number, 'id': row[1], 'project': row[2], 'branch': row[3], 'status': row[4],
+                    'subject': row[5], 'url': row[6], 'createdOn': row[7], 'lastUpdated': row[8]}
+            data['patchSets'] = [
+                {'number': num, 'revision': revision, 'createdOn': created_on}
+                for num, revision, created_on in self.db.execute(
+                    'SELECT number, revision, created_on FROM patch_sets WHERE change_number = ? ORDER BY number',
+                    (number,))]
+            data['comments'] = list()
+            for timestamp, username, name, message in self.db.execute(
+                    'SELECT timestamp, username, name, message FROM comments WHERE change_number = ? '
+                    'ORDER BY timestamp, rowid', (number,)):
+                reviewer = dict()
+                if username is not None:
+                    reviewer['username'] = username
+                if name is not None:
+                    reviewer['name'] = name
+                data['comments'].append({'timestamp': timestamp, 'reviewer': reviewer, 'message': message})
+            yield data
+
+    def _save(self, data):
+        # old gerrit returns number as string
+        number = int(data['number'])
+        self.db.execute(
+            'INSERT OR REPLACE INTO changes (number, id, project, branch, status, subject, url, created_on, last_updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (number, data['id'], data['project'], data['branch'], data['status'], data.get('subject'), data.get('url'),
+             data['createdOn'], data['lastUpdated']))
+        # changed change is replaced completely
+        self.db.execute('DELETE FROM patch_sets WHERE change_number = ?', (number,))
+        self.db.execute('DELETE FROM comments WHERE change_number = ?', (number,))
+        self.db.executemany(
+            'INSERT INTO patch_sets (change_number, number, revision, created_on) VALUES (?, ?, ?, ?)',
+            [(number, int(item['number']), item.get('revision'), item.get('createdOn'))
+             for item in data.get('patchSets', list())])
+        self.db.executemany(
+            'INSERT INTO comments (change_number, timestamp, username, name, message) VALUES (?, ?, ?, ?, ?)',
+            [(number, item['timestamp'], item['reviewer'].get('username'), item['reviewer'].get('name'),
+              item['message']) for item in data.get('comments', list())])